@@ -1,3 +1,6 @@
+import json
+import hashlib
+
 from settings import SIZE
 
 # Helper function to determine if a key falls within a range
@@ -11,13 +14,38 @@ def inrange(c, a, b):
 		return a <= c and c < b
 	return a <= c or c < b
 
+# position of a string on the ring, SHA-1 as in the paper: it is the same
+# in every process, unlike hash(), and spreads them evenly
+def hash_id(text):
+	if isinstance(text, unicode):
+		text = text.encode('utf-8')
+	return int(hashlib.sha1(text).hexdigest(), 16) % SIZE
+
+# position of a key on the ring
+def key_id(key):
+	if not isinstance(key, basestring):
+		key = str(key)
+	return hash_id(key)
+
 class Address(object):
-	def __init__(self, ip, port):
+	# vnode tells apart the virtual nodes living in the same process, they
+	# all share ip and port. position is set once a node moved away from
+	# the place its address hashes to (see chord.Local.move)
+	def __init__(self, ip, port, vnode = 0, position = None):
 		self.ip = ip
 		self.port = int(port)
+		self.vnode = int(vnode)
+		self.position = position if position == None else int(position) % SIZE
+		# our id, hashed the first time it's needed
+		self.id_ = self.position
 
 	def __hash__(self):
-		return hash(("%s:%s" % (self.ip, self.port))) % SIZE
+		if self.id_ == None:
+			if self.vnode:
+				self.id_ = hash_id("%s#%s:%s" % (self.vnode, self.ip, self.port))
+			else:
+				self.id_ = hash_id("%s:%s" % (self.ip, self.port))
+		return self.id_
 
 	def __cmp__(self, other):
 		return other.__hash__() < self.__hash__()
@@ -26,4 +54,20 @@ class Address(object):
 		return other.__hash__() == self.__hash__()
 
 	def __str__(self):
-		return "[\"%s\", %s]" % (self.ip, self.port)
+		return json.dumps(list(self.wire()))
+
+	def endpoint(self):
+		# where the process hosting this node listens
+		return (self.ip, self.port)
+
+	def identity(self):
+		# the node behind the address, wherever it is on the ring
+		return (self.ip, self.port, self.vnode)
+
+	def wire(self):
+		# how addresses travel between peers, Address(*wire) gets it back
+		if self.position != None:
+			return (self.ip, self.port, self.vnode, self.position)
+		if self.vnode:
+			return (self.ip, self.port, self.vnode)
+		return (self.ip, self.port)
@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import bisect
+import argparse
+import threading
+import subprocess
+
+from address import Address
+from remote import Remote, wait_for
+from settings import VNODES
+
+# Load generator for the DHT: starts a ring of N processes (python dht.py)
+# on localhost, drives gets and sets at it from a number of client
+# threads, and reports throughput, latency percentiles and how evenly the
+# load spread over the nodes. Results can be appended as a JSON line to a
+# file to compare versions.
+
+BENCH_PORT = 47000
+# seconds a node has to start answering, and the ring to settle
+START_TIMEOUT = 30
+SETTLE_TIMEOUT = 60
+
+# picks keys from a keyspace of size keys, every key equally likely or
+# the i-th one with probability proportional to 1/i^s
+class KeyChooser(object):
+	def __init__(self, keys, distribution = 'uniform', s = 0.99):
+		self.keys_ = keys
+		self.distribution_ = distribution
+		self.cumulative_ = None
+		if distribution == 'zipf':
+			total = 0.0
+			self.cumulative_ = []
+			for i in range(keys):
+				total += 1.0 / (i + 1) ** s
+				self.cumulative_.append(total)
+		elif distribution != 'uniform':
+			raise ValueError("unknown distribution %s" % distribution)
+
+	def pick(self, rnd):
+		if self.cumulative_ == None:
+			i = rnd.randrange(self.keys_)
+		else:
+			i = bisect.bisect_left(self.cumulative_, rnd.random() * self.cumulative_[-1])
+		return "key%s" % i
+
+def value_size(sizes, rnd):
+	# sizes = (smallest, biggest) in bytes
+	return rnd.randint(sizes[0], sizes[1])
+
+def percentile(values, fraction):
+	# values sorted
+	if not len(values):
+		return None
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def latency_summary(latencies):
+	latencies = sorted(latencies)
+	if not len(latencies):
+		return {'count':0}
+	return {'count':len(latencies), 'mean':sum(latencies) / len(latencies), \
+	        'p50':percentile(latencies, 0.5), 'p99':percentile(latencies, 0.99), \
+	        'p999':percentile(latencies, 0.999), 'max':latencies[-1]}
+
+class Ring(object):
+	# n processes running dht.py, the first one starts the ring
+	def __init__(self, n, port = BENCH_PORT, vnodes = VNODES):
+		self.addresses_ = map(lambda i: Address('127.0.0.1', port + i), range(n))
+		self.vnodes_ = vnodes
+		self.processes_ = []
+
+	def start(self):
+		here = os.path.dirname(os.path.abspath(__file__))
+		devnull = open(os.devnull, 'w')
+		for i, address in enumerate(self.addresses_):
+			args = [sys.executable, os.path.join(here, 'dht.py'), str(address.port)]
+			args.append(str(self.addresses_[0].port) if i > 0 else '-')
+			args.append(str(self.vnodes_))
+			# dht.py runs until its stdin gets a line
+			self.processes_.append(subprocess.Popen(args, stdin = subprocess.PIPE, \
+			                       stdout = devnull, stderr = devnull, cwd = here))
+			if i == 0:
+				self.wait_for(lambda: Remote(address).ping(), START_TIMEOUT)
+		for address in self.addresses_:
+			if not self.wait_for(lambda: Remote(address).ping(), START_TIMEOUT):
+				raise RuntimeError("node %s didn't start" % address)
+		if not self.wait_for(self.settled, SETTLE_TIMEOUT):
+			raise RuntimeError("the ring didn't settle in %s seconds" % SETTLE_TIMEOUT)
+
+	def wait_for(self, predicate, timeout):
+		end = time.time() + timeout
+		while time.time() < end:
+			try:
+				if predicate():
+					return True
+			except socket.error:
+				pass
+			time.sleep(0.5)
+		return False
+
+	def settled(self):
+		# every node has the successor it should, virtual ones included
+		nodes = [Address(address.ip, address.port, vnode) for address in self.addresses_ \
+		         for vnode in range(self.vnodes_)]
+		nodes = sorted(nodes, key = lambda address: address.__hash__())
+		for i, address in enumerate(nodes):
+			if Remote(address).successor().id() != nodes[(i + 1) % len(nodes)].__hash__():
+				return False
+		return True
+
+	def stats(self):
+		# port -> {'requests': requests served as owner of the key, 'keys':
+		# keys owned}. Clients pick the node they ask at random, so what
+		# tells the nodes apart is the work of the keys they own
+		result = {}
+		for address in self.addresses_:
+			metrics = Remote(address).call('stats')
+			requests = 0
+			for entry in metrics.get('dht_owner_requests_total', []):
+				if entry['labels'].get('port') == str(address.port):
+					requests = entry['value']
+			keys = 0
+			for entry in metrics.get('dht_keys', []):
+				if entry['labels'].get('port') == str(address.port):
+					keys = entry['value']
+			result[address.port] = {'requests':requests, 'keys':keys}
+		return result
+
+	def stop(self):
+		for process in self.processes_:
+			try:
+				process.kill()
+				process.wait()
+			except OSError:
+				pass
+		self.processes_ = []
+
+def imbalance(values):
+	# most loaded node over the average, 1 is perfectly even
+	values = list(values)
+	if not len(values) or not sum(values):
+		return None
+	return max(values) / (float(sum(values)) / len(values))
+
+def client(nodes, config, chooser, end, measure_from, results, seed):
+	# one client thread, results[op] gets the latencies of the calls
+	# made after measure_from
+	rnd = random.Random(seed)
+	latencies = {'get':[], 'set':[]}
+	errors = {'get':0, 'set':0}
+	while time.time() < end:
+		op = 'get' if rnd.random() < config['get_ratio'] else 'set'
+		key = chooser.pick(rnd)
+		node = nodes[rnd.randrange(len(nodes))]
+		start = time.time()
+		try:
+			if op == 'get':
+				response = node.call('get', {'key':key})
+			else:
+				response = node.call('set', {'key':key, 'value':'x' * value_size(config['value_size'], rnd)})
+			ok = response != None and response['status'] == 'ok'
+		except socket.error:
+			ok = False
+		if start < measure_from:
+			continue
+		if ok:
+			latencies[op].append(time.time() - start)
+		else:
+			errors[op] += 1
+	results.append((latencies, errors))
+
+def preload(nodes, config, keys, batch = 256):
+	# every key of the keyspace gets a value, so gets find something. A
+	# batch of sets is in flight at a time
+	rnd = random.Random(config['seed'])
+	for first in range(0, keys, batch):
+		calls = []
+		for i in range(first, min(first + batch, keys)):
+			value = 'x' * value_size(config['value_size'], rnd)
+			calls.append(nodes[i % len(nodes)].call_async('set', {'key':"key%s" % i, 'value':value}))
+		wait_for(calls, len(calls))
+
+def run(config):
+	ring = Ring(config['nodes'], config['port'], config['vnodes'])
+	try:
+		print "starting %s nodes" % config['nodes']
+		ring.start()
+		nodes = map(Remote, ring.addresses_)
+		if config['preload']:
+			print "preloading %s keys" % config['keys']
+			preload(nodes, config, config['keys'])
+		chooser = KeyChooser(config['keys'], config['distribution'], config['zipf_s'])
+		before = ring.stats()
+		print "running %s clients for %s seconds" % (config['concurrency'], config['warmup'] + config['duration'])
+		measure_from = time.time() + config['warmup']
+		end = measure_from + config['duration']
+		results = []
+		threads = []
+		for i in range(config['concurrency']):
+			thread = threading.Thread(target = client, args = (nodes, config, chooser, end, \
+			                          measure_from, results, config['seed'] + i))
+			thread.daemon = True
+			thread.start()
+			threads.append(thread)
+		for thread in threads:
+			thread.join()
+		after = ring.stats()
+	finally:
+		ring.stop()
+	latencies = {'get':[], 'set':[]}
+	errors = {'get':0, 'set':0}
+	for thread_latencies, thread_errors in results:
+		for op in latencies:
+			latencies[op] += thread_latencies[op]
+			errors[op] += thread_errors[op]
+	load = dict((port, {'requests':after[port]['requests'] - before[port]['requests'], \
+	                    'keys':after[port]['keys']}) for port in after)
+	ops = len(latencies['get']) + len(latencies['set'])
+	return {'config':config, 'version':version(), 'time':time.time(), \
+	        'throughput':ops / float(config['duration']), \
+	        'latency':{'get':latency_summary(latencies['get']), \
+	                   'set':latency_summary(latencies['set']), \
+	                   'all':latency_summary(latencies['get'] + latencies['set'])}, \
+	        'errors':errors, \
+	        'nodes':dict((str(port), load[port]) for port in load), \
+	        'imbalance':{'requests':imbalance(map(lambda l: l['requests'], load.values())), \
+	                     'keys':imbalance(map(lambda l: l['keys'], load.values()))}}
+
+def version():
+	# the commit benchmarked, if this is a git checkout
+	try:
+		here = os.path.dirname(os.path.abspath(__file__))
+		return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = here, \
+		                               stderr = open(os.devnull, 'w')).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def report(result):
+	def ms(seconds):
+		return "%.2f" % (seconds * 1000) if seconds != None else "-"
+	print "throughput: %.1f ops/s" % result['throughput']
+	for op in ('get', 'set', 'all'):
+		summary = result['latency'][op]
+		if not summary['count']:
+			continue
+		print "%4s: %6s ops, p50 %s ms, p99 %s ms, p999 %s ms, max %s ms" % (op, summary['count'], \
+		      ms(summary['p50']), ms(summary['p99']), ms(summary['p999']), ms(summary['max']))
+	print "errors: %s" % result['errors']
+	print "imbalance (max / mean): requests %s, keys %s" % (result['imbalance']['requests'], \
+	      result['imbalance']['keys'])
+
+def parse_sizes(text):
+	# "100" or "100-1000"
+	sizes = map(int, text.split('-'))
+	return (sizes[0], sizes[-1])
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "DHT throughput and latency benchmark")
+	parser.add_argument('--nodes', type = int, default = 4)
+	parser.add_argument('--vnodes', type = int, default = VNODES, help = "virtual nodes per process")
+	parser.add_argument('--port', type = int, default = BENCH_PORT, help = "of the first node, the rest follow")
+	parser.add_argument('--concurrency', type = int, default = 8, help = "client threads")
+	parser.add_argument('--get-ratio', type = float, default = 0.9, help = "fraction of the operations that are gets")
+	parser.add_argument('--keys', type = int, default = 10000, help = "size of the keyspace")
+	parser.add_argument('--distribution', choices = ('uniform', 'zipf'), default = 'uniform')
+	parser.add_argument('--zipf-s', type = float, default = 0.99)
+	parser.add_argument('--value-size', type = parse_sizes, default = (100, 100), help = "bytes, SIZE or MIN-MAX")
+	parser.add_argument('--warmup', type = float, default = 5, help = "seconds not measured")
+	parser.add_argument('--duration', type = float, default = 30, help = "seconds measured")
+	parser.add_argument('--no-preload', dest = 'preload', action = 'store_false', help = "don't set every key first")
+	parser.add_argument('--seed', type = int, default = 0)
+	parser.add_argument('--output', help = "file the results are appended to, as a JSON line")
+	config = vars(parser.parse_args())
+	output = config.pop('output')
+	result = run(config)
+	report(result)
+	if output:
+		f = open(output, 'a')
+		f.write(json.dumps(result) + "\n")
+		f.close()
@@ -3,47 +3,36 @@ import sys
 import json
 import socket
 import threading
-import random
 import time
+import select
 import mutex
 
 from address import Address, inrange
-from remote import Remote
+from remote import Remote, call_observers, wait_for
+from lookup_cache import LookupCache
+from finger_table import FingerTable
+from failure_detector import detector
+from latency import latency
+from scheduler import scheduler
+from logger import get_logger, DEBUG, INFO, WARNING
+from metrics import metrics, HOPS_BUCKETS
+from threadpool import ThreadPool
 from settings import *
 from network import *
 
-def repeat_and_sleep(sleep_time):
-	def decorator(func):
-		def inner(self, *args, **kwargs):
-			while 1:
-				time.sleep(sleep_time)
-				if self.shutdown_:
-					return
-				ret = func(self, *args, **kwargs)
-				if not ret:
-					return
-		return inner
-	return decorator
-
-def retry_on_socket_error(retry_limit):
-	def decorator(func):
-		def inner(self, *args, **kwargs):
-			retry_count = 0
-			while retry_count < retry_limit:
-				try:
-					ret = func(self, *args, **kwargs)
-					return ret
-				except socket.error:
-					# exp retry time
-					time.sleep(2 ** retry_count)
-					retry_count += 1
-			if retry_count == retry_limit:
-				print "Retry count limit reached, aborting.. (%s)" % func.__name__
-				self.shutdown_ = True
-				sys.exit(-1)
-		return inner
-	return decorator
+def same_node(a, b):
+	if a == None or b == None:
+		return a is b
+	return a.id() == b.id()
 
+logger = get_logger(LOG_FILE)
+
+# commands every node answers, see Local.dispatch. Metrics are labelled
+# with these and the ones registered with register_command, anything else
+# a client sends is counted as 'unknown'
+BUILTIN_COMMANDS = ('get_successor', 'get_predecessor', 'find_successor', 'closest_preceding_finger',
+                    'notify', 'moved', 'get_successors', 'find_successors', 'route', 'ping',
+                    'lookup_stats', 'cache_stats', 'scheduler_stats', 'shutdown')
 
 # deamon to run Local's run method
 class Daemon(threading.Thread):
@@ -57,19 +46,39 @@ class Daemon(threading.Thread):
 
 # class representing a local peer
 class Local(object):
-	def __init__(self, local_address, remote_address = None):
+	# virtual nodes are created with the Local of the same process that
+	# listens for them as host, they share its socket and workers
+	def __init__(self, local_address, remote_address = None, host = None):
 		self.address_ = local_address
 		print "self id = %s" % self.id()
 		self.shutdown_ = False
+		# the host serves the requests of every virtual node, vnode -> Local
+		self.host_ = host if host != None else self
+		if self.host_ is self:
+			self.vnodes_ = {}
 		# list of successors
 		self.successors_ = []
+		# event -> callbacks, see subscribe
+		self.listeners_ = {}
 		# join the DHT
 		self.join(remote_address)
-		# we don't have deamons until we start
+		# we don't have deamons until we start, nor maintenance tasks
 		self.daemons_ = {}
+		self.tasks_ = {}
+		# seconds until the next fix_fingers
+		self.fingers_interval_ = FIX_FINGERS_INT
 		# initially no commands
 		self.command_ = []
-
+		# owners of the ranges we have been looking up, forgets the
+		# owners that stop answering
+		self.lookup_cache_ = LookupCache()
+		call_observers.append(self.lookup_cache_.report)
+		# lookup mode -> hops and time spent
+		self.lookup_stats_ = {}
+		self.lookup_mutex_ = threading.Lock()
+		self.host_.vnodes_[self.address_.vnode] = self
+		# counters and histograms of the whole process, see metrics.py
+		self.register_command('stats', self.get_stats)
 	
 	# is this id within our range?
 	def is_ours(self, id):
@@ -77,47 +86,115 @@ class Local(object):
 		return inrange(id, self.predecessor_.id(1), self.id(1))
 
 	def shutdown(self):
-		self.shutdown_ = Trues
+		self.shutdown_ = True
+		call_observers.remove(self.lookup_cache_.report)
+		for task in self.tasks_.values():
+			task.cancel()
+		if self.host_ is not self:
+			return
+		# nobody can reach our virtual nodes anymore
+		for vnode in self.vnodes_.values():
+			if vnode is not self and not vnode.shutdown_:
+				vnode.shutdown()
 		self.socket_.shutdown(socket.SHUT_RDWR)
 		self.socket_.close()
 
-	# logging function
-	def log(self, info):
-	    f = open("/tmp/chord.log", "a+")
-	    f.write(str(self.id()) + " : " +  info + "\n")
-	    f.close()
-	    #print str(self.id()) + " : " +  info
-
-	def start(self):
-		# start the daemons
-		self.daemons_['run'] = Daemon(self, 'run')
-		self.daemons_['fix_fingers'] = Daemon(self, 'fix_fingers')
-		self.daemons_['stabilize'] = Daemon(self, 'stabilize')
-		self.daemons_['update_successors'] = Daemon(self, 'update_successors')
-		for key in self.daemons_:
-			self.daemons_[key].start()
-
-		self.log("started")
+	# logging functions, they cost a comparison unless level is enabled
+	def log(self, info, level = DEBUG):
+		if logger.enabled(level):
+			logger.log(level, "%s : %s", self.id(), info)
+
+	def log_sampled(self, info, level = DEBUG):
+		# for the lines logged on every request, see Logger.sampled
+		if logger.enabled(level):
+			logger.sampled(level, "%s : %s", self.id(), info)
+
+	def start(self, serve = True):
+		# the host listens for all its virtual nodes, and the maintenance
+		# of every node in the process is run by the same scheduler. With
+		# serve = False somebody else hands us our requests (see
+		# simulator.py)
+		if self.host_ is self and serve:
+			self.daemons_['run'] = Daemon(self, 'run')
+			self.daemons_['run'].start()
+		self.schedule('fix_fingers', FIX_FINGERS_INT)
+		self.schedule('stabilize', STABILIZE_INT, STABILIZE_RET)
+		self.schedule('update_successors', UPDATE_SUCCESSORS_INT, UPDATE_SUCCESSORS_RET)
+		self.schedule('heartbeat', HEARTBEAT_INT)
+
+		self.log("started", INFO)
+
+	def schedule(self, method, interval, retries = None):
+		# method runs every interval seconds until it returns False or we
+		# shut down. After retries socket errors in a row we give up.
+		def run():
+			if self.shutdown_:
+				return False
+			return getattr(self, method)()
+		def give_up():
+			print "Retry count limit reached, aborting.. (%s)" % method
+			self.shutdown_ = True
+		self.tasks_[method] = scheduler.add(method, run, interval, retries, \
+		                                    SCHEDULER_DEADLINE, give_up)
 
 	def ping(self):
 		return True
 
+	def is_alive(self, node):
+		# what the failure detector thinks, no round trip involved
+		if node is self:
+			return True
+		return detector.is_alive(node.address_)
+
+	def heartbeat(self):
+		# ping the peers in our tables we haven't heard from lately, the
+		# answers (or their absence) feed the failure detector
+		peers = {}
+		for node in [self.successor_, self.predecessor_] + self.successors_ + self.fingers_.nodes():
+			if node != None and node is not self and \
+			   detector.needs_heartbeat(node.address_):
+				peers[node.address_.endpoint()] = node
+		pings = []
+		for node in peers.values():
+			try:
+				pings.append(node.call_async('ping'))
+			except socket.error:
+				pass
+		for ping in pings:
+			try:
+				ping.result(HEARTBEAT_TIMEOUT)
+			except socket.error:
+				pass
+		# get rid of the dead
+		self.set_successors(filter(lambda node: not detector.is_dead(node.address_), self.successors_))
+		self.fingers_.remove(lambda node: detector.is_dead(node.address_))
+		if self.predecessor_ != None and self.predecessor_ is not self and \
+		   detector.is_dead(self.predecessor_.address_):
+			self.set_predecessor(None)
+		# Keep calling us
+		return True
+
 	def join(self, remote_address = None):
-		# initially just set successor
-		self.finger_ = map(lambda x: None, range(LOGSIZE))
+		# initially just set successor, the other fingers are found by
+		# fix_fingers
+		self.fingers_ = FingerTable(self.id())
+		# finger to refresh next
+		self.next_finger_ = 1
 
 		self.predecessor_ = None
 
 		if remote_address:
 			remote = Remote(remote_address)
-			self.finger_[0] = remote.find_successor(self.id())
+			self.successor_ = remote.find_successor(self.id())
+		elif self.host_ is not self:
+			# the first process of the ring, its host might not be
+			# listening yet so we ask it directly
+			self.successor_ = Remote(self.host_.find_successor(self.id()).address_)
 		else:
-			self.finger_[0] = self
+			self.successor_ = self
 
-		self.log("joined")
+		self.log("joined", INFO)
 
-	@repeat_and_sleep(STABILIZE_INT)
-	@retry_on_socket_error(STABILIZE_RET)
 	def stabilize(self):
 		self.log("stabilize")
 		suc = self.successor()
@@ -126,17 +203,20 @@ class Local(object):
 		# - x exists
 		# - x is in range (n, suc(n))
 		# - [n+1, suc(n)) is non-empty
-		# fix finger_[0] if successor failed
-		if suc.id() != self.finger_[0].id():
-			self.finger_[0] = suc
+		# fix successor_ if it failed
+		if suc.id() != self.successor_.id():
+			self.set_successor(suc)
 		x = suc.predecessor()
 		if x != None and \
 		   inrange(x.id(), self.id(1), suc.id()) and \
 		   self.id(1) != suc.id() and \
-		   x.ping():
-			self.finger_[0] = x
+		   self.is_alive(x):
+			self.set_successor(x)
+			# x took part of somebody's range
+			self.lookup_cache_.invalidate_id(x.id())
 		# We notify our new successor about us
 		self.successor().notify(self)
+		self.publish('stabilized', self.successor())
 		# Keep calling us
 		return True
 
@@ -147,23 +227,118 @@ class Local(object):
 		# - the new node r is in the range (pred(n), n)
 		# OR
 		# - our previous predecessor is dead
-		self.log("notify")
+		# OR
+		# - it's our predecessor at a new position
+		self.log_sampled("notify")
 		if self.predecessor() == None or \
 		   inrange(remote.id(), self.predecessor().id(1), self.id()) or \
-		   not self.predecessor().ping():
-			self.predecessor_ = remote
+		   not self.is_alive(self.predecessor()) or \
+		   (remote.id() != self.predecessor().id() and \
+		    remote.address_.identity() == self.predecessor().address_.identity()):
+			self.set_predecessor(remote)
+			self.lookup_cache_.invalidate_id(remote.id())
+
+	def move(self, id):
+		# takes position id on the ring, anywhere between our predecessor
+		# and our successor. Going back hands the ids we leave behind to
+		# our successor, going forward takes them from it. Returns False
+		# if id is not a valid position.
+		id = id % SIZE
+		suc = self.successor()
+		predecessor = self.predecessor()
+		if id == self.id() or suc.id() == self.id() or predecessor == None or \
+		   not inrange(id, predecessor.id(1), suc.id()):
+			return False
+		old = self.address_
+		self.address_ = Address(old.ip, old.port, old.vnode, id)
+		self.fingers_.rebase(id)
+		self.next_finger_ = 1
+		self.lookup_cache_.invalidate_id(id)
+		self.log("moved to %s" % id, INFO)
+		# our neighbours hear about it now and the rest of the ring through
+		# stabilize and fix_fingers, meanwhile they reach us anyway since
+		# we answer at the same address
+		for node in [predecessor, suc]:
+			try:
+				node.moved(old, self.address_)
+			except socket.error:
+				pass
+		self.publish('moved', old, self.address_)
+		return True
+
+	def moved(self, old, new):
+		# the node at old is at new now, our tables get the new position
+		node = Remote(new)
+		def same(other):
+			return other != None and other is not self and \
+			       other.address_.identity() == new.identity()
+		self.lookup_cache_.invalidate_owner(old)
+		if same(self.predecessor_):
+			self.set_predecessor(node)
+		if same(self.successor_):
+			self.set_successor(node)
+		self.set_successors(map(lambda other: node if same(other) else other, self.successors_))
+		self.fingers_.replace(same, node)
 
-	@repeat_and_sleep(FIX_FINGERS_INT)
 	def fix_fingers(self):
-		# Randomly select an entry in finger_ table and update its value
+		# refreshes the fingers in order, one lookup covers every finger
+		# up to the node it finds. While they keep changing we go fast,
+		# once they are stable we slow down up to FIX_FINGERS_MAX_INT.
+		# Returns the seconds until the next one.
+		if self.fix_finger():
+			self.fingers_interval_ = FIX_FINGERS_INT
+		else:
+			self.fingers_interval_ = min(self.fingers_interval_ * 2, FIX_FINGERS_MAX_INT)
+		return self.fingers_interval_
+
+	def fix_finger(self):
+		# returns whether the finger changed
 		self.log("fix_fingers")
-		i = random.randrange(LOGSIZE - 1) + 1
-		self.finger_[i] = self.find_successor(self.id(1<<i))
-		# Keep calling us
-		return True
+		i = self.next_finger_
+		# the cache could hide the node that just joined
+		try:
+			node = self.lookup(self.fingers_.start(i), cached = False)[0]
+		except socket.error:
+			return True
+		if node.id() == self.id():
+			# we are alone
+			self.next_finger_ = 1
+			return False
+		# the intervals before the one node is in are empty
+		i = max(i, self.fingers_.interval_of(node))
+		if PROXIMITY_FINGERS:
+			node = self.nearest_in_interval(i, node)
+		self.next_finger_ = i + 1 if i + 1 < LOGSIZE else 1
+		return self.fingers_.update(i, node)
+
+	def nearest_in_interval(self, i, node):
+		# node is the first one in the interval of finger i, the nodes
+		# following it that are in the interval as well route just as
+		# well. Returns the one with the lowest round trip time.
+		start, end = self.fingers_.interval(i)
+		try:
+			candidates = [node] + node.get_successors()
+		except socket.error:
+			return node
+		candidates = filter(lambda candidate: candidate.id() != self.id() and \
+		                    inrange(candidate.id(), start, end) and \
+		                    self.is_alive(candidate), candidates)
+		if not len(candidates):
+			return node
+		# the ones we never talked to get measured now
+		pings = []
+		for candidate in candidates:
+			if latency.rtt(candidate.address_) == None:
+				try:
+					pings.append(candidate.call_async('ping'))
+				except socket.error:
+					pass
+		wait_for(pings, len(pings), HEARTBEAT_TIMEOUT)
+		measured = filter(lambda candidate: latency.rtt(candidate.address_) != None, candidates)
+		if not len(measured):
+			return node
+		return min(measured, key = lambda candidate: latency.rtt(candidate.address_))
 
-	@repeat_and_sleep(UPDATE_SUCCESSORS_INT)
-	@retry_on_socket_error(UPDATE_SUCCESSORS_RET)
 	def update_successors(self):
 		self.log("update successor")
 		suc = self.successor()
@@ -174,120 +349,452 @@ class Local(object):
 			if suc_list and len(suc_list):
 				successors += suc_list
 			# if everything worked, we update
-			self.successors_ = successors
+			self.set_successors(successors)
 		return True
 
 	def get_successors(self):
-		self.log("get_successors")
-		return map(lambda node: (node.address_.ip, node.address_.port), self.successors_[:N_SUCCESSORS-1])
+		self.log_sampled("get_successors")
+		return map(lambda node: node.address_.wire(), self.successors_[:N_SUCCESSORS-1])
 
 	def id(self, offset = 0):
 		return (self.address_.__hash__() + offset) % SIZE
 
 	def successor(self):
 		# We make sure to return an existing successor, there `might`
-		# be redundance between finger_[0] and successors_[0], but
+		# be redundance between successor_ and successors_[0], but
 		# it doesn't harm
-		for remote in [self.finger_[0]] + self.successors_:
+		candidates = [self.successor_] + self.successors_
+		for remote in candidates:
+			if self.is_alive(remote):
+				self.set_successor(remote)
+				return remote
+		# the failure detector might be too pessimistic, ask them
+		for remote in candidates:
 			if remote.ping():
-				self.finger_[0] = remote
+				self.set_successor(remote)
 				return remote
 		print "No successor available, aborting"
 		self.shutdown_ = True
-		sys.exit(-1)
+		# this can happen on a thread of the scheduler, we can't just exit
+		raise socket.error("no successor available")
 
 	def predecessor(self):
 		return self.predecessor_
 
-	#@retry_on_socket_error(FIND_SUCCESSOR_RET)
+	def set_predecessor(self, node):
+		old, self.predecessor_ = self.predecessor_, node
+		if not same_node(old, node):
+			self.publish('predecessor_changed', old, node)
+
+	def set_successor(self, node):
+		old, self.successor_ = self.successor_, node
+		if not same_node(old, node):
+			self.publish('successor_changed', old, node)
+
+	def set_successors(self, successors):
+		old, self.successors_ = self.successors_, successors
+		if map(lambda node: node.id(), old) != map(lambda node: node.id(), successors):
+			self.publish('successors_changed', old, successors)
+
+	def subscribe(self, event, callback):
+		# upper layers learn about membership changes from here, events
+		# are 'predecessor_changed' and 'successor_changed', callbacks
+		# get the old and the new node (any of them can be None),
+		# 'successors_changed' with the old and the new successor list,
+		# 'moved' with our old and new Address and 'stabilized' with the
+		# successor we just notified
+		self.listeners_.setdefault(event, []).append(callback)
+
+	def unsubscribe(self, event, callback):
+		self.listeners_[event].remove(callback)
+
+	def publish(self, event, *args):
+		for callback in self.listeners_.get(event, []):
+			callback(*args)
+
 	def find_successor(self, id):
+		start = time.time()
+		successor = self.lookup(id)[0]
+		metrics.histogram('find_successor_seconds').observe(time.time() - start)
+		return successor
+
+	def lookup(self, id, mode = LOOKUP_MODE, cached = True):
+		# returns (successor of id, hops it took)
+		owner, hops, range_start = self.resolve(id, mode, cached)
+		return owner, hops
+
+	def resolve(self, id, mode = LOOKUP_MODE, cached = True):
+		# returns (successor of id, hops it took, id where the range of
+		# the successor starts). Recursive lookups that fail or time out
+		# are done again iteratively.
 		# The successor of a key can be us iff
 		# - we have a pred(n)
 		# - id is in (pred(n), n]
-		self.log("find_successor")
+		self.log_sampled("find_successor")
+		id = id % SIZE
 		if self.predecessor() and \
 		   inrange(id, self.predecessor().id(1), self.id(1)):
-			return self
-		node = self.find_predecessor(id)
-		return node.successor()
+			return self, 0, self.predecessor().id()
+		if cached:
+			entry = self.lookup_cache_.get_range(id)
+			if entry != None:
+				return entry[1], 0, entry[0]
+		start = time.time()
+		result = None
+		if mode == 'recursive':
+			result = self.route(id, 0, LOOKUP_TIMEOUT)
+			if result == None:
+				self.record_lookup('recursive_failed', 0, time.time() - start)
+				mode = 'iterative'
+		if result == None:
+			node, hops = self.walk_to_predecessor(id)
+			result = (node.successor(), hops, node.id())
+		owner, hops, range_start = result
+		self.lookup_cache_.put(range_start, owner)
+		self.record_lookup(mode, hops, time.time() - start)
+		return result
+
+	def find_successors(self, ids, cached = True):
+		# successor of every id, in the same order. Ids are walked around
+		# the ring starting from us, once we know who owns an id we also
+		# know who owns all the ids up to it, so there is one lookup per
+		# owner instead of one per id.
+		distance = lambda id: (id - self.id()) % SIZE
+		owners = {}
+		end = None
+		for id in sorted(set(map(lambda id: id % SIZE, ids)), key = distance):
+			if end == None or not inrange(id, range_start + 1, end + 1):
+				owner, hops, range_start = self.resolve(id, cached = cached)
+				end = owner.id()
+			owners[id] = owner
+		return map(lambda id: owners[id % SIZE], ids)
+
+	def route(self, id, hops, timeout):
+		# one step of a recursive lookup: either we know the successor of
+		# id or we forward the lookup to the closest finger we have and
+		# the answer comes back the same way. Returns (successor, hops,
+		# id of its predecessor) or None if the lookup couldn't make it.
+		start = time.time()
+		if self.predecessor() and \
+		   inrange(id, self.predecessor().id(1), self.id(1)):
+			return self, hops, self.predecessor().id()
+		suc = self.successor()
+		if suc.id() == self.id() or inrange(id, self.id(1), suc.id(1)):
+			return suc, hops, self.id()
+		node = self.closest_preceding_finger(id)
+		if node.id() == self.id() or hops > 2 * LOGSIZE:
+			# no progress, let the caller fall back to iterative
+			return None
+		# next hops get a bit less time so they give up before we do
+		timeout = (timeout - (time.time() - start)) * 0.9
+		if timeout <= 0:
+			return None
+		try:
+			return node.route(id, hops + 1, timeout)
+		except socket.error:
+			return None
+
+	def record_lookup(self, mode, hops, elapsed):
+		self.lookup_mutex_.acquire()
+		stats = self.lookup_stats_.setdefault(mode, {'lookups':0, 'hops':0, 'time':0.0, 'max_hops':0})
+		stats['lookups'] += 1
+		stats['hops'] += hops
+		stats['time'] += elapsed
+		stats['max_hops'] = max(stats['max_hops'], hops)
+		self.lookup_mutex_.release()
+		metrics.histogram('lookup_hops', HOPS_BUCKETS, mode = mode).observe(hops)
+		metrics.histogram('lookup_seconds', mode = mode).observe(elapsed)
+
+	def get_lookup_stats(self):
+		# per mode: lookups done, total hops and seconds, most hops seen
+		self.lookup_mutex_.acquire()
+		stats = dict((mode, dict(self.lookup_stats_[mode])) for mode in self.lookup_stats_)
+		self.lookup_mutex_.release()
+		return stats
+
+	def get_stats(self, args):
+		# {"format": "text"} or just text gets the scrape format
+		if args == 'text' or (isinstance(args, dict) and args.get('format') == 'text'):
+			return metrics.text()
+		return metrics.snapshot()
 
-	#@retry_on_socket_error(FIND_PREDECESSOR_RET)
 	def find_predecessor(self, id):
-		self.log("find_predecessor")
+		return self.walk_to_predecessor(id)[0]
+
+	def walk_to_predecessor(self, id):
+		# iterative lookup, returns (pred(id), hops)
+		self.log_sampled("find_predecessor")
 		node = self
+		hops = 0
 		# If we are alone in the ring, we are the pred(id)
 		if node.successor().id() == node.id():
-			return node
+			return node, hops
 		while not inrange(id, node.id(1), node.successor().id(1)):
 			node = node.closest_preceding_finger(id)
-		return node
+			hops += 1
+		return node, hops
 
 	def closest_preceding_finger(self, id):
-		# first fingers in decreasing distance, then successors in
-		# increasing distance.
-		self.log("closest_preceding_finger")
-		for remote in reversed(self.successors_ + self.finger_):
-			if remote != None and inrange(remote.id(), self.id(1), id) and remote.ping():
-				return remote
-		return self
+		# the farthest node in (n, id) among our fingers and successors
+		self.log_sampled("closest_preceding_finger")
+		closest = self.fingers_.closest_preceding(id, self.is_alive)
+		for remote in reversed([self.successor_] + self.successors_):
+			if inrange(remote.id(), self.id(1), id) and self.is_alive(remote):
+				if closest == None or \
+				   self.fingers_.distance(remote.id()) > self.fingers_.distance(closest.id()):
+					closest = remote
+				break
+		if closest == None:
+			return self
+		return closest
 
 	def run(self):
-		# should have a threadpool here :/
 		# listen to incomming connections
 		self.socket_ = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		# a restarted node gets its port back even with connections of
+		# the previous one still in TIME_WAIT
+		self.socket_.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 		self.socket_.bind((self.address_.ip, int(self.address_.port)))
 		self.socket_.listen(10)
 
-		while 1:
-			self.log("run loop")
+		# requests are served by a pool of workers, this thread only waits
+		# for connections to become readable and hands them out
+		self.pool_ = ThreadPool(RUN_WORKERS, RUN_QUEUE_SIZE)
+		# workers give connections back through returned_ and wake us up
+		# by writing on the wakeup pipe
+		self.returned_ = []
+		self.returned_mutex_ = threading.Lock()
+		self.wakeup_r_, self.wakeup_w_ = socket.socketpair()
+
+		# connections stay open until the client closes them or they are
+		# idle for too long, so peers can send many requests on each one.
+		# idle connection -> time of its last request
+		self.connections_ = {}
+		# connections with a request waiting for a free worker
+		self.pending_ = []
+		# connections currently owned by a worker
+		self.busy_ = 0
+		port = str(self.address_.port)
+		metrics.gauge('connections_idle', lambda: len(self.connections_), port = port)
+		metrics.gauge('connections_busy', lambda: self.busy_, port = port)
+		metrics.gauge('connections_pending', lambda: len(self.pending_), port = port)
+		while not self.shutdown_:
+			self.take_returned()
+			# backpressure: while the pool is saturated we neither read
+			# from connections nor accept new ones, clients wait on TCP
+			while len(self.pending_) and self.pool_.submit(self.serve_request, self.pending_[0]):
+				self.pending_.pop(0)
+			watch = [self.wakeup_r_]
+			if not len(self.pending_):
+				watch += self.connections_.keys()
+				if len(self.connections_) + self.busy_ < MAX_CONNECTIONS:
+					watch.append(self.socket_)
+			# poll, select can't watch descriptors past 1024
+			poller = select.poll()
+			by_fd = {}
+			for conn in watch:
+				poller.register(conn, select.POLLIN | select.POLLPRI)
+				by_fd[conn.fileno()] = conn
 			try:
-				conn, addr = self.socket_.accept()
-			except socket.error:
-				self.shutdown_ = True
-				break
-
-			request = read_from_socket(conn)
-			command = request.split(' ')[0]
-
-			# we take the command out
-			request = request[len(command) + 1:]
-
-			# defaul : "" = not respond anything
-			result = json.dumps("")
-			if command == 'get_successor':
-				successor = self.successor()
-				result = json.dumps((successor.address_.ip, successor.address_.port))
-			if command == 'get_predecessor':
-				# we can only reply if we have a predecessor
-				if self.predecessor_ != None:
-					predecessor = self.predecessor_
-					result = json.dumps((predecessor.address_.ip, predecessor.address_.port))
-			if command == 'find_successor':
-				successor = self.find_successor(int(request))
-				result = json.dumps((successor.address_.ip, successor.address_.port))
-			if command == 'closest_preceding_finger':
-				closest = self.closest_preceding_finger(int(request))
-				result = json.dumps((closest.address_.ip, closest.address_.port))
-			if command == 'notify':
-				npredecessor = Address(request.split(' ')[0], int(request.split(' ')[1]))
-				self.notify(Remote(npredecessor))
-			if command == 'get_successors':
-				result = json.dumps(self.get_successors())
-
-			# or it could be a user specified operation
-			for t in self.command_:
-				if command == t[0]:
-					result = t[1](request)
-
-			send_to_socket(conn, result)
+				readable = [by_fd[fd] for fd, _ in poller.poll(1000)]
+			except (select.error, socket.error, ValueError), e:
+				# nothing wrong with the node, interrupted or out of
+				# resources for a moment, we try again
+				self.log("poll failed: %s" % (e,), WARNING)
+				time.sleep(0.1)
+				continue
+
+			for conn in readable:
+				if conn is self.wakeup_r_:
+					self.wakeup_r_.recv(4096)
+				elif conn is self.socket_:
+					try:
+						conn, addr = self.socket_.accept()
+					except socket.error:
+						self.shutdown_ = True
+						break
+					conn.settimeout(REQUEST_READ_TIMEOUT)
+					self.connections_[Connection(conn)] = time.time()
+					metrics.counter('connections_accepted_total').inc()
+				else:
+					# the connection belongs to a worker until it's returned
+					del self.connections_[conn]
+					self.busy_ += 1
+					self.pending_.append(conn)
+
+			# get rid of connections nobody is using
+			now = time.time()
+			for conn in self.connections_.keys():
+				if now - self.connections_[conn] > CONNECTION_IDLE_TIMEOUT:
+					self.close_connection(conn)
+
+		self.pool_.shutdown()
+		for conn in self.connections_.keys() + self.pending_:
 			conn.close()
+		self.connections_ = {}
+		self.socket_.close()
+		self.wakeup_r_.close()
+		self.wakeup_w_.close()
+		self.log("execution terminated", INFO)
 
-			if command == 'shutdown':
-				self.socket_.close()
-				self.shutdown_ = True
-				self.log("shutdown started")
-				break
-		self.log("execution terminated")
+	def close_connection(self, conn):
+		del self.connections_[conn]
+		conn.close()
+
+	def return_connection(self, conn, usable):
+		# called by workers once they are done with conn
+		if self.shutdown_:
+			conn.close()
+			return
+		self.returned_mutex_.acquire()
+		self.returned_.append((conn, usable))
+		self.returned_mutex_.release()
+		try:
+			self.wakeup_w_.send("x")
+		except socket.error:
+			pass
+
+	def take_returned(self):
+		self.returned_mutex_.acquire()
+		returned, self.returned_ = self.returned_, []
+		self.returned_mutex_.release()
+		for conn, usable in returned:
+			self.busy_ -= 1
+			if not usable or self.shutdown_:
+				conn.close()
+			elif conn.has_buffered():
+				# pipelined requests poll can't tell us about
+				self.busy_ += 1
+				self.pending_.append(conn)
+			else:
+				self.connections_[conn] = time.time()
+
+	def serve_request(self, conn):
+		# serves a single request and gives the connection back, unless it
+		# was closed by the client or is not usable anymore
+		self.log_sampled("run loop")
+		try:
+			message = conn.read_message()
+		except Exception:
+			# closed, timed out or something we can't make sense of
+			self.return_connection(conn, False)
+			return
+		# it was just the handshake
+		if message == None:
+			self.return_connection(conn, True)
+			return
+		rid, request = message
+
+		# tagged requests can be answered in any order, so the connection
+		# goes back right away and the next request on it is served while
+		# we work on this one
+		if rid != None:
+			self.return_connection(conn, True)
+
+		usable = True
+		command = None
+		node = self
+		start = time.time()
+		try:
+			try:
+				vnode = 0
+				if conn.framed_:
+					command, args = request[:2]
+					if len(request) > 2:
+						vnode = request[2]
+				else:
+					command = request.split(' ')[0]
+					# we take the command out
+					args = request[len(command) + 1:]
+				# requests for virtual nodes we don't have get nothing back
+				result = None
+				if vnode in self.vnodes_:
+					node = self.vnodes_[vnode]
+					result = node.dispatch(command, args)
+			except Exception, e:
+				# a peer we asked is gone, bad arguments... the caller is
+				# told instead of waiting for its timeout
+				if not isinstance(command, basestring):
+					command = None
+				self.log("%s failed: %s" % (command, e), INFO)
+				result = error_response(e)
+			conn.send_message(rid, result)
+		except Exception:
+			# closed, or the result couldn't be encoded
+			usable = False
+		finally:
+			command = node.command_label(command)
+			metrics.counter('requests_total', command = command).inc()
+			metrics.histogram('request_seconds', command = command).observe(time.time() - start)
+			# for tagged requests the loop finds out about errors on its own
+			if rid == None:
+				self.return_connection(conn, usable)
+
+	def dispatch(self, command, args):
+		# args come decoded from framed connections, and as the raw string
+		# from text mode ones. The result is encoded with the codec of the
+		# connection, None = nothing to answer
+		result = None
+		if command == 'get_successor':
+			successor = self.successor()
+			result = successor.address_.wire()
+		if command == 'get_predecessor':
+			# we can only reply if we have a predecessor
+			if self.predecessor_ != None:
+				predecessor = self.predecessor_
+				result = predecessor.address_.wire()
+		if command == 'find_successor':
+			successor = self.find_successor(int(args))
+			result = successor.address_.wire()
+		if command == 'closest_preceding_finger':
+			closest = self.closest_preceding_finger(int(args))
+			result = closest.address_.wire()
+		if command == 'notify':
+			if isinstance(args, basestring):
+				args = args.split(' ')
+			npredecessor = Address(*args)
+			self.notify(Remote(npredecessor))
+		if command == 'moved':
+			self.moved(Address(*args[0]), Address(*args[1]))
+		if command == 'get_successors':
+			result = self.get_successors()
+		if command == 'find_successors':
+			result = map(lambda node: node.address_.wire(), self.find_successors(map(int, args)))
+		if command == 'route':
+			routed = self.route(int(args[0]), int(args[1]), float(args[2]))
+			if routed != None:
+				node, hops, range_start = routed
+				result = (node.address_.wire(), hops, range_start)
+		if command == 'ping':
+			result = True
+		if command == 'lookup_stats':
+			result = self.get_lookup_stats()
+		if command == 'cache_stats':
+			result = self.lookup_cache_.stats()
+		if command == 'scheduler_stats':
+			result = scheduler.stats()
+
+		# or it could be a user specified operation, those take json
+		# arguments in text mode
+		for t in self.command_:
+			if command == t[0]:
+				if isinstance(args, basestring):
+					try:
+						args = json.loads(args)
+					except ValueError:
+						pass
+				result = t[1](args)
+
+		if command == 'shutdown':
+			self.shutdown_ = True
+			self.log("shutdown started", INFO)
+		return result
+
+	def command_label(self, command):
+		# what command is counted as in metrics, see BUILTIN_COMMANDS
+		if command in BUILTIN_COMMANDS or command in map(lambda t: t[0], self.command_):
+			return command
+		return 'unknown'
 
 	def register_command(self, cmd, callback):
 		self.command_.append((cmd, callback))
@@ -0,0 +1,177 @@
+import json
+import base64
+import binascii
+import struct
+
+# Codecs turn the values exchanged by peers (None, bools, ints, floats,
+# strings, lists and dicts) into bytes and back. Which one is used is
+# agreed when a connection is opened, see network.Connection.
+
+# human readable, what text mode connections speak. Byte strings that are
+# not valid utf-8 travel as {"__bytes__": <base64>}.
+class JsonCodec(object):
+	name = 'json'
+
+	def encode(self, obj):
+		return json.dumps(self.wrap(obj))
+
+	def decode(self, data):
+		try:
+			return json.loads(data, object_hook = self.unwrap)
+		except TypeError:
+			# __bytes__ that isn't base64
+			raise ValueError("malformed message")
+
+	def wrap(self, obj):
+		if isinstance(obj, str):
+			try:
+				obj.decode('utf-8')
+			except UnicodeDecodeError:
+				return {'__bytes__': base64.b64encode(obj)}
+			return obj
+		if isinstance(obj, (list, tuple)):
+			return map(self.wrap, obj)
+		if isinstance(obj, dict):
+			return dict((key, self.wrap(value)) for key, value in obj.iteritems())
+		return obj
+
+	def unwrap(self, obj):
+		if len(obj) == 1 and '__bytes__' in obj:
+			return base64.b64decode(obj['__bytes__'])
+		return obj
+
+# compact tagged encoding, byte strings go as they are
+class BinaryCodec(object):
+	name = 'binary'
+
+	LENGTH = struct.Struct("!I")
+	INT = struct.Struct("!q")
+	FLOAT = struct.Struct("!d")
+
+	def encode(self, obj):
+		chunks = []
+		self.write(obj, chunks)
+		return "".join(chunks)
+
+	def decode(self, data):
+		try:
+			obj, offset = self.read(data, 0)
+		except RuntimeError:
+			# nested too deep
+			raise ValueError("malformed message")
+		if offset != len(data):
+			raise ValueError("%s trailing bytes" % (len(data) - offset))
+		return obj
+
+	def write(self, obj, chunks):
+		if obj is None:
+			chunks.append('N')
+		elif obj is True:
+			chunks.append('T')
+		elif obj is False:
+			chunks.append('F')
+		elif isinstance(obj, (int, long)):
+			if -(1<<63) <= obj < (1<<63):
+				chunks.append('i')
+				chunks.append(self.INT.pack(obj))
+			elif obj >= 0:
+				# big numbers, identifiers for instance, as big endian bytes
+				digits = '%x' % obj
+				if len(digits) % 2:
+					digits = '0' + digits
+				digits = binascii.unhexlify(digits)
+				chunks.append('n')
+				chunks.append(self.LENGTH.pack(len(digits)))
+				chunks.append(digits)
+			else:
+				digits = str(obj)
+				chunks.append('I')
+				chunks.append(self.LENGTH.pack(len(digits)))
+				chunks.append(digits)
+		elif isinstance(obj, float):
+			chunks.append('f')
+			chunks.append(self.FLOAT.pack(obj))
+		elif isinstance(obj, str):
+			chunks.append('b')
+			chunks.append(self.LENGTH.pack(len(obj)))
+			chunks.append(obj)
+		elif isinstance(obj, unicode):
+			obj = obj.encode('utf-8')
+			chunks.append('u')
+			chunks.append(self.LENGTH.pack(len(obj)))
+			chunks.append(obj)
+		elif isinstance(obj, (list, tuple)):
+			chunks.append('l')
+			chunks.append(self.LENGTH.pack(len(obj)))
+			for item in obj:
+				self.write(item, chunks)
+		elif isinstance(obj, dict):
+			chunks.append('d')
+			chunks.append(self.LENGTH.pack(len(obj)))
+			for key, value in obj.iteritems():
+				self.write(key, chunks)
+				self.write(value, chunks)
+		else:
+			raise TypeError("can't encode %s" % type(obj))
+
+	def unpack(self, fmt, data, offset):
+		# the value of fmt at offset and the offset after it
+		if offset + fmt.size > len(data):
+			raise ValueError("truncated message")
+		return fmt.unpack_from(data, offset)[0], offset + fmt.size
+
+	def read(self, data, offset):
+		# malformed data raises ValueError, whatever is wrong with it
+		if offset >= len(data):
+			raise ValueError("truncated message")
+		tag = data[offset]
+		offset += 1
+		if tag == 'N':
+			return None, offset
+		if tag == 'T':
+			return True, offset
+		if tag == 'F':
+			return False, offset
+		if tag == 'i':
+			return self.unpack(self.INT, data, offset)
+		if tag == 'f':
+			return self.unpack(self.FLOAT, data, offset)
+		if tag in 'Inbu':
+			size, offset = self.unpack(self.LENGTH, data, offset)
+			value = data[offset:offset + size]
+			if len(value) != size:
+				raise ValueError("truncated message")
+			offset += size
+			if tag == 'I':
+				return int(value), offset
+			if tag == 'n':
+				return int(binascii.hexlify(value), 16), offset
+			if tag == 'u':
+				return value.decode('utf-8'), offset
+			return value, offset
+		if tag == 'l':
+			count, offset = self.unpack(self.LENGTH, data, offset)
+			result = []
+			for i in xrange(count):
+				item, offset = self.read(data, offset)
+				result.append(item)
+			return result, offset
+		if tag == 'd':
+			count, offset = self.unpack(self.LENGTH, data, offset)
+			result = {}
+			for i in xrange(count):
+				key, offset = self.read(data, offset)
+				if isinstance(key, (list, dict)):
+					raise ValueError("unhashable key")
+				result[key], offset = self.read(data, offset)
+			return result, offset
+		raise ValueError("unknown tag %r" % tag)
+
+CODECS = {
+	JsonCodec.name: JsonCodec(),
+	BinaryCodec.name: BinaryCodec(),
+}
+
+def get_codec(name):
+	# unknown codecs fall back to json, every peer speaks it
+	return CODECS.get(name, CODECS[JsonCodec.name])
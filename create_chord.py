@@ -38,11 +38,14 @@ while 1:
 	if command == "add_node":
 		while 1:
 			address = Address("127.0.0.1", random.randrange(10000, 60000))
-			if not address.__hash__() in hash_list:
+			# ids don't collide anymore, ports still could
+			if not address.port in ports_list:
 				ports_list.append(address.port)
 				print "New node at port %s" % address.port
 				address_list.append(address)
-				locals_list.append(Local(address, locals_list[random.randrange(len(locals_list))].address))
+				local = Local(address, locals_list[random.randrange(len(locals_list))].address_)
+				local.start()
+				locals_list.append(local)
 				break
 	else:
 		address = address_list[random.randrange(len(address_list))]
@@ -1,115 +1,1059 @@
-from chord import Local, Daemon, repeat_and_sleep, inrange
-from remote import Remote
-from address import Address
-import json
+from chord import Local, inrange
+from remote import Remote, wait_for
+from address import Address, key_id
+from store import open_store
+from load import LoadMeter, value_size
+from scheduler import scheduler
+from metrics import metrics
+from settings import HANDOFF_BATCH, HANDOFF_GRACE, HANDOFF_SWEEP_INT, HANDOFF_RETRY_INT, \
+	REPLICATION_FACTOR, N_SUCCESSORS, READ_QUORUM, WRITE_QUORUM, VNODES, \
+	LOAD_METRIC, LOAD_IMBALANCE, LOAD_MIN, LOAD_EXCHANGE_INT, LOAD_HALF_LIFE, STORE_COMPACT_INT
+import socket
+import threading
+import time
+import Queue
 
-# data structure that represents a distributed hash table
+# Values are kept as records (stamp, value), the stamp being a Lamport
+# timestamp (counter, id of the node that wrote it). When two copies of a
+# key disagree the one with the biggest stamp wins.
+def to_record(obj):
+	# records travel as lists
+	if obj == None:
+		return None
+	return (tuple(obj[0]), obj[1])
+
+def newest(records):
+	newest = None
+	for record in records:
+		if record != None and (newest == None or record[0] > newest[0]):
+			newest = record
+	return newest
+
+# data structure that represents a distributed hash table. It can take
+# vnodes positions on the ring, the virtual nodes share the socket of the
+# first one and the storage: a key is ours if any of them owns it.
 class DHT(object):
-	def __init__(self, local_address, remote_address = None):
+	def __init__(self, local_address, remote_address = None, vnodes = VNODES):
 		self.local_ = Local(local_address, remote_address)
+		self.vnodes_ = []
+
+		# our keys, indexed by their position on the ring, and copies of
+		# the keys of our predecessors. With a store on disk they are
+		# still there after a restart (see STORE_BACKEND)
+		name = "%s_%s" % (local_address.ip, local_address.port)
+		self.data_ = open_store(name)
+		self.replicas_ = open_store(name + "_replicas")
+		# copies of every key, ours included, and how many of them have to
+		# answer reads and writes
+		self.replication_ = min(REPLICATION_FACTOR, N_SUCCESSORS)
+		self.read_quorum_ = min(READ_QUORUM, self.replication_)
+		self.write_quorum_ = min(WRITE_QUORUM, self.replication_)
+		# Lamport clock, guards the stores as well
+		self.clock_ = 0
+		self.mutex_ = threading.RLock()
+		self.shutdown_ = False
+		# membership changes and keys set here that belong somewhere else
+		# wake up distribute_data through here (see queue_handoff)
+		self.handoff_ = Queue.Queue()
+		# {(vnode, endpoint): (local, node)} of replicas that still need
+		# a copy of our keys
+		self.repair_ = {}
+		# vnode -> endpoints of its replicas the last time we looked
+		self.replica_endpoints_ = {}
+		# the nodes around us changed, some of our copies might belong to
+		# keys we are not a replica of any more (see prune)
+		self.prune_ = False
+		# vnode -> until when keys we own but don't have might still be on
+		# their way from the previous owner
+		self.receiving_until_ = {}
+		# requests and bytes of every key we own, and vnode -> when the
+		# load of its range is sent to its successor again
+		self.meter_ = LoadMeter()
+		self.next_exchange_ = {}
+		port = str(local_address.port)
+		self.owner_requests_ = metrics.counter('dht_owner_requests_total', port = port)
+		self.add_vnode(self.local_)
+		metrics.gauge('dht_keys', lambda: len(self.data_), port = port)
+		metrics.gauge('dht_replica_keys', lambda: len(self.replicas_), port = port)
+
+		self.distribute_ = scheduler.add('distribute_data', self.distribute_data, HANDOFF_SWEEP_INT)
+		self.compact_ = scheduler.add('compact', self.compact, STORE_COMPACT_INT)
+
+		self.local_.start()
+		for vnode in range(1, vnodes):
+			address = Address(local_address.ip, local_address.port, vnode)
+			local = Local(address, remote_address, self.local_)
+			self.add_vnode(local)
+			local.start()
+
+	def add_vnode(self, local):
 		def set_wrap(msg):
 			return self._set(msg)
 		def get_wrap(msg):
 			return self._get(msg)
+		def mset_wrap(msg):
+			return self._mset(msg)
+		def mget_wrap(msg):
+			return self._mget(msg)
+		def mget_replica_wrap(msg):
+			return self._mget_replica(msg)
+		def put_wrap(msg):
+			return self._put(msg)
+		def load_wrap(msg):
+			return self._load(local, msg)
+		def predecessor_changed(old, new):
+			self.predecessor_changed(local, old, new)
+		def successors_changed(old, new):
+			self.successors_changed(local, old, new)
+		def moved(old, new):
+			self.moved(local, old, new)
+		def stabilized(successor):
+			self.exchange_load(local, successor)
 
-		self.data_ = {}
-		self.shutdown_ = False
-
-		self.local_.register_command("set", set_wrap)
-		self.local_.register_command("get", get_wrap)
-
-		self.daemons_ = {}
-		self.daemons_['distribute_data'] = Daemon(self, 'distribute_data')
-		self.daemons_['distribute_data'].start()
+		self.receiving_until_[local.address_.vnode] = time.time() + HANDOFF_GRACE
+		local.subscribe('predecessor_changed', predecessor_changed)
+		local.subscribe('successors_changed', successors_changed)
+		local.subscribe('moved', moved)
+		local.subscribe('stabilized', stabilized)
 
-		self.local_.start()
+		local.register_command("set", set_wrap)
+		local.register_command("get", get_wrap)
+		local.register_command("mset", mset_wrap)
+		local.register_command("mget", mget_wrap)
+		local.register_command("mget_replica", mget_replica_wrap)
+		local.register_command("put", put_wrap)
+		local.register_command("load", load_wrap)
+		self.vnodes_.append(local)
 
 	def shutdown(self):
+		# takes the virtual nodes down as well
 		self.local_.shutdown()
 		self.shutdown_ = True
+		self.distribute_.cancel()
+		self.compact_.cancel()
+		self.data_.close()
+		self.replicas_.close()
+
+	def is_local(self, node):
+		# is node one of our virtual nodes?
+		return node.address_.endpoint() == self.local_.address_.endpoint()
 
 	def _get(self, request):
+		# request  = {'key':<#KEY#>[, 'replica':True[, 'owner':True] | 'forwarded':True]}
+		# response = {'status':'failed'} | {'status':'redirect'} |
+		#			 {'status':'missing'} | {'status':'ok', 'data':<#VALUE#>}
+		# replicas and forwarded reads answer with the record instead,
+		# {'status':'ok', 'record':<#RECORD#>}
 		try:
-			data = json.loads(request)
-			# we have the key
-			return json.dumps({'status':'ok', 'data':self.get(data['key'])})
+			key = request['key']
+			if request.get('replica'):
+				if request.get('owner'):
+					self.hit(key)
+				record = self.record(key)
+				if record != None:
+					return {'status':'ok', 'record':record}
+				if request.get('owner') and not self.is_ours(key):
+					# whoever asked has an outdated idea of the ring
+					return {'status':'redirect'}
+				if request.get('owner') and self.in_transit(key):
+					return {'status':'ok', 'record':self.get_in_transit(key)}
+				return {'status':'missing'}
+			if request.get('forwarded'):
+				# the new owner asking for a key that's in transit, if we
+				# don't have it nobody does
+				return {'status':'ok', 'record':self.record(key)}
+			start = time.time()
+			data = self.get(key)
+			metrics.histogram('dht_get_seconds').observe(time.time() - start)
+			return {'status':'ok', 'data':data}
 		except Exception:
 			# key not present
-			return json.dumps({'status':'failed'})
+			return {'status':'failed'}
 
 	def _set(self, request):
 		try:
-			data = json.loads(request)
-			key = data['key']
-			value = data['value']
-			self.set(key, value)
-			return json.dumps({'status':'ok'})
+			key = request['key']
+			value = request['value']
+			start = time.time()
+			stored = self.set(key, value)
+			metrics.histogram('dht_set_seconds').observe(time.time() - start)
+			if not stored:
+				raise Exception
+			return {'status':'ok'}
 		except Exception:
 			# something is not working
-			return json.dumps({'status':'failed'})
+			return {'status':'failed'}
+
+	def _mget(self, request):
+		# request  = {'keys':[<#KEY#>, ...]}
+		# response = {'status':'failed'} |
+		#			 {'status':'ok', 'results':{<#KEY#>:<#KEY STATUS#>, ...}}
+		# key status is {'status':'ok', 'data':<#VALUE#>} | {'status':'missing'} |
+		#			 {'status':'failed'}, see mget
+		try:
+			return {'status':'ok', 'results':self.mget(request['keys'])}
+		except Exception:
+			return {'status':'failed'}
+
+	def _mset(self, request):
+		# request  = {'items':{<#KEY#>:<#VALUE#>, ...}}
+		# response = {'status':'failed'} |
+		#			 {'status':'ok', 'results':{<#KEY#>:'ok' | 'failed', ...}}
+		try:
+			return {'status':'ok', 'results':self.mset(request['items'])}
+		except Exception:
+			return {'status':'failed'}
+
+	def _mget_replica(self, request):
+		# what mget asks every replica of an owner, the bulk version of a
+		# get with 'replica'
+		# request  = {'keys':[<#KEY#>, ...][, 'owner':True]}
+		# response = {'status':'failed'} |
+		#			 {'status':'ok', 'records':{<#KEY#>:<#RECORD#> | None, ...},
+		#			  'redirect':[<#KEY#>, ...]}
+		# redirect has the keys the owner we were taken for doesn't own
+		try:
+			owner = request.get('owner')
+			records = {}
+			redirect = []
+			for key in request['keys']:
+				if owner:
+					self.hit(key)
+				record = self.record(key)
+				if record == None and owner:
+					if not self.is_ours(key):
+						redirect.append(key)
+					elif self.in_transit(key):
+						record = self.get_in_transit(key)
+				records[key] = record
+			return {'status':'ok', 'records':records, 'redirect':redirect}
+		except Exception:
+			return {'status':'failed'}
 
-	def get(self, key):
+	def _put(self, request):
+		# request  = {'items':{<#KEY#>:<#RECORD#>, ...}[, 'primary':True | 'handoff':True]}
+		# response = {'status':'failed'} |
+		#			 {'status':'ok', 'newer':{<#KEY#>:<#STAMP#>, ...}}
+		# records are kept if they are newer than ours, newer has the stamps
+		# of the ones that weren't. Keys handed off by their previous owner
+		# also go to our replicas.
 		try:
-			return self.data_[key]
+			items = dict((key, to_record(record)) for key, record in request['items'].iteritems())
+			primary = request.get('primary') or request.get('handoff')
+			newer = {}
+			for key, record in items.iteritems():
+				if request.get('primary'):
+					self.hit(key)
+				kept = self.keep(key, record, primary)
+				if kept[0] > record[0]:
+					newer[key] = kept[0]
+			if request.get('handoff'):
+				self.replicate(items)
+			return {'status':'ok', 'newer':newer}
 		except Exception:
-			# not in our range
-			suc = self.local_.find_successor(hash(key))
-			if self.local_.id() == suc.id():
-				# it's us but we don't have it
-				return None
+			return {'status':'failed'}
+
+	def hit(self, key):
+		# a request for key served as its owner
+		self.meter_.hit(key)
+		self.owner_requests_.inc()
+
+	def stamp(self):
+		self.mutex_.acquire()
+		self.clock_ += 1
+		stamp = (self.clock_, self.local_.id())
+		self.mutex_.release()
+		return stamp
+
+	def record(self, key):
+		# our newest copy of key
+		return newest([self.data_.get(key), self.replicas_.get(key)])
+
+	def stored(self, key):
+		# our record of key, None if we don't have it or can't read it
+		try:
+			return self.data_.get(key)
+		except IOError, e:
+			print "can't read %s: %s" % (key, e)
+			return None
+
+	def observe(self, stamp):
+		self.mutex_.acquire()
+		self.clock_ = max(self.clock_, stamp[0])
+		self.mutex_.release()
+
+	def keep(self, key, record, primary = False):
+		# stores record unless we have a newer one, our keys go to data_
+		# and the rest to replicas_. Returns the record we end up with.
+		# The size of the value the meter needs is worked out before
+		# taking the lock
+		given = record
+		size = value_size(record[1]) if primary else None
+		self.mutex_.acquire()
+		try:
+			ours = self.data_.get(key)
+			replica = self.replicas_.get(key)
+			current = newest([ours, replica])
+			if current != None and current[0] >= record[0]:
+				record = current
+			self.observe(record[0])
+			# copies we already have are not written again
+			if primary or ours != None:
+				if ours == None or ours[0] != record[0]:
+					self.data_[key] = record
+					if record is not given or size == None:
+						size = value_size(record[1])
+					self.meter_.stored(key, size)
+			elif replica == None or replica[0] != record[0]:
+				self.replicas_[key] = record
+			return record
+		finally:
+			self.mutex_.release()
+
+	def group_by_owner(self, keys):
+		# returns [(owner, keys it owns)], we come first if we own any
+		owners = self.local_.find_successors(map(key_id, keys))
+		groups = {}
+		for key, node in zip(keys, owners):
+			groups.setdefault(node.id(), (node, []))[1].append(key)
+		return sorted(groups.values(), key = lambda group: not self.is_local(group[0]))
+
+	def mget(self, keys):
+		# returns {key: key status} (see _mget). Keys are grouped by owner
+		# and every group is read the way get reads a key: all the replicas
+		# of the owner are asked at the same time, one request each, a key
+		# is answered once read_quorum_ of them did and the ones that are
+		# behind get the newest record. The groups are in flight together.
+		results = {}
+		try:
+			groups = self.group_by_owner(keys)
+		except socket.error:
+			groups = []
+			for key in keys:
+				results[key] = {'status':'failed'}
+		reads = []
+		for owner, owner_keys in groups:
+			nodes = self.replicas_of(owner)
+			# key -> [(node, record it has)]
+			answers = dict((key, []) for key in owner_keys)
+			calls = []
+			for node in nodes:
+				if self.is_local(node):
+					for key in owner_keys:
+						if node is owner:
+							self.hit(key)
+						record = self.record(key)
+						if record == None and node is owner and self.in_transit(key):
+							record = self.get_in_transit(key)
+						answers[key].append((node, record))
+					continue
+				try:
+					calls.append((node, node.call_async('mget_replica', {'keys':owner_keys, 'owner':node is owner})))
+				except socket.error:
+					pass
+			reads.append((owner, owner_keys, answers, calls))
+		def answered(response):
+			return response and response['status'] == 'ok'
+		redirected = []
+		for owner, owner_keys, answers, calls in reads:
+			local = len(answers[owner_keys[0]])
+			arrived = wait_for(map(lambda call: call[1], calls), self.read_quorum_ - local, accept = answered)
+			for node, call in calls:
+				if not call in arrived:
+					continue
+				response = call.result(0)
+				for key in owner_keys:
+					if node is owner and key in response['redirect']:
+						continue
+					answers[key].append((node, to_record(response['records'].get(key))))
+				if node is owner and len(response['redirect']):
+					# the owner we had cached moved on, get finds the new one
+					self.local_.lookup_cache_.invalidate_owner(node.address_)
+					redirected += response['redirect']
+			repairs = {}
+			for key in owner_keys:
+				if key in redirected:
+					continue
+				if not len(answers[key]):
+					results[key] = {'status':'failed'}
+					continue
+				record = newest(map(lambda answer: answer[1], answers[key]))
+				if record == None:
+					results[key] = {'status':'missing'}
+					continue
+				self.observe(record[0])
+				results[key] = {'status':'ok', 'data':record[1]}
+				# read repair, one put per node that is behind
+				for node, answer in answers[key]:
+					if answer == None or answer[0] < record[0]:
+						repairs.setdefault(node.address_.wire(), (node, {}))[1][key] = record
+			self.read_repair(owner, repairs.values())
+		for key in redirected:
+			value = self.get(key, cached = False)
+			results[key] = {'status':'missing'} if value == None else {'status':'ok', 'data':value}
+		return results
+
+	def read_repair(self, owner, repairs):
+		# repairs = [(node, {key: newest record})], sends the records to
+		# the replicas that answered a read with older ones
+		for node, records in repairs:
+			metrics.counter('dht_read_repairs_total').inc(len(records))
+			if self.is_local(node):
+				for key, record in records.iteritems():
+					self.keep(key, record, node is owner)
+				continue
+			try:
+				node.call_async('put', {'items':records, 'primary':node is owner})
+			except socket.error:
+				pass
+
+	def mset(self, mapping):
+		# returns {key: 'ok' | 'failed'}. Keys are grouped by owner and every
+		# group is written the way set writes a key: the records go to all
+		# the replicas of the owner at the same time, one request each, and
+		# a key is stored once write_quorum_ of them kept it. Keys somebody
+		# had a newer version of are set again one by one.
+		results = {}
+		try:
+			groups = self.group_by_owner(mapping.keys())
+		except socket.error:
+			# like set, we keep them until they can go to their owners
+			for key, value in mapping.iteritems():
+				self.keep(key, (self.stamp(), value), True)
+				results[key] = 'failed'
+			self.queue_handoff('handoff')
+			return results
+		writes = []
+		for owner, owner_keys in groups:
+			nodes = self.replicas_of(owner)
+			items = dict((key, (self.stamp(), mapping[key])) for key in owner_keys)
+			acks = dict((key, 0) for key in owner_keys)
+			newer = set()
+			calls = []
+			for node in nodes:
+				if self.is_local(node):
+					for key, record in items.iteritems():
+						if node is owner:
+							self.hit(key)
+						if self.keep(key, record, node is owner) is record:
+							acks[key] += 1
+						else:
+							newer.add(key)
+					continue
+				try:
+					calls.append(node.call_async('put', {'items':items, 'primary':node is owner}))
+				except socket.error:
+					pass
+			writes.append((nodes, items, acks, newer, calls))
+		def stored(response):
+			return response and response['status'] == 'ok'
+		retry = []
+		for nodes, items, acks, newer, calls in writes:
+			wait_for(calls, self.write_quorum_ - min(acks.values()), accept = stored)
+			for call in calls:
+				if not call.done() or call.error_ != None or not stored(call.result(0)):
+					continue
+				response = call.result(0)
+				for key in items:
+					if key in response['newer']:
+						self.observe(response['newer'][key])
+						newer.add(key)
+					else:
+						acks[key] += 1
+			for key, record in items.iteritems():
+				if acks[key] >= self.write_quorum_:
+					results[key] = 'ok'
+				elif key in newer:
+					retry.append(key)
+				else:
+					metrics.counter('dht_write_quorum_failures_total').inc()
+					results[key] = 'failed'
+					if not len(filter(self.is_local, nodes)):
+						# not enough replicas answered, we keep it until they do
+						self.keep(key, record, True)
+						self.queue_handoff('handoff')
+		for key in retry:
+			results[key] = 'ok' if self.set(key, mapping[key]) else 'failed'
+		return results
+
+	def owner(self, key):
+		# which of our virtual nodes owns key, None if none of them
+		id = key_id(key)
+		for local in self.vnodes_:
+			predecessor = local.predecessor()
+			if predecessor == None or \
+			   inrange(id, predecessor.id(1), local.id(1)):
+				return local
+		return None
+
+	def is_ours(self, key):
+		return self.owner(key) != None
+
+	def replica_set(self, key, cached = True):
+		# the owner of key followed by the nodes keeping copies of it, each
+		# of them in a different process
+		return self.replicas_of(self.local_.lookup(key_id(key), cached = cached)[0])
+
+	def replicas_of(self, owner):
+		# owner followed by the nodes keeping copies of its keys. Finding
+		# them takes a call to a remote owner, so they are kept with its
+		# lookup cache entry. Short sets are not, the walk might have
+		# stopped at a node that didn't answer
+		if self.is_local(owner):
+			return [owner] + self.replica_nodes(owner)
+		cache = self.local_.lookup_cache_
+		nodes = cache.get_replicas(owner)
+		if nodes == None:
+			nodes = self.replica_nodes(owner)
+			if len(nodes) == self.replication_ - 1:
+				cache.put_replicas(owner, nodes)
+		return [owner] + nodes
+
+	def get(self, key, cached = True):
+		# asks all the replicas at the same time and returns as soon as
+		# read_quorum_ of them answered, the ones that are behind get the
+		# newest record
+		try:
+			nodes = self.replica_set(key, cached)
+		except socket.error:
+			record = self.record(key)
+			return record[1] if record != None else None
+		answers = []
+		calls = []
+		for node in nodes:
+			if self.is_local(node):
+				if node is nodes[0]:
+					self.hit(key)
+				record = self.record(key)
+				if record == None and node is nodes[0] and self.in_transit(key):
+					record = self.get_in_transit(key)
+				answers.append((node, record))
+				continue
+			request = {'key':key, 'replica':True, 'owner':node is nodes[0]}
 			try:
-				response = suc.command('get %s' % json.dumps({'key':key}))
-				if not response:
-					raise Exception
-				value = json.loads(response)
-				if value['status'] != 'ok':
-					raise Exception
-				return value['data']
-			except Exception:
-				return None
+				calls.append((node, node.call_async('get', request)))
+			except socket.error:
+				pass
+		def answered(response):
+			return response and response['status'] in ('ok', 'missing')
+		arrived = wait_for(map(lambda call: call[1], calls), \
+		                   self.read_quorum_ - len(answers), accept = answered)
+		for node, call in calls:
+			if call in arrived:
+				response = call.result(0)
+				answers.append((node, to_record(response.get('record'))))
+			elif cached and node is nodes[0] and call.done() and \
+			     call.error_ == None and call.result(0)['status'] == 'redirect':
+				# the owner we had cached moved on, ask the ring
+				self.local_.lookup_cache_.invalidate_owner(node.address_)
+				return self.get(key, cached = False)
+		record = newest(map(lambda answer: answer[1], answers))
+		if record == None:
+			return None
+		self.observe(record[0])
+		repairs = []
+		for node, answer in answers:
+			if answer == None or answer[0] < record[0]:
+				repairs.append((node, {key:record}))
+		self.read_repair(nodes[0], repairs)
+		return record[1]
+
 	def set(self, key, value):
-		# eventually it will distribute the keys
-		self.data_[key] = value
+		# sends the value to all the replicas at the same time, returns True
+		# as soon as write_quorum_ of them have it
+		try:
+			nodes = self.replica_set(key)
+		except socket.error:
+			nodes = []
+		# if somebody has a newer version than the stamp we picked, our
+		# clock is behind theirs. One more try with a stamp after theirs
+		for attempt in range(2):
+			record = (self.stamp(), value)
+			acks = 0
+			calls = []
+			newer = False
+			for node in nodes:
+				if self.is_local(node):
+					if node is nodes[0]:
+						self.hit(key)
+					if self.keep(key, record, node is nodes[0]) is record:
+						acks += 1
+					else:
+						# like the copy a restarted node read back
+						newer = True
+					continue
+				request = {'items':{key:record}, 'primary':node is nodes[0]}
+				try:
+					calls.append(node.call_async('put', request))
+				except socket.error:
+					pass
+			def stored(response):
+				return response and response['status'] == 'ok' and \
+				       not key in response['newer']
+			arrived = wait_for(calls, self.write_quorum_ - acks, accept = stored)
+			acks += len(arrived)
+			if acks >= self.write_quorum_:
+				return True
+			for call in calls:
+				if call.done() and call.error_ == None:
+					response = call.result(0)
+					if response and key in response.get('newer', {}):
+						self.observe(response['newer'][key])
+						newer = True
+			if not newer:
+				break
+		metrics.counter('dht_write_quorum_failures_total').inc()
+		if not len(filter(self.is_local, nodes)):
+			# not enough replicas answered, we keep it until they do
+			self.keep(key, record, True)
+			self.queue_handoff('handoff')
+		return False
 
-	@repeat_and_sleep(5)
-	def distribute_data(self):
-		to_remove = []
-		# to prevent from RTE in case data gets updated by other thread
-		keys = self.data_.keys()
-		for key in keys:
-			if self.local_.predecessor() and \
-			   not inrange(hash(key), self.local_.predecessor().id(1), self.local_.id(1)):
+	def replica_nodes(self, owner, successors = None):
+		# the nodes keeping copies of the keys of owner: the first
+		# replication_ - 1 processes after it on the ring, other than the
+		# one of owner. We go through its successors (successors if we
+		# have them already) and then the successors of the last one,
+		# until there are enough or we are back where we started.
+		nodes = []
+		endpoints = [owner.address_.endpoint()]
+		seen = set([owner.id()])
+		if successors == None:
+			successors = self.successors_of(owner)
+		while len(successors):
+			for node in successors:
+				if node.id() in seen:
+					# all the way around the ring
+					return nodes
+				seen.add(node.id())
+				if not node.address_.endpoint() in endpoints:
+					endpoints.append(node.address_.endpoint())
+					nodes.append(node)
+					if len(nodes) == self.replication_ - 1:
+						return nodes
+			successors = self.successors_of(successors[-1])
+		return nodes
+
+	def successors_of(self, node):
+		# the successor list of node, [] if it doesn't answer
+		if self.is_local(node):
+			local = self.local_.vnodes_.get(node.address_.vnode)
+			return local.successors_ if local != None else []
+		try:
+			return node.get_successors()
+		except socket.error:
+			return []
+
+	def replicate(self, records):
+		# the copies are sent to the replicas of the virtual node owning
+		# them without waiting, if they get lost reads and the next repair
+		# take care of it
+		groups = {}
+		for key, record in records.iteritems():
+			local = self.owner(key) or self.local_
+			groups.setdefault(local.address_.vnode, (local, {}))[1][key] = record
+		for local, group in groups.values():
+			for node in self.replica_nodes(local, local.successors_):
 				try:
-					node = self.local_.find_successor(hash(key))
-					node.command("set %s" % json.dumps({'key':key, 'value':self.data_[key]}))
-					# print "moved %s into %s" % (key, node.id())
-					to_remove.append(key)
-					print "migrated"
+					node.call_async('put', {'items':group})
 				except socket.error:
-					print "error migrating"
-					# we'll migrate it next time
 					pass
-		# remove all the keys we do not own any more
-		for key in to_remove:
-			del self.data_[key]
-		# Keep calling us
+
+	def in_transit(self, key):
+		# right after our range grew its keys might still be on their way
+		local = self.owner(key)
+		return local != None and time.time() < self.receiving_until_[local.address_.vnode]
+
+	def get_in_transit(self, key):
+		# the previous owner of the range is the successor of the virtual
+		# node owning it, returns its record or None
+		local = self.owner(key) or self.local_
+		suc = local.successor()
+		if self.is_local(suc):
+			return None
+		try:
+			value = suc.call('get', {'key':key, 'forwarded':True})
+			if value and value['status'] == 'ok':
+				return to_record(value['record'])
+		except socket.error:
+			pass
+		return None
+
+	def predecessor_changed(self, local, old, new):
+		self.local_.lookup_cache_.invalidate_replicas()
+		if new == None:
+			return
+		if old == None or not inrange(new.id(), old.id(1), local.id()):
+			# the range grew, reads might need to be forwarded for a while
+			self.receiving_until_[local.address_.vnode] = time.time() + HANDOFF_GRACE
+			# and if the predecessor died we have copies of its keys
+			self.queue_handoff('promote')
+		# somebody might have taken part of the range, hand it over now
+		self.queue_handoff('handoff')
+		self.queue_handoff('prune')
+
+	def successors_changed(self, local, old, new):
+		# the replicas of local might have changed, distribute_data finds
+		# out which ones (it can take a few round trips), and so might the
+		# ones of the owners before it
+		self.local_.lookup_cache_.invalidate_replicas()
+		self.queue_handoff(('replicas', local))
+		self.queue_handoff('prune')
+
+	def moved(self, local, old, new):
+		predecessor = local.predecessor()
+		if predecessor != None and not inrange(new.__hash__(), predecessor.id(1), old.__hash__()):
+			# we went forward, the keys we took are on their way from the
+			# successor
+			self.receiving_until_[local.address_.vnode] = time.time() + HANDOFF_GRACE
+		# and if we went back the ones we left go to it
+		self.next_exchange_[local.address_.vnode] = time.time() + LOAD_HALF_LIFE
+		self.local_.lookup_cache_.invalidate_replicas()
+		metrics.counter('dht_moves_total').inc()
+		self.queue_handoff('handoff')
+
+	def range_load(self, local):
+		# load of the keys local owns, see LoadMeter.summary
+		predecessor = local.predecessor()
+		if predecessor == None:
+			return self.meter_.summary(self.data_.keys())
+		return self.meter_.summary(self.data_.keys_in_range(predecessor.id(), local.id()))
+
+	def split(self, local, amount, top):
+		# position that cuts about amount of load off the range of local,
+		# from its top (the ids we would give to the successor) or from its
+		# bottom (the ids the predecessor would take). Keys with the same
+		# id go together and local keeps at least one id. Returns None if
+		# the range can't be cut.
+		predecessor = local.predecessor()
+		if predecessor == None:
+			return None
+		# [id, load] in ring order
+		groups = []
+		for id, key in self.data_.entries_in_range(predecessor.id(), local.id()):
+			if not len(groups) or groups[-1][0] != id:
+				groups.append([id, 0])
+			groups[-1][1] += self.meter_.load(key, LOAD_METRIC)
+		if top:
+			groups.reverse()
+		cut = 0
+		for i in range(len(groups) - 1):
+			cut += groups[i][1]
+			if cut >= amount:
+				# we keep up to the next id, or the predecessor takes up
+				# to this one
+				return groups[i + 1][0] if top else groups[i][0]
+		return None
+
+	def exchange_load(self, local, successor):
+		# called after every stabilize of local, every LOAD_EXCHANGE_INT
+		# the load of its range goes to the successor, which answers with
+		# its own. Whoever is hotter gives part of its range to the other
+		# one, the move is up to local in both cases.
+		vnode = local.address_.vnode
+		if time.time() < self.next_exchange_.get(vnode, 0) or self.is_local(successor):
+			return
+		self.next_exchange_[vnode] = time.time() + LOAD_EXCHANGE_INT
+		self.meter_.prune()
+		load = self.range_load(local)
+		try:
+			call = successor.call_async('load', {'load':load})
+		except socket.error:
+			return
+		call.add_done_callback(lambda call: self.load_exchanged(local, load, call))
+
+	def load_exchanged(self, local, load, call):
+		# runs on the thread reading answers, the rest is up to
+		# distribute_data (see balance)
+		if call.error_ == None:
+			self.queue_handoff(('load', local, load, call.result(0)))
+
+	def balance(self, local, load, response):
+		# load is the one of local we sent to its successor, response what
+		# it answered
+		if not response or response['status'] != 'ok':
+			return
+		ours = load[LOAD_METRIC]
+		theirs = response['load'][LOAD_METRIC]
+		if ours - theirs > LOAD_MIN and ours > LOAD_IMBALANCE * theirs:
+			# we go back and the successor takes our top ids
+			id = self.split(local, (ours - theirs) / 2.0, True)
+		else:
+			# we go forward and take its bottom ids, if it's the hot one
+			id = response.get('split')
+		if id != None:
+			print "moving %s -> %s, load %s vs %s" % (local.id(), id, ours, theirs)
+			local.move(id)
+
+	def _load(self, local, request):
+		# request  = {'load':<#LOAD OF THE PREDECESSOR#>}
+		# response = {'status':'failed'} |
+		#			 {'status':'ok', 'load':<#LOAD#>, 'split':<#ID#> | None}
+		# load is LoadMeter.summary of the range, split is where the
+		# predecessor should move to take part of it if we are too hot
+		try:
+			load = self.range_load(local)
+			ours = load[LOAD_METRIC]
+			theirs = request['load'][LOAD_METRIC]
+			split = None
+			if ours - theirs > LOAD_MIN and ours > LOAD_IMBALANCE * theirs:
+				split = self.split(local, (ours - theirs) / 2.0, False)
+			return {'status':'ok', 'load':load, 'split':split}
+		except Exception:
+			return {'status':'failed'}
+
+	def queue_handoff(self, event):
+		# 'handoff', 'promote', 'prune', ('replicas', local) or ('load',
+		# local, load, response), distribute_data runs right away
+		self.handoff_.put(event)
+		self.distribute_.wake()
+
+	def distribute_data(self):
+		# moves the keys we don't own to their owners and copies ours to
+		# new replicas as soon as we get a key we don't own or the nodes
+		# around us change, and every HANDOFF_SWEEP_INT just in case. Run
+		# by the scheduler, returns when to run again.
+		if self.shutdown_:
+			return False
+		# one pass covers every change queued so far
+		events = []
+		while not self.handoff_.empty():
+			events.append(self.handoff_.get_nowait())
+		if 'promote' in events:
+			self.promote()
+		if 'prune' in events:
+			self.prune_ = True
+		for event in events:
+			if isinstance(event, tuple) and event[0] == 'load':
+				self.balance(*event[1:])
+			elif isinstance(event, tuple):
+				self.replicas_changed(event[1])
+		done = self.hand_off()
+		# the ones that failed are tried again
+		self.repair_ = self.repair(self.repair_)
+		if self.prune_:
+			self.prune_ = not self.prune()
+		if not done or len(self.repair_) or self.prune_:
+			return HANDOFF_RETRY_INT
+		return True
+
+	def replicas_changed(self, local):
+		# nodes that just became replicas of local need a copy of its keys
+		vnode = local.address_.vnode
+		nodes = self.replica_nodes(local, local.successors_)
+		known = self.replica_endpoints_.get(vnode, [])
+		for node in nodes:
+			if not node.address_.endpoint() in known:
+				self.repair_[(vnode, node.address_.endpoint())] = (local, node)
+		self.replica_endpoints_[vnode] = map(lambda node: node.address_.endpoint(), nodes)
+
+	def compact(self):
+		# reclaims the space of old versions in stores on disk
+		if self.shutdown_:
+			return False
+		self.data_.compact()
+		self.replicas_.compact()
+		return True
+
+	def promote(self):
+		# the keys of the predecessors we lost are ours now, we have been
+		# keeping copies of them
+		records = {}
+		self.mutex_.acquire()
+		try:
+			for local in self.vnodes_:
+				predecessor = local.predecessor()
+				if predecessor == None:
+					continue
+				for key in self.replicas_.keys_in_range(predecessor.id(), local.id()):
+					record = self.replicas_[key]
+					del self.replicas_[key]
+					records[key] = self.keep(key, record, True)
+		finally:
+			self.mutex_.release()
+		self.replicate(records)
+		if len(records):
+			metrics.counter('dht_keys_promoted_total').inc(len(records))
+			print "promoted %s keys" % len(records)
+
+	def repair(self, pending):
+		# pending = {(vnode, endpoint): (local, node)}, copies the keys of
+		# local to node. Returns the ones that failed.
+		calls = []
+		replicas = {}
+		for local, node in pending.values():
+			vnode = local.address_.vnode
+			if not vnode in replicas:
+				replicas[vnode] = map(lambda node: node.address_.endpoint(), \
+				                      self.replica_nodes(local, local.successors_))
+			if not node.address_.endpoint() in replicas[vnode]:
+				continue
+			predecessor = local.predecessor()
+			if predecessor == None:
+				keys = self.data_.keys()
+			else:
+				keys = self.data_.keys_in_range(predecessor.id(), local.id())
+			for i in range(0, len(keys), HANDOFF_BATCH):
+				records = {}
+				for key in keys[i:i + HANDOFF_BATCH]:
+					record = self.stored(key)
+					if record != None:
+						records[key] = record
+				try:
+					calls.append((local, node, records, node.call_async('put', {'items':records})))
+				except socket.error:
+					calls.append((local, node, records, None))
+		failed = {}
+		for local, node, records, call in calls:
+			try:
+				if call == None:
+					raise socket.error
+				response = call.result()
+				if not response or response['status'] != 'ok':
+					raise socket.error
+				metrics.counter('dht_keys_repaired_total').inc(len(records))
+			except socket.error:
+				failed[(local.address_.vnode, node.address_.endpoint())] = (local, node)
+		return failed
+
+	def prune(self):
+		# drops the copies of the keys whose replica set we are not in any
+		# more, so replicas_ doesn't keep growing as nodes come and go and
+		# promote doesn't bring back old versions. Owners whose replica
+		# set we can't tell, because they don't answer or the ring is too
+		# small, keep theirs. Returns False if we should try again.
+		entries = self.replicas_.entries_in_range(0, 0)
+		if not len(entries):
+			return True
+		try:
+			owners = self.local_.find_successors(map(lambda entry: entry[0], entries), cached = False)
+		except socket.error:
+			return False
+		groups = {}
+		for entry, owner in zip(entries, owners):
+			groups.setdefault(owner.id(), (owner, []))[1].append(entry[1])
+		endpoint = self.local_.address_.endpoint()
+		dropped = 0
+		for owner, keys in groups.values():
+			if self.is_local(owner):
+				# they are ours now, promote takes care of them
+				continue
+			nodes = self.replica_nodes(owner)
+			if len(nodes) < self.replication_ - 1 or \
+			   endpoint in map(lambda node: node.address_.endpoint(), nodes):
+				continue
+			self.mutex_.acquire()
+			try:
+				for key in keys:
+					if key in self.replicas_:
+						del self.replicas_[key]
+						dropped += 1
+			finally:
+				self.mutex_.release()
+		if dropped:
+			metrics.counter('dht_replicas_dropped_total').inc(dropped)
+			print "dropped %s replicas" % dropped
 		return True
 
-def create_dht(lport):
+	def foreign_keys(self):
+		# (id, key) of the keys in the gaps between the ranges of our
+		# virtual nodes, (v, p] for every v and the predecessor p of the
+		# next one of ours
+		vnodes = sorted(self.vnodes_, key = lambda local: local.id())
+		entries = []
+		for i in range(len(vnodes)):
+			previous = vnodes[i - 1]
+			predecessor = vnodes[i].predecessor()
+			if predecessor == None or self.is_local(predecessor) or \
+			   not inrange(predecessor.id(), previous.id(1), vnodes[i].id()):
+				continue
+			entries += self.data_.entries_in_range(previous.id(), predecessor.id())
+		return entries
+
+	def hand_off(self):
+		# returns False if some keys couldn't be moved and we should try
+		# again in a moment
+		entries = self.foreign_keys()
+		if not len(entries):
+			return True
+		keys = map(lambda entry: entry[1], entries)
+		# all the owners at once, one lookup per owner and not per key. The
+		# ring just changed around us, so the cache is not to be trusted
+		try:
+			owners = self.local_.find_successors(map(lambda entry: entry[0], entries), cached = False)
+		except socket.error:
+			return False
+		# batches of keys streamed to their owners, all of them in flight
+		# on the same connection
+		done = True
+		batches = []
+		for key, node in zip(keys, owners):
+			if self.is_local(node):
+				# the ring hasn't settled yet
+				done = False
+				continue
+			record = self.stored(key)
+			if record == None:
+				continue
+			if not len(batches) or batches[-1][0].id() != node.id() or \
+			   len(batches[-1][1]) >= HANDOFF_BATCH:
+				batches.append((node, {}))
+			batches[-1][1][key] = record
+		calls = []
+		for node, records in batches:
+			try:
+				calls.append((records, node.call_async('put', {'items':records, 'handoff':True})))
+			except socket.error:
+				done = False
+		moved = 0
+		for records, call in calls:
+			try:
+				response = call.result()
+				if not response or response['status'] != 'ok':
+					raise socket.error
+			except socket.error:
+				done = False
+				continue
+			# remove the keys we do not own any more, unless they were
+			# written while we were sending them. keep() holds the same
+			# lock, so nothing gets in between the check and the delete.
+			# We might still be one of their replicas, they stay as
+			# copies until prune finds out
+			self.mutex_.acquire()
+			try:
+				for key, record in records.iteritems():
+					current = self.data_.get(key)
+					if current != None and current[0] == record[0]:
+						replica = self.replicas_.get(key)
+						if replica == None or replica[0] < current[0]:
+							self.replicas_[key] = current
+						del self.data_[key]
+						self.meter_.removed(key)
+						moved += 1
+			finally:
+				self.mutex_.release()
+		if moved:
+			self.prune_ = True
+			metrics.counter('dht_keys_migrated_total').inc(moved)
+			print "migrated %s keys" % moved
+		return done
+
+def create_dht(lport, vnodes = VNODES):
 	laddress = map(lambda port: Address('127.0.0.1', port), lport)
-	r = [DHT(laddress[0])]
+	r = [DHT(laddress[0], vnodes = vnodes)]
 	for address in laddress[1:]:
-		r.append(DHT(address, laddress[0]))
+		r.append(DHT(address, laddress[0], vnodes))
 	return r
 
 
 if __name__ == "__main__":
+	# python dht.py <port> [<remote port> | -] [<vnodes>], - starts a ring
 	import sys
-	if len(sys.argv) == 2:
-		dht = DHT(Address("127.0.0.1", sys.argv[1]))
-	else:
-		dht = DHT(Address("127.0.0.1", sys.argv[1]), Address("127.0.0.1", sys.argv[2]))
+	remote = None
+	if len(sys.argv) > 2 and sys.argv[2] != '-':
+		remote = Address("127.0.0.1", sys.argv[2])
+	vnodes = int(sys.argv[3]) if len(sys.argv) > 3 else VNODES
+	dht = DHT(Address("127.0.0.1", sys.argv[1]), remote, vnodes)
 	raw_input("Press any key to shutdown")
 	print "shuting down.."
 	dht.shutdown()
-
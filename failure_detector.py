@@ -0,0 +1,58 @@
+import threading
+import time
+
+from remote import call_observers
+from settings import HEARTBEAT_INT, SUSPECT_TIMEOUT
+
+# Keeps a liveness table of the peers we talk to so that routing doesn't
+# need to ping anybody. It learns from the outcome of every call made
+# through Remote (see remote.call_observers) and from the heartbeats
+# Local sends to the peers it hasn't heard from lately.
+#
+# A peer is alive until a call to it fails, then it's suspected until a
+# call succeeds again. Peers suspected for longer than SUSPECT_TIMEOUT
+# are dead and should be dropped from routing tables.
+class FailureDetector(object):
+	def __init__(self, suspect_timeout = SUSPECT_TIMEOUT):
+		self.suspect_timeout_ = suspect_timeout
+		self.mutex_ = threading.Lock()
+		# (ip, port) -> [time of last success, suspected since or None],
+		# the virtual nodes of a process live and die together
+		self.peers_ = {}
+
+	def report(self, address, ok):
+		key = address.endpoint()
+		now = time.time()
+		self.mutex_.acquire()
+		try:
+			peer = self.peers_.setdefault(key, [0, None])
+			if ok:
+				peer[0] = now
+				peer[1] = None
+			elif peer[1] == None:
+				peer[1] = now
+		finally:
+			self.mutex_.release()
+
+	def is_alive(self, address):
+		# peers we never talked to get the benefit of the doubt
+		peer = self.peers_.get(address.endpoint())
+		return peer == None or peer[1] == None
+
+	def is_dead(self, address):
+		peer = self.peers_.get(address.endpoint())
+		return peer != None and peer[1] != None and \
+		       time.time() - peer[1] > self.suspect_timeout_
+
+	def needs_heartbeat(self, address, interval = HEARTBEAT_INT):
+		# suspected peers are probed until they come back or die
+		peer = self.peers_.get(address.endpoint())
+		return peer == None or peer[1] != None or time.time() - peer[0] > interval
+
+	def forget(self, address):
+		self.mutex_.acquire()
+		self.peers_.pop(address.endpoint(), None)
+		self.mutex_.release()
+
+detector = FailureDetector()
+call_observers.append(detector.report)
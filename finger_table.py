@@ -0,0 +1,122 @@
+import bisect
+import threading
+
+from settings import SIZE, LOGSIZE
+
+# Fingers of a node n: finger i is the successor of n + 2^i. With big ids
+# most fingers of a ring that isn't huge are the same few nodes, so only
+# the distinct ones are kept, sorted by their distance from n. Finger i is
+# then the first one at distance 2^i or more, and the closest finger
+# preceding an id is found with a binary search.
+class FingerTable(object):
+	def __init__(self, id):
+		self.mutex_ = threading.Lock()
+		self.rebase(id)
+
+	def rebase(self, id):
+		# our id changed, the fingers we had are not right anymore
+		self.mutex_.acquire()
+		self.id_ = id
+		# where every finger interval starts
+		self.starts_ = map(lambda i: (id + (1<<i)) % SIZE, range(LOGSIZE))
+		# sorted distances from us, and the node at each of them
+		self.distances_ = []
+		self.nodes_ = []
+		self.mutex_.release()
+
+	def start(self, i):
+		return self.starts_[i]
+
+	def interval(self, i):
+		# [start, end) of the ids finger i can be in, any node there
+		# routes as well as its first one
+		if i + 1 < LOGSIZE:
+			return self.starts_[i], self.starts_[i + 1]
+		return self.starts_[i], self.id_
+
+	def distance(self, id):
+		return (id - self.id_) % SIZE
+
+	def get(self, i):
+		# finger i, None if we don't know any node past its start
+		self.mutex_.acquire()
+		try:
+			j = bisect.bisect_left(self.distances_, 1<<i)
+			if j == len(self.nodes_):
+				return None
+			return self.nodes_[j]
+		finally:
+			self.mutex_.release()
+
+	def update(self, i, node):
+		# node is the successor of start(i), so there are no nodes between
+		# start(i) and node. Returns whether the table changed.
+		distance = self.distance(node.id())
+		if distance == 0:
+			return False
+		self.mutex_.acquire()
+		try:
+			start = bisect.bisect_left(self.distances_, 1<<i)
+			end = bisect.bisect_left(self.distances_, distance)
+			changed = start != end
+			if end == len(self.distances_) or self.distances_[end] != distance:
+				self.distances_.insert(end, distance)
+				self.nodes_.insert(end, node)
+				changed = True
+			else:
+				self.nodes_[end] = node
+			del self.distances_[start:end]
+			del self.nodes_[start:end]
+			return changed
+		finally:
+			self.mutex_.release()
+
+	def interval_of(self, node):
+		# the finger whose interval node is in, -1 if node is us
+		return self.distance(node.id()).bit_length() - 1
+
+	def nodes(self):
+		return list(self.nodes_)
+
+	def remove(self, match):
+		# drops the fingers match(node) is True for
+		self.mutex_.acquire()
+		try:
+			for j in reversed(range(len(self.nodes_))):
+				if match(self.nodes_[j]):
+					del self.distances_[j]
+					del self.nodes_[j]
+		finally:
+			self.mutex_.release()
+
+	def replace(self, match, node):
+		# node takes the place of the fingers match(node) is True for, at
+		# its own distance
+		self.remove(match)
+		distance = self.distance(node.id())
+		if distance == 0:
+			return
+		self.mutex_.acquire()
+		try:
+			j = bisect.bisect_left(self.distances_, distance)
+			if j < len(self.distances_) and self.distances_[j] == distance:
+				self.nodes_[j] = node
+			else:
+				self.distances_.insert(j, distance)
+				self.nodes_.insert(j, node)
+		finally:
+			self.mutex_.release()
+
+	def closest_preceding(self, id, alive):
+		# the farthest finger in (n, id) alive(node) is happy with, or None
+		self.mutex_.acquire()
+		try:
+			# id = n means anywhere around the ring
+			j = bisect.bisect_left(self.distances_, self.distance(id) or SIZE)
+			nodes = self.nodes_[:j]
+		finally:
+			self.mutex_.release()
+		for node in reversed(nodes):
+			if alive(node):
+				return node
+		return None
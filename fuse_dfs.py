@@ -24,8 +24,8 @@
 #
 # - In the case of directories, 'data' contains a dictionary with the keyword \
 # 'files' that returns a list of files in the FS.
-# - In the case of files, 'data' contains a 'base64_data' field with bytes encoded
-# in base64.
+# - In the case of files, 'data' contains a 'bytes' field with the raw bytes of
+# the block, the codec of the connection takes care of sending them.
 #
 #
 
@@ -39,7 +39,7 @@ from subprocess import *
 
 import chord
 import json 
-import base64
+from logger import get_logger, DEBUG, INFO
 
 fuse.fuse_python_api = (0, 2)
 
@@ -63,19 +63,19 @@ class MyStat(fuse.Stat):
         self.st_ctime = 0
 
 
+logger = get_logger("/tmp/dfs.log")
+
 # logging function
 def log(info):
-    f = open("/tmp/dfs.log", "a+")
-    f.write(info + "\n")
-    f.close()
+    logger.log(INFO, "%s", info)
 
-# decorator to log every system call on our fs (strace equiv)
+# decorator to log every system call on our fs (strace equiv), sampled
+# since it's called for every block read or written
 def logtofile(func):
     def inner(self, *args, **kwargs):
-        f = open("/tmp/dfs.log", "a+")
-        f.write("Function %s called with parameters %s %s\n" % (func.__name__,
-                args, kwargs))
-        f.close()
+        if logger.enabled(DEBUG):
+            logger.sampled(DEBUG, "Function %s called with parameters %s %s",
+                           func.__name__, args, kwargs)
         return func(self, *args, **kwargs)
     return inner
 
@@ -140,7 +140,7 @@ class FUSEDFS(fuse.Fuse):
             # at block 'left'
             key = "%s:%s" %(path[1:], left)
             block = get(key)
-            size = left * BLOCK_SIZE + len(base64.b64decode(block['data']['b64_data']))
+            size = left * BLOCK_SIZE + len(block['data']['bytes'])
 
             st.st_size = size
         return st
@@ -171,7 +171,7 @@ class FUSEDFS(fuse.Fuse):
         # we only set the initial block
         key = "%s:0" % key
         obj = {'type': 'file',
-               'data': { 'b64_data': base64.b64encode("") }
+               'data': { 'bytes': "" }
               }
         put(key, obj)
 
@@ -208,7 +208,7 @@ class FUSEDFS(fuse.Fuse):
             return 0
 
         # we read
-        data = base64.b64decode(obj['data']['b64_data'])[start:end]
+        data = obj['data']['bytes'][start:end]
 
         return data
 
@@ -234,18 +234,18 @@ class FUSEDFS(fuse.Fuse):
         # if it doesn't exist, just return create it
         if obj == None:
             obj = {'type':'file',
-                   'data':{'b64_data': None}
+                   'data':{'bytes': None}
             }
 
             # fill up with 0x00's before
             data = ("\00" * start) + buf[:end-start]
-            obj['data']['b64_data'] = base64.b64encode(data)
+            obj['data']['bytes'] = data
 
         else:
-            data = base64.b64decode(obj['data']['b64_data'])
+            data = obj['data']['bytes']
             # this is the new data
             data = data[:start] + buf[:end-start] + data[end:]
-            obj['data']['b64_data'] = base64.b64encode(data)
+            obj['data']['bytes'] = data
 
 
         # save into the DHT
@@ -283,8 +283,8 @@ class FUSEDFS(fuse.Fuse):
             return 0
 
         # if it does exist, truncate it
-        data = base64.b64decode(obj['data']['b64_data'])
-        obj['data']['b64_data'] = base64.b64encode(data[:end])
+        data = obj['data']['bytes']
+        obj['data']['bytes'] = data[:end]
 
 
         put(key, obj)
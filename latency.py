@@ -0,0 +1,39 @@
+import threading
+
+from remote import rtt_observers
+from settings import RTT_ALPHA
+
+# Smoothed round trip time to every peer we talk to, learnt from the calls
+# made through Remote (see remote.rtt_observers). Like TCP's SRTT, every
+# new sample moves the estimate RTT_ALPHA of the way towards it. The
+# virtual nodes of a process share their estimate.
+class LatencyEstimator(object):
+	def __init__(self, alpha = RTT_ALPHA):
+		self.alpha_ = alpha
+		self.mutex_ = threading.Lock()
+		# (ip, port) -> seconds
+		self.rtt_ = {}
+
+	def observe(self, address, rtt):
+		key = address.endpoint()
+		self.mutex_.acquire()
+		try:
+			estimate = self.rtt_.get(key)
+			if estimate == None:
+				self.rtt_[key] = rtt
+			else:
+				self.rtt_[key] = estimate + self.alpha_ * (rtt - estimate)
+		finally:
+			self.mutex_.release()
+
+	def rtt(self, address):
+		# seconds, None if we never heard from address
+		return self.rtt_.get(address.endpoint())
+
+	def forget(self, address):
+		self.mutex_.acquire()
+		self.rtt_.pop(address.endpoint(), None)
+		self.mutex_.release()
+
+latency = LatencyEstimator()
+rtt_observers.append(latency.observe)
@@ -0,0 +1,80 @@
+import math
+import threading
+import time
+
+from codec import get_codec
+from settings import LOAD_HALF_LIFE
+
+codec = get_codec('binary')
+
+def value_size(value):
+	# bytes value takes, encoded the way peers send it
+	return len(codec.encode(value))
+
+# Keeps track of what every key costs us: how often it's asked for and how
+# many bytes it takes. Requests are counted with an exponential decay, a
+# request LOAD_HALF_LIFE seconds old counts half as much as a new one, so
+# the rate follows the workload as it changes.
+class LoadMeter(object):
+	def __init__(self, half_life = LOAD_HALF_LIFE):
+		self.half_life_ = float(half_life)
+		self.mutex_ = threading.Lock()
+		# key -> [decayed count of requests, when it was last decayed]
+		self.requests_ = {}
+		# key -> bytes it takes
+		self.bytes_ = {}
+
+	def decayed(self, entry, now):
+		return entry[0] * 0.5 ** ((now - entry[1]) / self.half_life_)
+
+	def hit(self, key, count = 1):
+		now = time.time()
+		self.mutex_.acquire()
+		try:
+			entry = self.requests_.get(key)
+			if entry == None:
+				self.requests_[key] = [count, now]
+			else:
+				entry[0] = self.decayed(entry, now) + count
+				entry[1] = now
+		finally:
+			self.mutex_.release()
+
+	def stored(self, key, size):
+		# size is what value_size says of its value
+		self.bytes_[key] = size
+
+	def removed(self, key):
+		# the key is somebody else's problem now
+		self.mutex_.acquire()
+		self.requests_.pop(key, None)
+		self.bytes_.pop(key, None)
+		self.mutex_.release()
+
+	def load(self, key, metric):
+		# 'requests' (per second) or 'bytes' of key
+		if metric == 'bytes':
+			return self.bytes_.get(key, 0)
+		entry = self.requests_.get(key)
+		if entry == None:
+			return 0.0
+		# a steady rate r keeps the decayed count at r * half_life / ln 2
+		return self.decayed(entry, time.time()) * math.log(2) / self.half_life_
+
+	def summary(self, keys):
+		# load of a range of keys, what neighbours exchange
+		return {'requests':sum(map(lambda key: self.load(key, 'requests'), keys)),
+		        'bytes':sum(map(lambda key: self.load(key, 'bytes'), keys)),
+		        'keys':len(keys)}
+
+	def prune(self, threshold = 0.01):
+		# forgets the keys nobody asks for anymore and we don't keep
+		now = time.time()
+		self.mutex_.acquire()
+		try:
+			for key in self.requests_.keys():
+				if not key in self.bytes_ and \
+				   self.decayed(self.requests_[key], now) < threshold:
+					del self.requests_[key]
+		finally:
+			self.mutex_.release()
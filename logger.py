@@ -0,0 +1,126 @@
+import sys
+import threading
+import time
+import Queue
+
+from settings import LOG_LEVEL, LOG_QUEUE_SIZE, LOG_BATCH, LOG_SAMPLE
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+NAMES = {DEBUG:'DEBUG', INFO:'INFO', WARNING:'WARNING', ERROR:'ERROR'}
+LEVELS = dict((name.lower(), level) for level, name in NAMES.items())
+
+# Log file written by a background thread. Callers only check the level
+# and, if it's enabled, put the record in a bounded queue: formatting and
+# writing happen on the writer, which takes records in batches and writes
+# each batch at once. When the queue is full records are dropped rather
+# than making the caller wait.
+class Logger(object):
+	def __init__(self, path, level = LOG_LEVEL, queue_size = LOG_QUEUE_SIZE, \
+	             batch = LOG_BATCH, sample = LOG_SAMPLE):
+		self.path_ = path
+		if isinstance(level, basestring):
+			level = LEVELS[level.lower()]
+		self.level_ = level
+		self.queue_ = Queue.Queue(queue_size)
+		self.batch_ = batch
+		self.sample_ = sample
+		# calls to sampled, and records lost because the queue was full
+		self.count_ = 0
+		self.dropped_ = 0
+		self.mutex_ = threading.Lock()
+		self.writer_ = None
+
+	def enabled(self, level):
+		return level >= self.level_
+
+	def log(self, level, message, *args):
+		# message % args is done by the writer
+		if level < self.level_:
+			return
+		self.push((time.time(), level, message, args))
+
+	def sampled(self, level, message, *args):
+		# for the lines written on every request, only one in sample_ of
+		# them makes it to the file
+		if level < self.level_:
+			return
+		self.count_ += 1
+		if self.count_ % self.sample_:
+			return
+		self.push((time.time(), level, message, args))
+
+	def debug(self, message, *args):
+		self.log(DEBUG, message, *args)
+
+	def info(self, message, *args):
+		self.log(INFO, message, *args)
+
+	def warning(self, message, *args):
+		self.log(WARNING, message, *args)
+
+	def error(self, message, *args):
+		self.log(ERROR, message, *args)
+
+	def push(self, record):
+		if self.writer_ == None:
+			self.start()
+		try:
+			self.queue_.put_nowait(record)
+		except Queue.Full:
+			self.dropped_ += 1
+
+	def start(self):
+		self.mutex_.acquire()
+		try:
+			if self.writer_ == None:
+				self.writer_ = threading.Thread(target = self.write)
+				self.writer_.daemon = True
+				self.writer_.start()
+		finally:
+			self.mutex_.release()
+
+	def write(self):
+		f = None
+		while 1:
+			records = [self.queue_.get()]
+			try:
+				while len(records) < self.batch_:
+					records.append(self.queue_.get_nowait())
+			except Queue.Empty:
+				pass
+			lines = []
+			for when, level, message, args in records:
+				if len(args):
+					try:
+						message = message % args
+					except (TypeError, ValueError):
+						message = "%s %s" % (message, args)
+				lines.append("%s %s %s\n" % (time.strftime("%H:%M:%S", time.localtime(when)), \
+				                             NAMES.get(level, level), message))
+			if self.dropped_:
+				dropped, self.dropped_ = self.dropped_, 0
+				lines.append("%s records dropped, the log can't keep up\n" % dropped)
+			try:
+				if f == None:
+					f = open(self.path_, "a")
+				f.write("".join(lines))
+				f.flush()
+			except IOError, e:
+				print >> sys.stderr, "can't write %s: %s" % (self.path_, e)
+				f = None
+
+# one Logger per file, shared by everybody writing to it
+loggers = {}
+loggers_mutex = threading.Lock()
+
+def get_logger(path):
+	loggers_mutex.acquire()
+	try:
+		if not path in loggers:
+			loggers[path] = Logger(path)
+		return loggers[path]
+	finally:
+		loggers_mutex.release()
@@ -0,0 +1,157 @@
+import bisect
+import threading
+import time
+from collections import OrderedDict
+
+from address import inrange
+from settings import LOOKUP_CACHE_SIZE, LOOKUP_CACHE_TTL
+
+# Remembers which node owns which range of identifiers: once we learn that
+# node n owns (pred(n), n], any id in that range is resolved without a
+# lookup. Entries expire after ttl seconds, the least recently used ones
+# go first when the cache is full, and they are dropped as soon as we
+# find out the ring changed around them. Entries can also keep the nodes
+# with copies of the keys of their owner (see put_replicas), those are
+# forgotten when one of them fails or a node shows up among them.
+class LookupCache(object):
+	def __init__(self, size = LOOKUP_CACHE_SIZE, ttl = LOOKUP_CACHE_TTL):
+		self.size_ = size
+		self.ttl_ = ttl
+		self.mutex_ = threading.Lock()
+		# owner id -> (start of range, owner, expiration, replicas or None),
+		# in LRU order
+		self.entries_ = OrderedDict()
+		# sorted owner ids, to find the range an id falls in
+		self.ends_ = []
+		self.hits_ = 0
+		self.misses_ = 0
+
+	def get(self, id):
+		# returns the owner of id or None
+		entry = self.get_range(id)
+		if entry == None:
+			return None
+		return entry[1]
+
+	def get_range(self, id):
+		# returns (start, owner) of the range id falls in, or None
+		self.mutex_.acquire()
+		try:
+			entry = None
+			if len(self.ends_):
+				# the first range ending at or after id, wrapping around
+				i = bisect.bisect_left(self.ends_, id) % len(self.ends_)
+				end = self.ends_[i]
+				start, owner, expires, replicas = self.entries_[end]
+				if expires < time.time():
+					self.remove(end)
+				elif inrange(id, start + 1, end + 1):
+					entry = self.entries_.pop(end)
+					self.entries_[end] = entry
+			if entry == None:
+				self.misses_ += 1
+				return None
+			self.hits_ += 1
+			return entry[0], entry[1]
+		finally:
+			self.mutex_.release()
+
+	def put(self, start, owner):
+		# owner owns (start, owner.id()]
+		end = owner.id()
+		self.mutex_.acquire()
+		try:
+			if end in self.entries_:
+				self.remove(end)
+			elif len(self.entries_) >= self.size_:
+				self.remove(iter(self.entries_).next())
+			self.entries_[end] = (start, owner, time.time() + self.ttl_, None)
+			bisect.insort(self.ends_, end)
+		finally:
+			self.mutex_.release()
+
+	def get_replicas(self, owner):
+		# the replicas we know of owner, None if we don't
+		self.mutex_.acquire()
+		try:
+			entry = self.entries_.get(owner.id())
+			if entry == None or entry[2] < time.time() or \
+			   entry[1].address_.endpoint() != owner.address_.endpoint():
+				return None
+			return entry[3]
+		finally:
+			self.mutex_.release()
+
+	def put_replicas(self, owner, replicas):
+		# replicas keep copies of the keys of owner, kept as long as the
+		# entry of owner is
+		self.mutex_.acquire()
+		try:
+			entry = self.entries_.get(owner.id())
+			if entry != None and entry[1].address_.endpoint() == owner.address_.endpoint():
+				self.entries_[owner.id()] = entry[:3] + (replicas,)
+		finally:
+			self.mutex_.release()
+
+	def forget_replicas(self, end):
+		# mutex_ must be held
+		self.entries_[end] = self.entries_[end][:3] + (None,)
+
+	def remove(self, end):
+		# mutex_ must be held
+		del self.entries_[end]
+		del self.ends_[bisect.bisect_left(self.ends_, end)]
+
+	def invalidate_id(self, id):
+		# a node showed up at id, the range containing it is not right
+		# anymore
+		self.mutex_.acquire()
+		try:
+			for end in self.entries_.keys():
+				start, owner, expires, replicas = self.entries_[end]
+				if inrange(id, start + 1, end + 1):
+					self.remove(end)
+				elif replicas != None and (not len(replicas) or inrange(id, end + 1, replicas[-1].id() + 1)):
+					# or among the replicas of the owner
+					self.forget_replicas(end)
+		finally:
+			self.mutex_.release()
+
+	def invalidate_owner(self, address):
+		# every virtual node of the process goes, they fail together, and
+		# so do the replica sets they are in
+		self.mutex_.acquire()
+		try:
+			for end in self.entries_.keys():
+				start, owner, expires, replicas = self.entries_[end]
+				if owner.address_.endpoint() == address.endpoint():
+					self.remove(end)
+				elif replicas != None and address.endpoint() in \
+				     map(lambda node: node.address_.endpoint(), replicas):
+					self.forget_replicas(end)
+		finally:
+			self.mutex_.release()
+
+	def invalidate_replicas(self):
+		# the nodes around us changed, we can't tell which replica sets
+		# did
+		self.mutex_.acquire()
+		try:
+			for end in self.entries_.keys():
+				self.forget_replicas(end)
+		finally:
+			self.mutex_.release()
+
+	def report(self, address, ok):
+		# call observer, owners that fail to answer are forgotten
+		if not ok:
+			self.invalidate_owner(address)
+
+	def clear(self):
+		self.mutex_.acquire()
+		self.entries_ = OrderedDict()
+		self.ends_ = []
+		self.mutex_.release()
+
+	def stats(self):
+		return {'hits':self.hits_, 'misses':self.misses_, 'size':len(self.entries_)}
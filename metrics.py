@@ -0,0 +1,145 @@
+import bisect
+import threading
+
+# seconds, for the latency histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# lookup hops
+HOPS_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16, 24, 32)
+
+class Counter(object):
+	kind = 'counter'
+
+	def __init__(self):
+		self.mutex_ = threading.Lock()
+		self.value_ = 0
+
+	def inc(self, amount = 1):
+		self.mutex_.acquire()
+		self.value_ += amount
+		self.mutex_.release()
+
+	def snapshot(self):
+		return self.value_
+
+# a value that goes up and down, either set or read from func when the
+# metrics are collected
+class Gauge(object):
+	kind = 'gauge'
+
+	def __init__(self, func = None):
+		self.func_ = func
+		self.value_ = 0
+
+	def set(self, value):
+		self.value_ = value
+
+	def snapshot(self):
+		if self.func_ != None:
+			return self.func_()
+		return self.value_
+
+# how many observations fell in every bucket, each bucket counts the ones
+# up to its bound that didn't fit in the previous one
+class Histogram(object):
+	kind = 'histogram'
+
+	def __init__(self, buckets = LATENCY_BUCKETS):
+		self.mutex_ = threading.Lock()
+		self.bounds_ = list(buckets)
+		# the last one is for what's bigger than every bound
+		self.counts_ = [0] * (len(buckets) + 1)
+		self.sum_ = 0
+		self.count_ = 0
+
+	def observe(self, value):
+		i = bisect.bisect_left(self.bounds_, value)
+		self.mutex_.acquire()
+		self.counts_[i] += 1
+		self.sum_ += value
+		self.count_ += 1
+		self.mutex_.release()
+
+	def snapshot(self):
+		# buckets are [bound, observations up to bound] like in the text
+		# format, the last bound is None
+		self.mutex_.acquire()
+		try:
+			buckets = []
+			total = 0
+			for bound, count in zip(self.bounds_ + [None], self.counts_):
+				total += count
+				buckets.append([bound, total])
+			return {'count':self.count_, 'sum':self.sum_, 'buckets':buckets}
+		finally:
+			self.mutex_.release()
+
+# Every metric of the process, by name and labels. Getting a metric that
+# doesn't exist creates it, so code only needs
+# metrics.counter('rpc_calls_total', command = 'ping').inc()
+class Registry(object):
+	def __init__(self):
+		self.mutex_ = threading.Lock()
+		# (name, sorted labels) -> metric
+		self.metrics_ = {}
+
+	def get(self, cls, name, labels, *args):
+		# one label or none, the usual case, needs no sorting
+		if len(labels) > 1:
+			key = (name, tuple(sorted(labels.items())))
+		else:
+			key = (name, tuple(labels.items()))
+		metric = self.metrics_.get(key)
+		if metric == None:
+			self.mutex_.acquire()
+			try:
+				metric = self.metrics_.setdefault(key, cls(*args))
+			finally:
+				self.mutex_.release()
+		return metric
+
+	def counter(self, name, **labels):
+		return self.get(Counter, name, labels)
+
+	def histogram(self, name, buckets = LATENCY_BUCKETS, **labels):
+		return self.get(Histogram, name, labels, buckets)
+
+	def gauge(self, name, func = None, **labels):
+		# a gauge with func reads from it, the last one given wins
+		gauge = self.get(Gauge, name, labels)
+		if func != None:
+			gauge.func_ = func
+		return gauge
+
+	def snapshot(self):
+		# {name: [{'labels':{...}, 'value':<#VALUE#>}, ...]}, histograms
+		# have their Histogram.snapshot as value
+		result = {}
+		for (name, labels), metric in sorted(self.metrics_.items()):
+			result.setdefault(name, []).append({'labels':dict(labels), 'value':metric.snapshot()})
+		return result
+
+	def text(self):
+		# text format scrapers like Prometheus understand
+		lines = []
+		last = None
+		for (name, labels), metric in sorted(self.metrics_.items()):
+			if name != last:
+				lines.append("# TYPE %s %s" % (name, metric.kind))
+				last = name
+			value = metric.snapshot()
+			if metric.kind != 'histogram':
+				lines.append("%s%s %s" % (name, format_labels(labels), value))
+				continue
+			for bound, count in value['buckets']:
+				le = "+Inf" if bound == None else repr(bound)
+				lines.append("%s_bucket%s %s" % (name, format_labels(labels + (('le', le),)), count))
+			lines.append("%s_sum%s %s" % (name, format_labels(labels), value['sum']))
+			lines.append("%s_count%s %s" % (name, format_labels(labels), value['count']))
+		return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+	if not len(labels):
+		return ""
+	return "{%s}" % ",".join(map(lambda label: '%s="%s"' % label, labels))
+
+metrics = Registry()
@@ -1,18 +1,195 @@
+import socket
+import struct
+import threading
 
-# reads from socket until "\r\n"
-def read_from_socket(s):
-	result = ""
-	while 1:
-		data = s.recv(256)
-		if data[-2:] == "\r\n":
-			result += data[:-2]
-			break
-		result += data
-#	if result != "":
-#		print "read : %s" % result
-	return result
-
-# sends all on socket, adding "\r\n"
-def send_to_socket(s, msg):
-#	print "respond : %s" % msg
-	s.sendall(str(msg) + "\r\n")
+from codec import get_codec
+from settings import MAX_FRAME_SIZE
+
+# Connections start in text mode: one "\r\n" terminated line per message,
+# optionally tagged as "@<id> <message>", answers are json. A client that
+# sends FRAME_MAGIC first switches the connection to length prefixed
+# frames, each one is a header (payload length, request id) followed by
+# the payload. The first frame carries the name of the codec the client
+# would like to use, the server answers with the one it picked.
+FRAME_MAGIC = "\x00CHF"
+FRAME_HEADER = struct.Struct("!II")
+
+# what a request that failed on the server is answered with, so the caller
+# doesn't wait for its timeout (see remote.RemoteError)
+ERROR_KEY = '__error__'
+
+def error_response(error):
+	return {ERROR_KEY: "%s: %s" % (error.__class__.__name__, error)}
+
+def is_error_response(response):
+	return isinstance(response, dict) and len(response) == 1 and ERROR_KEY in response
+
+# payloads above this size are sent on their own instead of being
+# copied next to their header
+BULK_SEND_SIZE = 1<<16
+
+RECV_SIZE = 1<<16
+
+# socket wrapper that parses messages out of a reusable receive buffer,
+# so messages that arrive together or split across reads are handled
+# without copying everything received so far. Sends are serialized,
+# responses may be written by several threads.
+class Connection(object):
+	def __init__(self, s):
+		self.socket_ = s
+		try:
+			self.socket_.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		except socket.error:
+			# not a TCP socket
+			pass
+		# received data lives in buffer_[start_:end_]
+		self.buffer_ = bytearray(RECV_SIZE)
+		self.start_ = 0
+		self.end_ = 0
+		# None until we know what the other end speaks
+		self.framed_ = None
+		self.codec_ = get_codec('json')
+		self.send_mutex_ = threading.Lock()
+
+	def fileno(self):
+		return self.socket_.fileno()
+
+	def start_framing(self, codec_name):
+		self.framed_ = True
+		self.socket_.sendall(FRAME_MAGIC)
+		self.send_frame(0, codec_name)
+		rid, accepted = self.read_frame()
+		self.codec_ = get_codec(accepted)
+
+	def buffered(self):
+		return self.end_ - self.start_
+
+	def fill(self, needed):
+		# reads until at least needed bytes are buffered
+		while self.buffered() < needed:
+			if needed > len(self.buffer_) - self.start_:
+				self.make_room(needed)
+			read = self.socket_.recv_into(memoryview(self.buffer_)[self.end_:])
+			if read == 0:
+				raise socket.error("connection closed by peer")
+			self.end_ += read
+
+	def make_room(self, needed):
+		# move what we have to the front, growing only if it doesn't fit
+		data = self.buffer_[self.start_:self.end_]
+		if needed > len(self.buffer_):
+			self.buffer_ = bytearray(max(needed, 2 * len(self.buffer_)))
+		self.buffer_[:len(data)] = data
+		self.start_ = 0
+		self.end_ = len(data)
+
+	def take(self, size):
+		data = str(self.buffer_[self.start_:self.start_ + size])
+		self.start_ += size
+		if self.start_ == self.end_:
+			self.start_ = self.end_ = 0
+			# don't hold on to the memory of a big message
+			if len(self.buffer_) > RECV_SIZE:
+				self.buffer_ = bytearray(RECV_SIZE)
+		return data
+
+	def detect_mode(self):
+		self.fill(1)
+		if self.buffer_[self.start_] != ord(FRAME_MAGIC[0]):
+			self.framed_ = False
+			return
+		self.fill(len(FRAME_MAGIC))
+		if self.take(len(FRAME_MAGIC)) != FRAME_MAGIC:
+			raise socket.error("bad frame magic")
+		self.framed_ = True
+		rid, wanted = self.read_frame()
+		self.codec_ = get_codec(wanted)
+		self.send_frame(0, self.codec_.name)
+
+	def has_buffered(self):
+		# is there a whole message waiting in the buffer?
+		if self.framed_ == None:
+			return False
+		if not self.framed_:
+			return self.buffer_.find("\r\n", self.start_, self.end_) >= 0
+		if self.buffered() < FRAME_HEADER.size:
+			return False
+		size, rid = FRAME_HEADER.unpack_from(self.buffer_, self.start_)
+		return self.buffered() >= FRAME_HEADER.size + size
+
+	def read_line(self):
+		# bytes after start_ already searched for the terminator
+		scanned = 0
+		while 1:
+			end = self.buffer_.find("\r\n", self.start_ + scanned, self.end_)
+			if end >= 0:
+				line = self.take(end - self.start_)
+				self.take(2)
+				return line
+			if self.buffered() > MAX_FRAME_SIZE:
+				raise socket.error("line longer than %s bytes" % MAX_FRAME_SIZE)
+			# the terminator might be split between two reads
+			scanned = max(0, self.buffered() - 1)
+			self.fill(self.buffered() + 1)
+
+	def read_frame(self):
+		self.fill(FRAME_HEADER.size)
+		size, rid = FRAME_HEADER.unpack_from(self.buffer_, self.start_)
+		if size > MAX_FRAME_SIZE:
+			raise socket.error("frame of %s bytes is too large" % size)
+		self.fill(FRAME_HEADER.size + size)
+		self.start_ += FRAME_HEADER.size
+		return rid, self.take(size)
+
+	def read_message(self):
+		# returns (request id, message). In text mode the message is the
+		# line as it came, the id is None for untagged lines. Frames are
+		# decoded with the codec of the connection. Returns None if there
+		# was only the handshake to read.
+		if self.framed_ == None:
+			self.detect_mode()
+			if self.framed_ and not self.has_buffered():
+				return None
+		if self.framed_:
+			rid, payload = self.read_frame()
+			return rid, self.codec_.decode(payload)
+		line = self.read_line()
+		if line[:1] == '@':
+			rid, _, line = line[1:].partition(' ')
+			return int(rid), line
+		return None, line
+
+	def send_message(self, rid, obj):
+		msg = self.codec_.encode(obj)
+		if self.framed_:
+			self.send_frame(rid or 0, msg)
+		elif rid != None:
+			self.send("@%s %s\r\n" % (rid, msg))
+		else:
+			self.send(msg + "\r\n")
+
+	def send_frame(self, rid, msg):
+		if len(msg) > MAX_FRAME_SIZE:
+			raise socket.error("frame of %s bytes is too large" % len(msg))
+		header = FRAME_HEADER.pack(len(msg), rid)
+		# small frames go in a single write, big ones are not copied
+		if len(msg) < BULK_SEND_SIZE:
+			self.send(header + msg)
+		else:
+			self.send(header, msg)
+
+	def send(self, *chunks):
+		self.send_mutex_.acquire()
+		try:
+			for chunk in chunks:
+				self.socket_.sendall(chunk)
+		finally:
+			self.send_mutex_.release()
+
+	def close(self):
+		# shutdown wakes up any thread blocked reading from us
+		try:
+			self.socket_.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+		self.socket_.close()
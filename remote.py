@@ -1,38 +1,354 @@
-import json
 import socket
 import threading
+import time
 
 from address import Address
-from settings import SIZE
+from metrics import metrics
+from settings import SIZE, POOL_SIZE, POOL_IDLE_TIMEOUT, RPC_TIMEOUT, CODEC
+from settings import HEARTBEAT_TIMEOUT, CHANNEL_MAX_TIMEOUTS
 from network import *
 
-# decorator to thread-safe Remote's socket
-def requires_connection(func):
-	""" initiates and cleans up connections with remote server """
-	def inner(self, *args, **kwargs):
+# functions called as f(address, ok) with the outcome of every call made
+# to a peer, so liveness can be learnt without pinging anybody
+call_observers = []
+
+def report_outcome(address, ok):
+	for observer in call_observers:
+		observer(address, ok)
+
+# functions called as f(address, seconds) with the round trip time of the
+# calls that got an answer. Only commands the peer answers on its own are
+# measured, the time of lookups and quorum operations depends on the
+# peers they involve and not on how far the peer is
+rtt_observers = []
+RTT_COMMANDS = ('ping', 'get_successor', 'get_predecessor', 'get_successors')
+
+def report_rtt(address, rtt):
+	for observer in rtt_observers:
+		observer(address, rtt)
+
+# the peer got the call but failed to serve it, it's alive all the same
+class RemoteError(socket.error):
+	pass
+
+# result of a call that might not have been answered yet
+class Future(object):
+	def __init__(self, address, parse = None, command = None):
+		self.address_ = address
+		self.command_ = command
+		self.event_ = threading.Event()
+		self.mutex_ = threading.Lock()
+		self.callbacks_ = []
+		self.parse_ = parse
+		self.result_ = None
+		self.error_ = None
+		# futures are created right before the request is sent
+		self.sent_ = time.time()
+		# the Channel it was sent on and its request id there
+		self.channel_ = None
+		self.rid_ = None
+
+	def set_result(self, result):
+		self.result_ = result
+		self.finish()
+		report_outcome(self.address_, True)
+		rtt = time.time() - self.sent_
+		if self.command_ in RTT_COMMANDS:
+			report_rtt(self.address_, rtt)
+		metrics.histogram('rpc_seconds', command = self.command_).observe(rtt)
+
+	def set_error(self, error, answered = False):
+		self.error_ = error
+		self.finish()
+		report_outcome(self.address_, answered)
+		metrics.counter('rpc_errors_total', command = self.command_).inc()
+
+	def finish(self):
+		self.mutex_.acquire()
+		self.event_.set()
+		callbacks, self.callbacks_ = self.callbacks_, []
+		self.mutex_.release()
+		for callback in callbacks:
+			callback(self)
+
+	def add_done_callback(self, callback):
+		# callback(future) is called once there is a response or an error
+		self.mutex_.acquire()
+		if not self.event_.is_set():
+			self.callbacks_.append(callback)
+			self.mutex_.release()
+			return
+		self.mutex_.release()
+		callback(self)
+
+	def done(self):
+		return self.event_.is_set()
+
+	def result(self, timeout = RPC_TIMEOUT):
+		if not self.event_.wait(timeout):
+			report_outcome(self.address_, False)
+			metrics.counter('rpc_timeouts_total', command = self.command_).inc()
+			error = socket.timeout("no response after %s seconds" % timeout)
+			if self.channel_ != None:
+				self.channel_.timed_out(self, error)
+			raise error
+		if self.error_ != None:
+			raise self.error_
+		if self.parse_:
+			return self.parse_(self.result_)
+		return self.result_
+
+def wait_for(futures, count, timeout = RPC_TIMEOUT, accept = None):
+	# waits until count of the futures got a response, all of them are done
+	# or timeout goes by. Returns the ones that got a response accept(result)
+	# is happy with, in the order they arrived, the rest keep going on
+	# their own.
+	condition = threading.Condition()
+	arrived = []
+	failed = []
+	def done(future):
+		ok = future.error_ == None and (accept == None or accept(future.result(0)))
+		condition.acquire()
+		if ok:
+			arrived.append(future)
+		else:
+			failed.append(future)
+		condition.notify()
+		condition.release()
+	for future in futures:
+		future.add_done_callback(done)
+	deadline = time.time() + timeout
+	condition.acquire()
+	try:
+		while len(arrived) < count and len(arrived) + len(failed) < len(futures):
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				break
+			condition.wait(remaining)
+		return list(arrived)
+	finally:
+		condition.release()
+
+# connection to a peer that carries many calls at the same time. Every
+# request goes in a frame tagged with an id, the peer answers with a frame
+# carrying the same id in whatever order it finishes them.
+class Channel(object):
+	def __init__(self, address):
+		self.address_ = address
+		# a peer that accepts but never answers (frozen, or not reading
+		# because it's saturated) fails here like any other dead peer
+		s = socket.create_connection((address.ip, address.port), HEARTBEAT_TIMEOUT)
+		try:
+			self.connection_ = Connection(s)
+			self.connection_.start_framing(CODEC)
+		except socket.error:
+			s.close()
+			raise
+		# from now on calls wait as long as they want, see Future.result,
+		# but a send that can't go through in RPC_TIMEOUT fails the channel
+		s.settimeout(RPC_TIMEOUT)
+		self.mutex_ = threading.Lock()
+		# request id -> Future
+		self.pending_ = {}
+		self.next_id_ = 0
+		# calls in a row nobody waited the answer of
+		self.timeouts_ = 0
+		self.alive_ = True
+		self.last_used_ = time.time()
+		self.reader_ = threading.Thread(target = self.read_responses)
+		self.reader_.daemon = True
+		self.reader_.start()
+
+	def call(self, command, args, parse = None, vnode = 0):
+		metrics.counter('rpc_calls_total', command = command).inc()
+		future = Future(self.address_, parse, command)
 		self.mutex_.acquire()
+		try:
+			if not self.alive_:
+				raise socket.error("connection to %s is closed" % self.address_)
+			rid = self.next_id_
+			self.next_id_ += 1
+			self.pending_[rid] = future
+			future.channel_ = self
+			future.rid_ = rid
+			self.last_used_ = time.time()
+		finally:
+			self.mutex_.release()
+		# requests for virtual nodes say which one they are for
+		request = (command, args, vnode) if vnode else (command, args)
+		try:
+			self.connection_.send_message(rid, request)
+		except socket.error, e:
+			self.fail(e)
+		return future
+
+	def read_responses(self):
+		try:
+			while 1:
+				try:
+					rid, response = self.connection_.read_message()
+				except socket.timeout:
+					# nothing to read, what was read of a frame is kept
+					if self.stalled(time.time()):
+						self.fail(socket.timeout("calls to %s not answered in %s seconds" % \
+						                         (self.address_, RPC_TIMEOUT)))
+						return
+					continue
+				self.mutex_.acquire()
+				self.timeouts_ = 0
+				future = self.pending_.pop(rid, None)
+				self.mutex_.release()
+				if future == None:
+					continue
+				if is_error_response(response):
+					future.set_error(RemoteError("%s failed on %s, %s" % \
+					                 (future.command_, self.address_, response[ERROR_KEY])), True)
+				else:
+					future.set_result(response)
+		except Exception:
+			# closed, or an answer we can't make sense of, either way the
+			# calls on it are not getting their answers
+			self.fail(socket.error("connection to %s lost" % self.address_))
 
-		self.open_connection()
-		ret = func(self, *args, **kwargs)
-		self.close_connection()
+	def timed_out(self, future, error):
+		# the caller gave up on future, its answer is not waited for. After
+		# CHANNEL_MAX_TIMEOUTS of them in a row the channel is failed
+		self.mutex_.acquire()
+		dropped = self.pending_.pop(future.rid_, None) != None
+		if dropped:
+			self.timeouts_ += 1
+		give_up = self.timeouts_ >= CHANNEL_MAX_TIMEOUTS
 		self.mutex_.release()
+		if dropped:
+			# anybody else waiting on it gets the timeout as well
+			future.error_ = error
+			future.finish()
+		if give_up and self.alive_:
+			metrics.counter('rpc_channels_stalled_total').inc()
+			self.fail(socket.timeout("%s calls in a row to %s timed out" % (self.timeouts_, self.address_)))
 
-		return ret
-	return inner
+	def stalled(self, now):
+		# the oldest call waiting has waited longer than anybody does
+		self.mutex_.acquire()
+		try:
+			oldest = min([future.sent_ for future in self.pending_.values()] or [now])
+		finally:
+			self.mutex_.release()
+		return now - oldest > RPC_TIMEOUT
+
+	def fail(self, error):
+		# every call still waiting gets the error
+		self.mutex_.acquire()
+		self.alive_ = False
+		pending, self.pending_ = self.pending_, {}
+		self.mutex_.release()
+		self.connection_.close()
+		for future in pending.values():
+			future.set_error(error)
+
+	def load(self):
+		return len(self.pending_)
+
+	def idle_since(self):
+		if len(self.pending_):
+			return time.time()
+		return self.last_used_
+
+	def close(self):
+		self.fail(socket.error("connection to %s closed" % self.address_))
+
+# pool of open channels, shared by every Remote so that all the Remote
+# objects pointing to the same peer, or to any of its virtual nodes, reuse
+# the same sockets
+class ChannelPool(object):
+	def __init__(self, size = POOL_SIZE, idle_timeout = POOL_IDLE_TIMEOUT):
+		self.size_ = size
+		self.idle_timeout_ = idle_timeout
+		self.mutex_ = threading.Lock()
+		# (ip, port) -> list of channels
+		self.channels_ = {}
+		self.last_eviction_ = time.time()
+
+	def get(self, address):
+		# returns a channel to address and whether it was already open.
+		# The least busy channel is used, a new one is opened only if all
+		# of them have calls in flight and we are below size_.
+		key = address.endpoint()
+		if time.time() - self.last_eviction_ > 1:
+			self.evict_idle()
+		self.mutex_.acquire()
+		try:
+			channels = filter(lambda c: c.alive_, self.channels_.get(key, []))
+			self.channels_[key] = channels
+			if len(channels):
+				channel = min(channels, key = lambda c: c.load())
+				if channel.load() == 0 or len(channels) >= self.size_:
+					return channel, True
+		finally:
+			self.mutex_.release()
+		try:
+			channel = Channel(address)
+			metrics.counter('rpc_channels_opened_total').inc()
+		except socket.error:
+			report_outcome(address, False)
+			raise
+		self.mutex_.acquire()
+		self.channels_.setdefault(key, []).append(channel)
+		self.mutex_.release()
+		return channel, False
+
+	def evict_idle(self):
+		now = time.time()
+		idle = []
+		stalled = []
+		self.mutex_.acquire()
+		try:
+			self.last_eviction_ = now
+			for key in self.channels_.keys():
+				keep = []
+				for channel in self.channels_[key]:
+					if not channel.alive_:
+						continue
+					if channel.stalled(now):
+						stalled.append(channel)
+					elif now - channel.idle_since() < self.idle_timeout_:
+						keep.append(channel)
+					else:
+						idle.append(channel)
+				if len(keep):
+					self.channels_[key] = keep
+				else:
+					del self.channels_[key]
+		finally:
+			self.mutex_.release()
+		for channel in idle:
+			channel.close()
+		for channel in stalled:
+			metrics.counter('rpc_channels_stalled_total').inc()
+			channel.fail(socket.timeout("calls to %s not answered in %s seconds" % \
+			                            (channel.address_, RPC_TIMEOUT)))
+
+	def close_all(self):
+		self.mutex_.acquire()
+		channels, self.channels_ = self.channels_, {}
+		self.mutex_.release()
+		for key in channels:
+			for channel in channels[key]:
+				channel.close()
+
+	def size(self):
+		return sum(map(len, self.channels_.values()))
+
+pool = ChannelPool()
+metrics.gauge('rpc_channels', pool.size)
+
+def remote_from_response(response):
+	return Remote(Address(*response))
 
 # class representing a remote peer
 class Remote(object):
 	def __init__(self, remote_address):
 		self.address_ = remote_address
-		self.mutex_ = threading.Lock()
-
-	def open_connection(self):
-		self.socket_ = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		self.socket_.connect((self.address_.ip, self.address_.port))
-
-	def close_connection(self):
-		self.socket_.close()
-		self.socket_ = None
 
 	def __str__(self):
 		return "Remote %s" % self.address_
@@ -40,74 +356,77 @@ class Remote(object):
 	def id(self, offset = 0):
 		return (self.address_.__hash__() + offset) % SIZE
 
-	def send(self, msg):
-		self.socket_.sendall(msg + "\r\n")
-		self.last_msg_send_ = msg
-		# print "send: %s <%s>" % (msg, self.address_)
+	def call_async(self, command, args = None, parse = None):
+		""" sends command to the peer, returns a Future with its response """
+		channel, reused = pool.get(self.address_)
+		future = channel.call(command, args, parse, self.address_.vnode)
+		# the peer might have dropped a pooled connection while it was
+		# idle, that's worth one retry on a new one. Any other failure
+		# goes up to the caller, maintenance tasks are retried by the
+		# scheduler (see scheduler.Task).
+		if reused and future.done() and future.error_ != None and \
+		   not isinstance(future.error_, RemoteError):
+			metrics.counter('rpc_retries_total', command = command).inc()
+			channel, reused = pool.get(self.address_)
+			future = channel.call(command, args, parse, self.address_.vnode)
+		return future
 
-	def recv(self):
-		# we use to have more complicated logic here
-		# and we might have again, so I'm not getting rid of this yet
-		return read_from_socket(self.socket_)
+	def call(self, command, args = None, parse = None):
+		return self.call_async(command, args, parse).result()
 
-	def ping(self):
+	def ping(self, timeout = HEARTBEAT_TIMEOUT):
 		try:
-			s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-			s.connect((self.address_.ip, self.address_.port))
-			s.sendall("\r\n")
-			s.close()
-			return True
+			return self.call_async('ping').result(timeout)
 		except socket.error:
 			return False
 
-	@requires_connection
 	def command(self, msg):
-		self.send(msg)
-		response = self.recv()
-		return response
+		# text style "<command> <arguments>", as typed on a terminal
+		command = msg.split(' ')[0]
+		return self.call(command, msg[len(command) + 1:])
 
-	@requires_connection
 	def get_successors(self):
-		self.send('get_successors')
+		def parse(response):
+			# if our next guy doesn't have successors, return empty list
+			if not response:
+				return []
+			return map(remote_from_response, response)
+		return self.call('get_successors', parse = parse)
 
-		response = self.recv()
-		# if our next guy doesn't have successors, return empty list
-		if response == "":
-			return []
-		response = json.loads(response)
-		return map(lambda address: Remote(Address(address[0], address[1])) ,response)
-
-	@requires_connection
 	def successor(self):
-		self.send('get_successor')
-
-		response = json.loads(self.recv())
-		return Remote(Address(response[0], response[1]))
+		return self.call('get_successor', parse = remote_from_response)
 
-	@requires_connection
 	def predecessor(self):
-		self.send('get_predecessor')
+		def parse(response):
+			if not response:
+				return None
+			return remote_from_response(response)
+		return self.call('get_predecessor', parse = parse)
 
-		response = self.recv()
-		if response == "":
-			return None
-		response = json.loads(response)
-		return Remote(Address(response[0], response[1]))
+	def find_successor_async(self, id):
+		return self.call_async('find_successor', id, remote_from_response)
 
-	@requires_connection
 	def find_successor(self, id):
-		self.send('find_successor %s' % id)
+		return self.find_successor_async(id).result()
 
-		response = json.loads(self.recv())
-		return Remote(Address(response[0], response[1]))
+	def find_successors(self, ids):
+		# one round trip for all of them, see Local.find_successors
+		return self.call('find_successors', ids, lambda response: map(remote_from_response, response))
 
-	@requires_connection
-	def closest_preceding_finger(self, id):
-		self.send('closest_preceding_finger %s' % id)
+	def route(self, id, hops, timeout):
+		# forwards a recursive lookup, see Local.route
+		def parse(response):
+			if not response:
+				return None
+			return remote_from_response(response[0]), response[1], response[2]
+		return self.call_async('route', (id, hops, timeout), parse).result(timeout)
 
-		response = json.loads(self.recv())
-		return Remote(Address(response[0], response[1]))
+	def closest_preceding_finger(self, id):
+		return self.call('closest_preceding_finger', id, remote_from_response)
 
-	@requires_connection
 	def notify(self, node):
-		self.send('notify %s %s' % (node.address_.ip, node.address_.port))
+		self.call('notify', node.address_.wire())
+
+	def moved(self, old, new):
+		# see Local.move
+		self.call('moved', (old.wire(), new.wire()))
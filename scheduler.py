@@ -0,0 +1,226 @@
+import sys
+import heapq
+import random
+import socket
+import threading
+import time
+import traceback
+
+from threadpool import ThreadPool
+from metrics import metrics
+from settings import SCHEDULER_WORKERS, SCHEDULER_QUEUE_SIZE, SCHEDULER_JITTER, \
+	SCHEDULER_RETRY_INT
+
+# A job the Scheduler runs over and over. func() returns False to stop,
+# True to run again after interval seconds or a number of seconds to run
+# again after that many. When it raises socket.error it's tried again
+# after SCHEDULER_RETRY_INT seconds, twice as long every time, up to
+# retries times in a row; then give_up() is called and the task stops.
+# Runs that can't start within deadline seconds of when they were due are
+# skipped, the next one is a whole interval later.
+class Task(object):
+	def __init__(self, scheduler, name, func, interval, retries = None, \
+	             deadline = None, give_up = None):
+		self.scheduler_ = scheduler
+		self.name_ = name
+		self.func_ = func
+		self.interval_ = interval
+		self.retries_ = retries
+		self.deadline_ = deadline
+		self.give_up_ = give_up
+		# when it's due, and the heap entry that stands for it
+		self.due_ = None
+		self.entry_ = None
+		self.running_ = False
+		self.woken_ = False
+		self.cancelled_ = False
+		self.failures_ = 0
+		# runs, socket errors, runs skipped because they were too late,
+		# runs longer than the deadline, seconds they started late
+		self.stats_ = {'runs':0, 'errors':0, 'skipped':0, 'overdue':0, 'lag':0.0, 'max_lag':0.0}
+
+	def wake(self):
+		# runs the task as soon as possible, right after the current run
+		# if it's running
+		self.scheduler_.wake(self)
+
+	def cancel(self):
+		self.cancelled_ = True
+
+# Runs the periodic maintenance of every node of the process (stabilize,
+# fix_fingers, ...) from a single timer thread and a few workers instead
+# of a sleeping thread per job. Tasks due are handed to the workers in
+# the order they were due, the ones the workers have no room for wait in
+# the queue. A task never runs twice at the same time.
+class Scheduler(object):
+	def __init__(self, workers = SCHEDULER_WORKERS, queue_size = SCHEDULER_QUEUE_SIZE, \
+	             jitter = SCHEDULER_JITTER):
+		self.workers_ = workers
+		self.queue_size_ = queue_size
+		self.jitter_ = jitter
+		self.condition_ = threading.Condition()
+		# (due, sequence, task), entries of cancelled or rescheduled tasks
+		# are dropped when they come up
+		self.heap_ = []
+		self.sequence_ = 0
+		# tasks due, waiting for room in the pool
+		self.queue_ = []
+		self.tasks_ = []
+		self.thread_ = None
+		self.pool_ = None
+
+	def add(self, name, func, interval, retries = None, deadline = None, \
+	        give_up = None, delay = None):
+		# first run after delay, or around interval if not given
+		task = Task(self, name, func, interval, retries, deadline, give_up)
+		self.condition_.acquire()
+		try:
+			if self.thread_ == None:
+				self.start()
+			self.tasks_.append(task)
+			self.push(task, self.jittered(interval) if delay == None else delay)
+		finally:
+			self.condition_.release()
+		return task
+
+	def start(self):
+		# condition_ must be held
+		self.pool_ = ThreadPool(self.workers_, self.queue_size_)
+		self.thread_ = threading.Thread(target = self.loop)
+		self.thread_.daemon = True
+		self.thread_.start()
+
+	def jittered(self, interval):
+		# so tasks started at the same time don't keep running together
+		return interval * (1 + random.uniform(-self.jitter_, self.jitter_))
+
+	def push(self, task, delay):
+		# condition_ must be held
+		task.due_ = time.time() + delay
+		task.entry_ = self.sequence_
+		self.sequence_ += 1
+		heapq.heappush(self.heap_, (task.due_, task.entry_, task))
+		self.condition_.notify()
+
+	def wake(self, task):
+		self.condition_.acquire()
+		try:
+			if task.cancelled_:
+				return
+			if task.running_:
+				task.woken_ = True
+			elif task.due_ > time.time():
+				self.push(task, 0)
+		finally:
+			self.condition_.release()
+
+	def loop(self):
+		self.condition_.acquire()
+		try:
+			while 1:
+				now = time.time()
+				self.queue_ += self.take_due(now)
+				while len(self.queue_) and self.pool_.submit(self.run, self.queue_[0]):
+					self.queue_.pop(0)
+				timeout = 1
+				if len(self.heap_):
+					timeout = min(timeout, self.heap_[0][0] - now)
+				if timeout > 0:
+					self.condition_.wait(timeout)
+		finally:
+			self.condition_.release()
+
+	def take_due(self, now):
+		# condition_ must be held, pops the tasks due by now in the order
+		# they were due
+		due = []
+		while len(self.heap_) and self.heap_[0][0] <= now:
+			when, entry, task = heapq.heappop(self.heap_)
+			if entry != task.entry_:
+				continue
+			if task.cancelled_:
+				self.tasks_.remove(task)
+				continue
+			task.running_ = True
+			due.append(task)
+		return due
+
+	def run(self, task):
+		start = time.time()
+		lag = start - task.due_
+		delay = None
+		if task.cancelled_:
+			pass
+		elif task.deadline_ != None and lag > task.deadline_:
+			task.stats_['skipped'] += 1
+			metrics.counter('task_skipped_total', task = task.name_).inc()
+			delay = self.jittered(task.interval_)
+		else:
+			task.stats_['runs'] += 1
+			task.stats_['lag'] += lag
+			task.stats_['max_lag'] = max(task.stats_['max_lag'], lag)
+			metrics.histogram('task_lag_seconds', task = task.name_).observe(lag)
+			try:
+				result = task.func_()
+				task.failures_ = 0
+			except socket.error:
+				task.stats_['errors'] += 1
+				task.failures_ += 1
+				if task.retries_ != None and task.failures_ > task.retries_:
+					metrics.counter('task_give_ups_total', task = task.name_).inc()
+					task.cancel()
+					if task.give_up_ != None:
+						task.give_up_()
+					result = False
+				else:
+					metrics.counter('task_retries_total', task = task.name_).inc()
+					result = SCHEDULER_RETRY_INT * 2 ** (task.failures_ - 1)
+			except Exception:
+				# a failing task must not stop the others
+				traceback.print_exc(file = sys.stderr)
+				result = True
+			if task.deadline_ != None and time.time() - start > task.deadline_:
+				task.stats_['overdue'] += 1
+			if result is False or result is None:
+				task.cancel()
+			elif result is True:
+				delay = self.jittered(task.interval_)
+			else:
+				delay = self.jittered(result)
+		self.condition_.acquire()
+		try:
+			task.running_ = False
+			if task.cancelled_:
+				self.tasks_.remove(task)
+				return
+			if task.woken_:
+				task.woken_ = False
+				delay = 0
+			self.push(task, delay)
+		finally:
+			self.condition_.release()
+
+	def stats(self):
+		# queue_depth = tasks due waiting for a worker, lag = seconds they
+		# started late. Tasks with the same name are added up.
+		self.condition_.acquire()
+		try:
+			tasks = {}
+			for task in self.tasks_:
+				stats = tasks.setdefault(task.name_, {'tasks':0, 'runs':0, 'errors':0, \
+				                         'skipped':0, 'overdue':0, 'lag':0.0, 'max_lag':0.0})
+				stats['tasks'] += 1
+				for key in task.stats_:
+					if key == 'max_lag':
+						stats[key] = max(stats[key], task.stats_[key])
+					else:
+						stats[key] += task.stats_[key]
+			queued = len(self.queue_)
+			if self.pool_ != None:
+				queued += self.pool_.pending()
+			return {'queue_depth':queued, 'tasks':tasks}
+		finally:
+			self.condition_.release()
+
+scheduler = Scheduler()
+metrics.gauge('scheduler_queue_depth', lambda: scheduler.stats()['queue_depth'])
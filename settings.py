@@ -1,7 +1,7 @@
 # CONFIGURATION FILE
 
-# log size of the ring
-LOGSIZE = 8
+# log size of the ring, ids are SHA-1 hashes so up to 160 bits
+LOGSIZE = 160
 SIZE = 1<<LOGSIZE
 
 # successors list size (to continue operating on node failures)
@@ -14,8 +14,17 @@ N_SUCCESSORS = 4
 STABILIZE_INT = 1
 STABILIZE_RET = 4
 
-# Fix Fingers
-FIX_FINGERS_INT = 4
+# Fix Fingers, one finger is refreshed every FIX_FINGERS_INT seconds while
+# they keep changing, and the interval doubles up to FIX_FINGERS_MAX_INT
+# while they don't
+FIX_FINGERS_INT = 0.5
+FIX_FINGERS_MAX_INT = 8
+
+# Proximity neighbour selection, fingers are the node with the lowest
+# round trip time in their interval instead of its first node
+# RTT_ALPHA = weight of every new sample in the smoothed round trip time
+PROXIMITY_FINGERS = True
+RTT_ALPHA = 0.125
 
 # Update Successors
 UPDATE_SUCCESSORS_INT = 1
@@ -24,3 +33,159 @@ UPDATE_SUCCESSORS_RET = 6
 # Find Successors
 FIND_SUCCESSOR_RET = 3
 FIND_PREDECESSOR_RET = 3
+
+# Connection pool
+# POOL_SIZE = connections kept open per peer, each one carries many calls
+# POOL_IDLE_TIMEOUT = seconds before an idle connection is closed
+POOL_SIZE = 2
+POOL_IDLE_TIMEOUT = 30
+
+# seconds to wait for the answer of a call before giving up on it, and
+# for a call to be sent
+RPC_TIMEOUT = 30
+
+# calls in a row that can time out on a connection before it's closed,
+# the peer is taken for stuck and the calls still waiting on it fail
+CHANNEL_MAX_TIMEOUTS = 3
+
+# Incoming connections are closed after being idle for this many seconds
+CONNECTION_IDLE_TIMEOUT = 60
+
+# seconds a worker waits for the rest of a request that started arriving,
+# so a client that stops halfway doesn't keep it busy
+REQUEST_READ_TIMEOUT = 10
+
+# Request serving
+# RUN_WORKERS = requests served concurrently
+# RUN_QUEUE_SIZE = requests waiting for a worker, once full we stop reading
+# from clients until workers catch up
+# MAX_CONNECTIONS = open incoming connections, extra clients wait in backlog
+RUN_WORKERS = 16
+RUN_QUEUE_SIZE = 64
+MAX_CONNECTIONS = 256
+
+# biggest message (in bytes) we accept from or send to a peer
+MAX_FRAME_SIZE = 1<<24
+
+# codec asked for when connecting to peers: 'binary' is compact and sends
+# bytes as they are, 'json' is easier to read when debugging
+CODEC = 'binary'
+
+# Lookups
+# LOOKUP_MODE = 'iterative' (we ask every hop) or 'recursive' (every hop
+# forwards the lookup to the next one)
+# LOOKUP_TIMEOUT = seconds a recursive lookup gets before we fall back
+LOOKUP_MODE = 'iterative'
+LOOKUP_TIMEOUT = 5
+
+# Failure detector
+# HEARTBEAT_INT = seconds without news from a peer before we ping it
+# HEARTBEAT_TIMEOUT = seconds a ping waits for its answer
+# SUSPECT_TIMEOUT = seconds a peer can be failing before we consider it dead
+HEARTBEAT_INT = 1
+HEARTBEAT_TIMEOUT = 1
+SUSPECT_TIMEOUT = 5
+
+# Lookup cache, ranges of ids we know the owner of
+# LOOKUP_CACHE_SIZE = ranges remembered
+# LOOKUP_CACHE_TTL = seconds before we look a range up again
+LOOKUP_CACHE_SIZE = 1024
+LOOKUP_CACHE_TTL = 10
+
+# DHT key handoff
+# HANDOFF_BATCH = keys per request when moving keys to their new owner
+# HANDOFF_GRACE = seconds after our range grows during which reads for keys
+# we don't have yet are forwarded to the previous owner
+# HANDOFF_SWEEP_INT = seconds between handoffs when nothing changes
+# HANDOFF_RETRY_INT = seconds before keys that couldn't be moved are tried
+# again
+HANDOFF_BATCH = 256
+HANDOFF_GRACE = 10
+HANDOFF_SWEEP_INT = 30
+HANDOFF_RETRY_INT = 1
+
+# DHT replication, copies of every key including the owner's. They are kept
+# by the owner and the next nodes on the ring, so at most N_SUCCESSORS
+REPLICATION_FACTOR = 3
+
+# DHT quorums, replicas that have to answer a read or acknowledge a write
+# before it returns. With READ_QUORUM + WRITE_QUORUM > REPLICATION_FACTOR
+# reads always see the last write
+READ_QUORUM = 2
+WRITE_QUORUM = 2
+
+# virtual nodes per process, each one takes its own position on the ring
+# and they share the socket and the storage. Processes on bigger machines
+# can be given more (see dht.DHT) to take a larger share of the keys
+VNODES = 1
+
+# Adaptive load balancing, neighbours on the ring exchange the load of
+# their ranges and the hotter one moves its identifier so the other one
+# takes part of its range
+# LOAD_METRIC = what is balanced, 'requests' (per second) or 'bytes' stored
+# LOAD_IMBALANCE = how many times more loaded than its neighbour a node has
+# to be before load is moved
+# LOAD_MIN = differences below this (in LOAD_METRIC units) are ignored
+# LOAD_EXCHANGE_INT = seconds between exchanges with the successor
+# LOAD_HALF_LIFE = seconds for a request to count half, a node that moved
+# waits that long before moving again so the rates settle
+LOAD_METRIC = 'requests'
+LOAD_IMBALANCE = 2.0
+LOAD_MIN = 1
+LOAD_EXCHANGE_INT = 10
+LOAD_HALF_LIFE = 60
+
+# Scheduler running the periodic maintenance of every node of the process
+# SCHEDULER_WORKERS = tasks running at the same time
+# SCHEDULER_QUEUE_SIZE = tasks handed to the workers and waiting for one
+# SCHEDULER_JITTER = intervals are randomly off by up to this fraction
+# SCHEDULER_RETRY_INT = seconds before a task that failed with a socket
+# error is tried again, doubled every time
+# SCHEDULER_DEADLINE = seconds a run of the node maintenance can be late,
+# later runs are skipped
+SCHEDULER_WORKERS = 8
+SCHEDULER_QUEUE_SIZE = 64
+SCHEDULER_JITTER = 0.1
+SCHEDULER_RETRY_INT = 1
+SCHEDULER_DEADLINE = 5
+
+# Logging, records go through a bounded queue to a writer thread
+# LOG_LEVEL = 'debug', 'info', 'warning' or 'error', what's below is dropped
+# right away. Routing and maintenance steps are 'debug'
+# LOG_FILE = where Local writes
+# LOG_QUEUE_SIZE = records waiting for the writer, more are dropped
+# LOG_BATCH = records written at once
+# LOG_SAMPLE = only one in this many lines logged on every request is kept
+LOG_LEVEL = 'info'
+LOG_FILE = '/tmp/chord.log'
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH = 256
+LOG_SAMPLE = 100
+
+# Ring simulator (simulator.py), nodes are spread on a plane and the one
+# way latency between them grows with their distance
+# SIM_MIN_LATENCY, SIM_MAX_LATENCY = one way latency in seconds of the
+# closest and farthest nodes
+# SIM_LOSS = fraction of the messages lost
+# SIM_TIMEOUT = seconds a caller waits for a lost message
+SIM_MIN_LATENCY = 0.005
+SIM_MAX_LATENCY = 0.1
+SIM_LOSS = 0
+SIM_TIMEOUT = 1
+
+# Storage of the DHT keys
+# STORE_BACKEND = 'memory', or 'log' to keep them in an append-only log per
+# store that a restarted process reads back
+# STORE_DIR = where the logs are
+# STORE_SYNC = fsync every write, without it writes survive the process
+# dying but not the machine
+# STORE_COMPACT_INT = seconds between checks for garbage in the logs
+# STORE_COMPACT_RATIO = a log is rewritten once this fraction of it is old
+# versions and deleted keys
+# STORE_COMPACT_MIN = bytes of garbage not worth rewriting a log for
+STORE_BACKEND = 'memory'
+STORE_DIR = '/tmp/chord-data'
+STORE_SYNC = False
+STORE_COMPACT_INT = 60
+STORE_COMPACT_RATIO = 0.5
+STORE_COMPACT_MIN = 1<<20
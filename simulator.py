@@ -0,0 +1,488 @@
+import sys
+import math
+import time
+import bisect
+import random
+import socket
+import traceback
+
+import chord
+import remote
+from chord import Local
+from remote import Future
+from address import Address
+from failure_detector import FailureDetector
+from latency import LatencyEstimator
+from scheduler import Scheduler
+from settings import SIZE, LOGSIZE, N_SUCCESSORS, SIM_MIN_LATENCY, SIM_MAX_LATENCY, \
+	SIM_LOSS, SIM_TIMEOUT
+
+# every simulated process listens on the same port of its own ip
+SIM_PORT = 4000
+
+# Time in the simulator, nothing ever waits for real. Each task runs at the
+# time it's due and the messages it sends move the clock forward while it
+# runs, then the clock goes to whenever the next task is due, even if
+# that's before the previous one finished.
+class VirtualClock(object):
+	def __init__(self):
+		self.now_ = 0.0
+
+	def time(self):
+		return self.now_
+
+	def advance(self, seconds):
+		self.now_ += seconds
+
+	def set(self, now):
+		self.now_ = now
+
+# The maintenance of every node is run by Simulator.run on the virtual
+# clock instead of a timer thread and workers. Tasks remember the process
+# that added them so they run as that process.
+class SimScheduler(Scheduler):
+	def __init__(self, simulator):
+		Scheduler.__init__(self)
+		self.simulator_ = simulator
+
+	def start(self):
+		pass
+
+	def add(self, *args, **kwargs):
+		task = Scheduler.add(self, *args, **kwargs)
+		task.process_ = self.simulator_.current_
+		return task
+
+# A simulated host: its nodes, where it is on the plane latencies come
+# from, and what the nodes of a real process share with each other.
+class Process(object):
+	def __init__(self, address, position):
+		self.address_ = address
+		self.position_ = position
+		# the Local listening for the process, None until it joined
+		self.host_ = None
+		self.detector_ = FailureDetector()
+		self.latency_ = LatencyEstimator()
+		self.call_observers_ = [self.detector_.report]
+		self.rtt_observers_ = [self.latency_.observe]
+		# requests delivered to it
+		self.received_ = 0
+
+	def nodes(self):
+		if self.host_ == None:
+			return []
+		return self.host_.vnodes_.values()
+
+# stands for a Channel, calls are delivered by the simulator right away
+class SimChannel(object):
+	def __init__(self, simulator, address):
+		self.simulator_ = simulator
+		self.address_ = address
+
+	def call(self, command, args, parse = None, vnode = 0):
+		future = Future(self.address_, parse, command)
+		self.simulator_.deliver(self.address_, vnode, command, args, future)
+		return future
+
+# stands for remote.pool
+class SimNetwork(object):
+	def __init__(self, simulator):
+		self.simulator_ = simulator
+		# (ip, port) -> SimChannel
+		self.channels_ = {}
+
+	def get(self, address):
+		key = address.endpoint()
+		channel = self.channels_.get(key)
+		if channel == None:
+			channel = self.channels_[key] = SimChannel(self.simulator_, address)
+		# never reused, there is no idle connection to retry on
+		return channel, False
+
+	def size(self):
+		return 0
+
+# Runs thousands of unmodified Local nodes in a single thread: requests go
+# through a simulated network instead of sockets, with latency and loss,
+# and maintenance runs on a virtual clock, so runs are deterministic for
+# a given seed and a minute of ring time takes much less than a minute.
+#
+# While installed the simulator owns the process: time.time() is the
+# virtual clock, and remote.pool, chord.scheduler and the failure
+# detector, rtt estimates and call observers every node uses are the ones
+# of the process whose code is running.
+#
+# Calls are delivered as soon as they are made and the caller goes on once
+# the answer is back, so a task waiting on several calls at once sees
+# their latencies add up rather than overlap. What it changes is seen
+# right away by the tasks after it, even the ones due before it finished.
+class Simulator(object):
+	def __init__(self, seed = 0, min_latency = SIM_MIN_LATENCY, max_latency = SIM_MAX_LATENCY, \
+	             loss = SIM_LOSS, timeout = SIM_TIMEOUT):
+		self.seed_ = seed
+		self.random_ = random.Random(seed)
+		self.min_latency_ = min_latency
+		self.max_latency_ = max_latency
+		self.loss_ = loss
+		self.timeout_ = timeout
+		self.clock_ = VirtualClock()
+		self.scheduler_ = SimScheduler(self)
+		self.network_ = SimNetwork(self)
+		# (ip, port) -> Process, the live ones
+		self.processes_ = {}
+		self.created_ = 0
+		# the process whose code is running, None for the simulator
+		self.current_ = None
+		# command -> requests sent, lost ones included
+		self.messages_ = {}
+		self.saved_ = None
+		self.install()
+
+	def install(self):
+		self.saved_ = (time.time, remote.pool, chord.scheduler, chord.detector, chord.latency, \
+		               remote.call_observers, remote.rtt_observers)
+		time.time = self.clock_.time
+		remote.pool = self.network_
+		chord.scheduler = self.scheduler_
+		# scheduler jitter comes from there
+		random.seed(self.seed_)
+
+	def close(self):
+		if self.saved_ == None:
+			return
+		self.switch(None)
+		time.time, remote.pool, chord.scheduler = self.saved_[:3]
+		self.saved_ = None
+
+	def now(self):
+		return self.clock_.time()
+
+	def switch(self, process):
+		# process runs from now on
+		if process is self.current_:
+			return
+		self.current_ = process
+		if process == None:
+			chord.detector, chord.latency, call_observers, rtt_observers = self.saved_[3:]
+		else:
+			chord.detector = process.detector_
+			chord.latency = process.latency_
+			call_observers = process.call_observers_
+			rtt_observers = process.rtt_observers_
+		# Local adds its lookup cache to the list chord imported
+		remote.call_observers = chord.call_observers = call_observers
+		remote.rtt_observers = rtt_observers
+
+	def delay(self, a, b):
+		# one way latency between processes a and b
+		if a is b:
+			return 0
+		if a == None or b == None:
+			return self.min_latency_
+		distance = math.hypot(a.position_[0] - b.position_[0], a.position_[1] - b.position_[1])
+		return self.min_latency_ + (self.max_latency_ - self.min_latency_) * distance / math.sqrt(2)
+
+	def lost(self):
+		return self.loss_ and self.random_.random() < self.loss_
+
+	def deliver(self, address, vnode, command, args, future):
+		# what Local.serve_request would do at the other end, the caller
+		# finds out about lost messages and dead peers after timeout_
+		self.messages_[command] = self.messages_.get(command, 0) + 1
+		caller = self.current_
+		process = self.processes_.get(address.endpoint())
+		if process == None or process.host_ == None or self.lost():
+			self.clock_.advance(self.timeout_)
+			future.set_error(socket.timeout("no response from %s" % address))
+			return
+		delay = self.delay(caller, process)
+		self.clock_.advance(delay)
+		process.received_ += 1
+		node = process.host_.vnodes_.get(vnode)
+		result = None
+		error = None
+		self.switch(process)
+		try:
+			if node != None:
+				result = node.dispatch(command, args)
+		except socket.error:
+			# the connection is closed on the caller
+			error = socket.error("connection to %s lost" % address)
+		except Exception:
+			traceback.print_exc(file = sys.stderr)
+			error = socket.timeout("no response from %s" % address)
+		finally:
+			self.switch(caller)
+		if error != None and isinstance(error, socket.timeout) or self.lost():
+			self.clock_.advance(self.timeout_)
+			future.set_error(socket.timeout("no response from %s" % address))
+		elif error != None:
+			self.clock_.advance(delay)
+			future.set_error(error)
+		else:
+			self.clock_.advance(delay)
+			future.set_result(result)
+
+	def create(self, vnodes = 1, bootstrap = None):
+		# a process with vnodes nodes that joins through bootstrap, or
+		# starts a ring of its own. Not started yet.
+		self.created_ += 1
+		n = self.created_
+		address = Address("10.%s.%s.%s" % (n >> 16 & 255, n >> 8 & 255, n & 255), SIM_PORT)
+		process = Process(address, (self.random_.random(), self.random_.random()))
+		self.processes_[address.endpoint()] = process
+		caller = self.current_
+		self.switch(process)
+		try:
+			host = Local(address, bootstrap)
+			for vnode in range(1, vnodes):
+				Local(Address(address.ip, address.port, vnode), bootstrap, host)
+			process.host_ = host
+		except socket.error:
+			del self.processes_[address.endpoint()]
+			raise
+		finally:
+			self.switch(caller)
+		return process
+
+	def start(self, process):
+		caller = self.current_
+		self.switch(process)
+		try:
+			for node in process.nodes():
+				node.start(serve = False)
+		finally:
+			self.switch(caller)
+
+	def add(self, vnodes = 1):
+		# a new process joins through a random one, a few tries in case
+		# the messages get lost
+		for attempt in range(3):
+			bootstrap = None
+			if len(self.processes_):
+				bootstrap = self.random_.choice(sorted(self.processes_.keys()))
+				bootstrap = self.processes_[bootstrap].address_
+			try:
+				process = self.create(vnodes, bootstrap)
+			except socket.error:
+				continue
+			self.start(process)
+			return process
+		return None
+
+	def kill(self, process):
+		# the process crashes, nobody is told
+		self.processes_.pop(process.address_.endpoint(), None)
+		for node in process.nodes():
+			node.shutdown_ = True
+			for task in node.tasks_.values():
+				task.cancel()
+
+	def processes(self):
+		return map(lambda key: self.processes_[key], sorted(self.processes_.keys()))
+
+	def nodes(self):
+		nodes = []
+		for process in self.processes():
+			nodes += process.nodes()
+		return sorted(nodes, key = lambda node: node.id())
+
+	def build(self, n, vnodes = 1):
+		# n processes with their tables already right, as if the ring had
+		# been running for a while
+		processes = map(lambda i: self.create(vnodes), range(n))
+		nodes = self.nodes()
+		ids = map(lambda node: node.id(), nodes)
+		remotes = map(lambda node: remote.Remote(node.address_), nodes)
+		for i, node in enumerate(nodes):
+			if len(nodes) == 1:
+				break
+			node.set_successor(remotes[(i + 1) % len(nodes)])
+			node.set_predecessor(remotes[i - 1])
+			node.set_successors(map(lambda j: remotes[(i + j) % len(nodes)], range(1, N_SUCCESSORS + 1)))
+			finger = 0
+			while finger < LOGSIZE:
+				j = bisect.bisect_left(ids, node.fingers_.start(finger)) % len(nodes)
+				if nodes[j] is node:
+					break
+				finger = max(finger, node.fingers_.interval_of(remotes[j]))
+				node.fingers_.update(finger, remotes[j])
+				finger += 1
+		for process in processes:
+			self.start(process)
+
+	def grow(self, n, interval = 0.1, vnodes = 1):
+		# n processes joining one after the other, interval seconds apart
+		for i in range(n):
+			self.add(vnodes)
+			self.run(interval)
+
+	def churn(self, interval, vnodes = 1):
+		# every interval seconds a random process crashes and a new one
+		# joins. Returns the task, cancel it to stop.
+		def step():
+			processes = self.processes()
+			if len(processes) > 1:
+				self.kill(self.random_.choice(processes))
+			self.add(vnodes)
+			return True
+		return self.scheduler_.add('churn', step, interval)
+
+	def run(self, seconds):
+		# runs the tasks due in the next seconds in the order they are due
+		end = self.now() + seconds
+		heap = self.scheduler_.heap_
+		while len(heap) and heap[0][0] <= end:
+			due = heap[0][0]
+			self.clock_.set(due)
+			self.scheduler_.condition_.acquire()
+			try:
+				tasks = self.scheduler_.take_due(due)
+			finally:
+				self.scheduler_.condition_.release()
+			for task in tasks:
+				self.switch(task.process_)
+				try:
+					self.scheduler_.run(task)
+				finally:
+					self.switch(None)
+		self.clock_.set(end)
+
+	def run_until(self, predicate, timeout, step = 0.1):
+		# seconds it took predicate() to be True, None if it wasn't after
+		# timeout seconds
+		start = self.now()
+		while not predicate():
+			if self.now() - start >= timeout:
+				return None
+			self.run(step)
+		return self.now() - start
+
+	def converged(self):
+		# every node has the right successor and predecessor
+		nodes = self.nodes()
+		for i, node in enumerate(nodes):
+			successor = nodes[(i + 1) % len(nodes)]
+			predecessor = nodes[i - 1]
+			if node.successor_.id() != successor.id():
+				return False
+			if len(nodes) > 1 and (node.predecessor_ == None or node.predecessor_.id() != predecessor.id()):
+				return False
+		return True
+
+	def stale_fingers(self):
+		# fraction of the fingers pointing to dead processes
+		total = 0
+		stale = 0
+		for node in self.nodes():
+			for finger in node.fingers_.nodes():
+				total += 1
+				if not finger.address_.endpoint() in self.processes_:
+					stale += 1
+		return float(stale) / total if total else 0.0
+
+	def lookups(self, count):
+		# looks up count random ids from random nodes, skipping the
+		# caches, all of them now. Returns {'lookups', 'failed', 'wrong', 'messages',
+		# 'time', 'hops':{hops:lookups}}, messages and seconds in total.
+		nodes = self.nodes()
+		ids = map(lambda node: node.id(), nodes)
+		stats = {'lookups':count, 'failed':0, 'wrong':0, 'messages':0, 'time':0.0, 'hops':{}}
+		for i in range(count):
+			node = self.random_.choice(nodes)
+			id = self.random_.randrange(SIZE)
+			expected = ids[bisect.bisect_left(ids, id) % len(ids)]
+			messages = self.message_count()
+			start = self.now()
+			self.switch(self.processes_[node.address_.endpoint()])
+			try:
+				owner, hops = node.lookup(id, cached = False)
+			except socket.error:
+				stats['failed'] += 1
+				continue
+			finally:
+				self.switch(None)
+				elapsed = self.now() - start
+				self.clock_.set(start)
+			stats['messages'] += self.message_count() - messages
+			stats['time'] += elapsed
+			if owner.id() != expected:
+				stats['wrong'] += 1
+			stats['hops'][hops] = stats['hops'].get(hops, 0) + 1
+		return stats
+
+	def message_count(self):
+		return sum(self.messages_.values())
+
+	def reset_messages(self):
+		self.messages_ = {}
+		for process in self.processes_.values():
+			process.received_ = 0
+
+def percentile(histogram, fraction):
+	# histogram = {value: times seen}
+	total = sum(histogram.values())
+	seen = 0
+	for value in sorted(histogram.keys()):
+		seen += histogram[value]
+		if seen >= fraction * total:
+			return value
+	return None
+
+# seconds of ring time every step of scale takes
+WARMUP = 10
+MEASURE = 10
+LOOKUPS = 1000
+CONVERGE_TIMEOUT = 300
+
+def scale(sizes, seed = 0, vnodes = 1, loss = SIM_LOSS):
+	# for every ring size: lookup hops, maintenance messages per node and
+	# second, and seconds until the ring is right again after 1% of the
+	# processes crashed and as many joined
+	print "%6s %6s %5s %5s %5s %6s %8s %9s %6s %6s" % ('nodes', 'hops', 'p50', 'p99', 'max', \
+	      'wrong', 'msgs/n/s', 'converge', 'stale', 'wall')
+	results = []
+	for n in sizes:
+		wall = time.time()
+		simulator = Simulator(seed, loss = loss)
+		try:
+			silenced(simulator.build, n, vnodes)
+			simulator.run(WARMUP)
+			simulator.reset_messages()
+			simulator.run(MEASURE)
+			rate = float(simulator.message_count()) / (n * vnodes * MEASURE)
+			lookups = simulator.lookups(LOOKUPS)
+			hops = lookups['hops']
+			changes = max(1, n / 100)
+			for process in simulator.random_.sample(simulator.processes(), changes):
+				simulator.kill(process)
+			for i in range(changes):
+				silenced(simulator.add, vnodes)
+			converge = simulator.run_until(simulator.converged, CONVERGE_TIMEOUT)
+			stale = simulator.stale_fingers()
+		finally:
+			simulator.close()
+		wall = time.time() - wall
+		mean = float(sum(map(lambda h: h * hops[h], hops))) / max(1, sum(hops.values()))
+		print "%6s %6.2f %5s %5s %5s %6s %8.1f %9s %6.3f %6.1f" % (n * vnodes, mean, \
+		      percentile(hops, 0.5), percentile(hops, 0.99), max(hops.keys() or [0]), \
+		      lookups['wrong'] + lookups['failed'], rate, \
+		      "%.1f" % converge if converge != None else "-", stale, wall)
+		results.append({'nodes':n * vnodes, 'lookups':lookups, 'messages_per_node':rate, \
+		                'converge':converge, 'stale_fingers':stale})
+	return results
+
+def silenced(func, *args):
+	# Local prints every node it creates
+	stdout = sys.stdout
+	sys.stdout = open('/dev/null', 'w')
+	try:
+		return func(*args)
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+
+if __name__ == "__main__":
+	# python simulator.py [ring sizes...]
+	sizes = map(int, sys.argv[1:]) or [64, 256, 1024]
+	scale(sizes)
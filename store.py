@@ -0,0 +1,316 @@
+import os
+import zlib
+import bisect
+import struct
+import cPickle
+import threading
+
+from address import key_id
+from settings import SIZE, STORE_BACKEND, STORE_DIR, STORE_SYNC, STORE_COMPACT_RATIO, \
+	STORE_COMPACT_MIN
+
+# dict-like store that also keeps its keys sorted by their position on the
+# ring, so "which keys fall in (a, b]" doesn't need to look at every key.
+# The position of every key is hashed once, when it's added.
+class RangeStore(object):
+	def __init__(self):
+		self.mutex_ = threading.RLock()
+		# key -> (id of key, value)
+		self.data_ = {}
+		# sorted (id of key, key)
+		self.index_ = []
+
+	def __contains__(self, key):
+		return key in self.data_
+
+	def __getitem__(self, key):
+		return self.data_[key][1]
+
+	def __setitem__(self, key, value):
+		self.mutex_.acquire()
+		try:
+			entry = self.data_.get(key)
+			if entry == None:
+				id = key_id(key)
+				bisect.insort(self.index_, (id, key))
+			else:
+				id = entry[0]
+			self.data_[key] = (id, value)
+		finally:
+			self.mutex_.release()
+
+	def __delitem__(self, key):
+		self.mutex_.acquire()
+		try:
+			id = self.data_.pop(key)[0]
+			del self.index_[bisect.bisect_left(self.index_, (id, key))]
+		finally:
+			self.mutex_.release()
+
+	def __len__(self):
+		return len(self.data_)
+
+	def get(self, key, default = None):
+		entry = self.data_.get(key)
+		if entry == None:
+			return default
+		return entry[1]
+
+	def keys(self):
+		return self.data_.keys()
+
+	def compact(self):
+		# nothing to reclaim in memory
+		return False
+
+	def close(self):
+		pass
+
+	def keys_in_range(self, a, b):
+		# keys whose id is in (a, b], if a == b that's the whole ring
+		return map(lambda entry: entry[1], self.entries_in_range(a, b))
+
+	def entries_in_range(self, a, b):
+		# (id, key) of the keys in (a, b], in ring order
+		a = a % SIZE
+		b = b % SIZE
+		self.mutex_.acquire()
+		try:
+			if a < b:
+				return self.slice(a, b)
+			# it wraps around 0
+			return self.slice(a, SIZE - 1) + self.slice(-1, b)
+		finally:
+			self.mutex_.release()
+
+	def slice(self, a, b):
+		# entries with a < id <= b, mutex_ must be held
+		# every key sorts after None
+		start = bisect.bisect_left(self.index_, (a + 1, None))
+		end = bisect.bisect_left(self.index_, (b + 1, None))
+		return self.index_[start:end]
+
+# RangeStore whose values live in an append-only log on disk, only the
+# keys and where their values are stay in memory, so it can hold more than
+# fits in RAM. Every write appends an entry and a delete appends a
+# tombstone. Opening the log reads it back and checks it, only the keys
+# are kept, and compact() rewrites the live entries once most of it is
+# garbage.
+# Entries are
+# crc32 of the rest of the header | crc32 of key and value | op |
+# key length | value length | key | value
+# with key and value pickled so tuples come back as tuples. The header has
+# its own crc so a corrupted length is told apart from a torn write.
+class LogStore(RangeStore):
+	CRC = struct.Struct("!I")
+	FIELDS = struct.Struct("!IBII")
+	HEADER_SIZE = CRC.size + FIELDS.size
+	PUT = 0
+	DELETE = 1
+
+	def __init__(self, path, sync = STORE_SYNC):
+		RangeStore.__init__(self)
+		self.path_ = path
+		self.sync_ = sync
+		# bytes in the log, and of them the ones that are old versions,
+		# deleted keys or tombstones
+		self.size_ = 0
+		self.garbage_ = 0
+		# entries skipped when reading the log back because they were
+		# corrupted
+		self.corrupted_ = 0
+		directory = os.path.dirname(path)
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.recover()
+		self.file_ = open(path, 'a+b')
+
+	def recover(self):
+		# data_ = key -> (id of key, (offset, size) of its entry). Every
+		# entry is checked: one that doesn't fit in the file, or is the last
+		# one and doesn't check out, is a write that didn't make it to disk
+		# whole and is cut off. One in the middle whose key and value are
+		# corrupted is skipped, so an older version of its key (if any) is
+		# what we keep. If a header in the middle is corrupted we can't
+		# tell where the next entry starts, the log is left as it is and
+		# IOError raised.
+		if not os.path.exists(self.path_):
+			return
+		f = open(self.path_, 'rb')
+		try:
+			end = os.fstat(f.fileno()).st_size
+			offset = 0
+			while offset + self.HEADER_SIZE <= end:
+				fields = self.unpack_header(f.read(self.HEADER_SIZE))
+				if fields == None:
+					if f.read().strip("\0") == "":
+						# the file grew but what was written is not there
+						break
+					raise IOError("corrupted entry header in %s at %s, %s bytes after it" % \
+					              (self.path_, offset, end - offset))
+				crc, op, key_size, value_size = fields
+				size = self.HEADER_SIZE + key_size + value_size
+				if offset + size > end:
+					break
+				body = f.read(key_size + value_size)
+				try:
+					if self.crc(body) != crc:
+						raise ValueError
+					key = cPickle.loads(body[:key_size])
+				except Exception:
+					if offset + size == end:
+						break
+					self.corrupted_ += 1
+					self.garbage_ += size
+					offset += size
+					continue
+				entry = self.data_.get(key)
+				if entry != None:
+					self.garbage_ += entry[1][1]
+				if op == self.PUT:
+					self.data_[key] = (entry[0] if entry != None else key_id(key), (offset, size))
+				else:
+					self.data_.pop(key, None)
+					self.garbage_ += size
+				offset += size
+		finally:
+			f.close()
+		if offset < end:
+			f = open(self.path_, 'r+b')
+			f.truncate(offset)
+			f.close()
+		self.size_ = offset
+		self.index_ = sorted((entry[0], key) for key, entry in self.data_.iteritems())
+
+	def crc(self, data):
+		return zlib.crc32(data) & 0xffffffff
+
+	def pack_header(self, op, key_size, body):
+		fields = self.FIELDS.pack(self.crc(body), op, key_size, len(body) - key_size)
+		return self.CRC.pack(self.crc(fields)) + fields
+
+	def unpack_header(self, header):
+		# (crc of the body, op, key length, value length), None if the
+		# header is corrupted
+		fields = header[self.CRC.size:self.HEADER_SIZE]
+		if len(fields) != self.FIELDS.size or self.CRC.unpack_from(header)[0] != self.crc(fields):
+			return None
+		return self.FIELDS.unpack(fields)
+
+	def append(self, op, key, value):
+		# mutex_ must be held, returns (offset, size) of the entry
+		body = cPickle.dumps(key, 2)
+		key_size = len(body)
+		if op == self.PUT:
+			body += cPickle.dumps(value, 2)
+		entry = self.pack_header(op, key_size, body) + body
+		self.file_.seek(0, 2)
+		self.file_.write(entry)
+		self.file_.flush()
+		if self.sync_:
+			os.fsync(self.file_.fileno())
+		location = (self.size_, len(entry))
+		self.size_ += len(entry)
+		return location
+
+	def read(self, location):
+		# mutex_ must be held
+		offset, size = location
+		self.file_.seek(offset)
+		entry = self.file_.read(size)
+		fields = self.unpack_header(entry)
+		body = entry[self.HEADER_SIZE:]
+		if fields == None or len(body) != fields[2] + fields[3] or self.crc(body) != fields[0]:
+			raise IOError("corrupted entry in %s at %s" % (self.path_, offset))
+		return cPickle.loads(body[fields[2]:])
+
+	def __getitem__(self, key):
+		self.mutex_.acquire()
+		try:
+			return self.read(RangeStore.__getitem__(self, key))
+		finally:
+			self.mutex_.release()
+
+	def get(self, key, default = None):
+		self.mutex_.acquire()
+		try:
+			location = RangeStore.get(self, key)
+			if location == None:
+				return default
+			return self.read(location)
+		finally:
+			self.mutex_.release()
+
+	def __setitem__(self, key, value):
+		self.mutex_.acquire()
+		try:
+			location = self.append(self.PUT, key, value)
+			old = RangeStore.get(self, key)
+			if old != None:
+				self.garbage_ += old[1]
+			RangeStore.__setitem__(self, key, location)
+		finally:
+			self.mutex_.release()
+
+	def __delitem__(self, key):
+		self.mutex_.acquire()
+		try:
+			old = RangeStore.get(self, key)
+			if old == None:
+				raise KeyError(key)
+			location = self.append(self.DELETE, key, None)
+			self.garbage_ += old[1] + location[1]
+			RangeStore.__delitem__(self, key)
+		finally:
+			self.mutex_.release()
+
+	def compact(self, force = False):
+		# rewrites the live entries in ring order once STORE_COMPACT_RATIO
+		# of the log is garbage. Returns whether it did.
+		self.mutex_.acquire()
+		try:
+			if not force and (self.garbage_ < STORE_COMPACT_MIN or \
+			                  self.garbage_ < self.size_ * STORE_COMPACT_RATIO):
+				return False
+			path = self.path_ + '.compact'
+			f = open(path, 'wb')
+			offset = 0
+			locations = []
+			for id, key in self.index_:
+				start, size = self.data_[key][1]
+				self.file_.seek(start)
+				f.write(self.file_.read(size))
+				locations.append((key, id, (offset, size)))
+				offset += size
+			f.flush()
+			os.fsync(f.fileno())
+			f.close()
+			os.rename(path, self.path_)
+			self.file_.close()
+			self.file_ = open(self.path_, 'a+b')
+			for key, id, location in locations:
+				self.data_[key] = (id, location)
+			self.size_ = offset
+			self.garbage_ = 0
+			return True
+		finally:
+			self.mutex_.release()
+
+	def close(self):
+		self.mutex_.acquire()
+		try:
+			self.file_.flush()
+			os.fsync(self.file_.fileno())
+			self.file_.close()
+		finally:
+			self.mutex_.release()
+
+def open_store(name, backend = STORE_BACKEND):
+	# the store of a DHT, name tells apart the ones of a process and of
+	# every process on the machine. 'memory' ones are gone on restart,
+	# 'log' ones are read back from STORE_DIR
+	if backend == 'log':
+		return LogStore(os.path.join(STORE_DIR, name + '.log'))
+	if backend != 'memory':
+		raise ValueError("unknown store backend %s" % backend)
+	return RangeStore()
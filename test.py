@@ -4,10 +4,17 @@ import socket
 import random
 from chord import *
 
+# random ids looked up, there are too many to try them all
+LOOKUP_TEST_KEYS = 1000
 
 def check_key_lookup(peers, hash_list):
 	print "Running key lookup consistency test"
-	for key in range(SIZE):
+	# the ids of the peers and their neighbours, and a sample of the rest
+	keys = map(lambda x: random.randrange(SIZE), range(LOOKUP_TEST_KEYS))
+	for id in hash_list:
+		keys += [id - 1, id, id + 1]
+	for key in keys:
+		key = key % SIZE
 		# select random node
 		node = peers[random.randrange(len(peers))]
 		# get the successor
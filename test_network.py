@@ -0,0 +1,157 @@
+import socket
+import threading
+
+from codec import get_codec
+from network import *
+from settings import MAX_FRAME_SIZE
+
+# checks of the framing reader and the codecs, over socket pairs so no
+# ring is needed. `$>python test_network.py`
+
+VALUES = [None, True, False, 0, -1, 42, (1<<63) - 1, -(1<<63), 1<<63, (1<<160) - 1, -(1<<100),
+          0.5, -1e300, "", "hello", "\x00\xff\xfe bytes", u"unicode \xe9", [], [1, [2, [3]]],
+          {}, {'key':'value', 'nested':{'list':[1, "\xff", None]}}, ('a', 1)]
+
+def normalized(obj):
+	# tuples come back as lists
+	if isinstance(obj, (list, tuple)):
+		return map(normalized, obj)
+	if isinstance(obj, dict):
+		return dict((key, normalized(value)) for key, value in obj.iteritems())
+	return obj
+
+def check_codecs():
+	print "Running codec round trip test"
+	for name in ('json', 'binary'):
+		codec = get_codec(name)
+		for value in VALUES:
+			decoded = codec.decode(codec.encode(value))
+			assert decoded == normalized(value), (name, value, decoded)
+	print "Finished codec round trip test, all good"
+
+def check_malformed():
+	print "Running malformed payload test"
+	codec = get_codec('binary')
+	for value in VALUES:
+		data = codec.encode(value)
+		# every cut of a message is an error, and only a ValueError
+		for end in range(len(data)):
+			try:
+				codec.decode(data[:end])
+			except ValueError:
+				continue
+			assert False, "%r decoded" % data[:end]
+	for data in ['l\x00\x00\x00\x05', 'x', 'N trailing', 'd\x00\x00\x00\x01l\x00\x00\x00\x00N', 'l\x00\x00\x00\x01' * 5000]:
+		try:
+			codec.decode(data)
+		except ValueError:
+			continue
+		assert False, "%r decoded" % data[:20]
+	print "Finished malformed payload test, all good"
+
+def dribble(s, data, size = 1):
+	# sends data a few bytes at a time
+	for i in range(0, len(data), size):
+		s.sendall(data[i:i + size])
+
+def check_text_mode():
+	print "Running text mode framing test"
+	a, b = socket.socketpair()
+	conn = Connection(b)
+	# terminator split between two reads
+	a.sendall("ping\r")
+	thread = threading.Thread(target = lambda: dribble(a, "\nfind_successor 10\r\n"))
+	thread.start()
+	assert conn.read_message() == (None, "ping")
+	assert conn.read_message() == (None, "find_successor 10")
+	thread.join()
+	# several lines in a single read
+	a.sendall("@3 get_successor \r\n@4 ping\r\nshutdown\r\n")
+	assert conn.read_message() == (3, "get_successor ")
+	assert conn.has_buffered()
+	assert conn.read_message() == (4, "ping")
+	assert conn.read_message() == (None, "shutdown")
+	assert not conn.has_buffered()
+	# answers are json, tagged like the request
+	conn.send_message(7, {'status':'ok'})
+	conn.send_message(None, True)
+	assert a.recv(100) == '@7 {"status": "ok"}\r\ntrue\r\n'
+	conn.close()
+	a.close()
+	print "Finished text mode framing test, all good"
+
+def check_framed():
+	print "Running framed connection test"
+	for codec in ('json', 'binary'):
+		a, b = socket.socketpair()
+		client = Connection(a)
+		server = Connection(b)
+		# the client waits for the codec the server picked
+		thread = threading.Thread(target = client.start_framing, args = (codec,))
+		thread.start()
+		assert server.read_message() == None
+		thread.join()
+		assert client.codec_.name == codec and server.codec_.name == codec
+		# a frame bigger than the receive buffer, sent without copying
+		big = "x" * (3 * RECV_SIZE) + "\xff"
+		def send():
+			client.send_message(1, ['set', {'key':'k', 'value':big}])
+			client.send_message(2, ['ping', None, 3])
+		thread = threading.Thread(target = send)
+		thread.start()
+		assert server.read_message() == (1, ['set', {'key':'k', 'value':big}])
+		assert server.read_message() == (2, ['ping', None, 3])
+		thread.join()
+		# frames that arrive in a single read
+		first = client.codec_.encode(['ping'])
+		second = client.codec_.encode(['get_successor', None])
+		a.sendall(FRAME_HEADER.pack(len(first), 3) + first + FRAME_HEADER.pack(len(second), 4) + second)
+		assert server.read_message() == (3, ['ping'])
+		assert server.has_buffered()
+		assert server.read_message() == (4, ['get_successor', None])
+		assert not server.has_buffered()
+		# identifiers bigger than 64 bits, a frame a byte at a time
+		id = (1<<160) - 12345
+		server.send_message(9, [id, -id])
+		client.send_message(5, ['find_successor', id])
+		assert server.read_message() == (5, ['find_successor', id])
+		assert client.read_message() == (9, [id, -id])
+		frame = FRAME_HEADER.pack(len(client.codec_.encode(id)), 6) + client.codec_.encode(id)
+		thread = threading.Thread(target = dribble, args = (a, frame))
+		thread.start()
+		assert server.read_message() == (6, id)
+		thread.join()
+		client.close()
+		server.close()
+	print "Finished framed connection test, all good"
+
+def check_frame_limits():
+	print "Running frame size limit test"
+	a, b = socket.socketpair()
+	server = Connection(b)
+	a.sendall(FRAME_MAGIC + FRAME_HEADER.pack(len('binary'), 0) + 'binary')
+	assert server.read_message() == None
+	assert a.recv(100)[FRAME_HEADER.size:] == 'binary'
+	# the header is enough to turn it down, nothing else is read
+	a.sendall(FRAME_HEADER.pack(MAX_FRAME_SIZE + 1, 1))
+	try:
+		server.read_message()
+		assert False, "oversized frame accepted"
+	except socket.error:
+		pass
+	# and we don't send them either
+	try:
+		server.send_frame(2, "x" * (MAX_FRAME_SIZE + 1))
+		assert False, "oversized frame sent"
+	except socket.error:
+		pass
+	server.close()
+	a.close()
+	print "Finished frame size limit test, all good"
+
+if __name__ == "__main__":
+	check_codecs()
+	check_malformed()
+	check_text_mode()
+	check_framed()
+	check_frame_limits()
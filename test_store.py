@@ -0,0 +1,152 @@
+import os
+import shutil
+import tempfile
+
+from store import LogStore
+
+# checks of the log store: reading it back after a crash, corruption,
+# deletes and compaction. `$>python test_store.py`
+
+def new_log(directory, name, count):
+	# a log with count keys, returns it and the (offset, size) of the
+	# entry of every key
+	store = LogStore(os.path.join(directory, name))
+	for i in range(count):
+		store["key%s" % i] = (i, "value%s" % i)
+	locations = map(lambda i: store.data_["key%s" % i][1], range(count))
+	store.close()
+	return store.path_, locations
+
+def flip(path, offset):
+	f = open(path, 'r+b')
+	f.seek(offset)
+	byte = f.read(1)
+	f.seek(offset)
+	f.write(chr(ord(byte) ^ 0x10))
+	f.close()
+
+def check_reopen(directory):
+	print "Running log replay test"
+	store = LogStore(os.path.join(directory, 'replay.log'))
+	for i in range(10):
+		store["key%s" % i] = (i, "old")
+	for i in range(5):
+		store["key%s" % i] = (i, "new")
+	del store["key9"]
+	store["key8"] = (8, "after")
+	size = store.size_
+	store.close()
+	store = LogStore(store.path_)
+	assert sorted(store.keys()) == sorted("key%s" % i for i in range(9))
+	for i in range(5):
+		assert store["key%s" % i] == (i, "new")
+	assert store["key5"] == (5, "old")
+	assert store["key8"] == (8, "after")
+	# the tombstone keeps key9 deleted
+	assert store.get("key9") == None
+	assert store.size_ == size and store.corrupted_ == 0
+	# overwrites, the deleted key and its tombstone are garbage
+	assert store.garbage_ > 0
+	assert store.keys_in_range(0, 0) != []
+	store.close()
+	print "Finished log replay test, all good"
+
+def check_torn_tail(directory):
+	print "Running torn tail test"
+	path, locations = new_log(directory, 'torn.log', 10)
+	last = locations[-1]
+	for cut in (1, LogStore.HEADER_SIZE - 1, LogStore.HEADER_SIZE + 1, last[1] - 1):
+		shutil.copy(path, path + '.cut')
+		f = open(path + '.cut', 'r+b')
+		f.truncate(last[0] + last[1] - cut)
+		f.close()
+		store = LogStore(path + '.cut')
+		# the last write is gone, the rest is there and we can go on
+		assert len(store) == 9 and store.get("key9") == None, cut
+		assert os.path.getsize(path + '.cut') == last[0]
+		store["key9"] = (9, "again")
+		store.close()
+		store = LogStore(path + '.cut')
+		assert len(store) == 10 and store["key9"] == (9, "again")
+		store.close()
+	# a torn write that left zeros behind
+	shutil.copy(path, path + '.cut')
+	f = open(path + '.cut', 'ab')
+	f.write("\0" * 100)
+	f.close()
+	store = LogStore(path + '.cut')
+	assert len(store) == 10 and os.path.getsize(path + '.cut') == os.path.getsize(path)
+	store.close()
+	print "Finished torn tail test, all good"
+
+def check_corruption(directory):
+	print "Running corrupted entry test"
+	path, locations = new_log(directory, 'corrupted.log', 10)
+	size = os.path.getsize(path)
+	# in the value of the third entry, the rest of the log is still there
+	flip(path, locations[2][0] + locations[2][1] - 3)
+	store = LogStore(path)
+	assert store.corrupted_ == 1 and store.get("key2") == None
+	assert len(store) == 9 and os.path.getsize(path) == size
+	for i in range(10):
+		if i != 2:
+			assert store["key%s" % i] == (i, "value%s" % i)
+	store.close()
+	# in the value length of the third entry, we can't find the ones
+	# after it so the log is not touched
+	path, locations = new_log(directory, 'length.log', 10)
+	size = os.path.getsize(path)
+	flip(path, locations[2][0] + LogStore.HEADER_SIZE - 1)
+	try:
+		LogStore(path)
+		assert False, "corrupted header accepted"
+	except IOError:
+		pass
+	assert os.path.getsize(path) == size
+	# corrupted after it was read back, reads fail instead of returning it
+	path, locations = new_log(directory, 'late.log', 3)
+	store = LogStore(path)
+	flip(path, locations[1][0] + locations[1][1] - 3)
+	try:
+		store["key1"]
+		assert False, "corrupted entry read"
+	except IOError:
+		pass
+	assert store["key0"] == (0, "value0")
+	store.close()
+	print "Finished corrupted entry test, all good"
+
+def check_compact(directory):
+	print "Running compaction test"
+	store = LogStore(os.path.join(directory, 'compact.log'))
+	for round in range(5):
+		for i in range(50):
+			store["key%s" % i] = (round, "x" * 100)
+	for i in range(0, 50, 2):
+		del store["key%s" % i]
+	before = store.size_
+	assert store.compact(True)
+	assert store.size_ < before / 4 and store.garbage_ == 0
+	assert os.path.getsize(store.path_) == store.size_
+	# written after compacting, the log goes on from where it ends now
+	store["key0"] = (5, "back")
+	store.close()
+	store = LogStore(store.path_)
+	assert len(store) == 26 and store.corrupted_ == 0
+	assert store["key0"] == (5, "back") and store.get("key2") == None
+	for i in range(1, 50, 2):
+		assert store["key%s" % i] == (4, "x" * 100)
+	# nothing to reclaim
+	assert not store.compact()
+	store.close()
+	print "Finished compaction test, all good"
+
+if __name__ == "__main__":
+	directory = tempfile.mkdtemp()
+	try:
+		check_reopen(directory)
+		check_torn_tail(directory)
+		check_corruption(directory)
+		check_compact(directory)
+	finally:
+		shutil.rmtree(directory)
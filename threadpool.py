@@ -0,0 +1,48 @@
+import sys
+import threading
+import traceback
+import Queue
+
+# fixed number of worker threads consuming jobs from a bounded queue
+class ThreadPool(object):
+	def __init__(self, workers, queue_size):
+		self.queue_ = Queue.Queue(queue_size)
+		self.workers_ = []
+		for i in range(workers):
+			worker = threading.Thread(target = self.work)
+			worker.daemon = True
+			worker.start()
+			self.workers_.append(worker)
+
+	# returns False if the queue is full, the caller decides whether to
+	# wait, retry later or drop the job
+	def submit(self, func, *args):
+		try:
+			self.queue_.put_nowait((func, args))
+			return True
+		except Queue.Full:
+			return False
+
+	def saturated(self):
+		return self.queue_.full()
+
+	def pending(self):
+		return self.queue_.qsize()
+
+	def work(self):
+		while 1:
+			job = self.queue_.get()
+			# None is the signal to leave
+			if job == None:
+				return
+			func, args = job
+			try:
+				func(*args)
+			except Exception:
+				# a failing job must not kill the worker
+				traceback.print_exc(file = sys.stderr)
+
+	def shutdown(self):
+		# blocking put, workers will make room as they leave
+		for worker in self.workers_:
+			self.queue_.put(None)